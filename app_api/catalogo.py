@@ -0,0 +1,82 @@
+"""
+Pacote de cadastros do app (/api/catalog/): clientes, condutores, veículos e
+produtos ativos, só com os campos que o app usa, em uma resposta.
+
+O ETag é o SHA-256 do pacote. Para não montar o pacote a cada pedido, ele fica
+em cache sob uma impressão barata das tabelas (COUNT e MAX(atualizado_em) de
+cada uma e a última exclusão): qualquer inclusão, alteração, inativação ou
+exclusão muda a impressão, e o pacote é refeito no próximo pedido. Um app com o
+pacote em dia recebe 304 depois dessas poucas queries agregadas.
+
+O token do pacote é a última alteração (menos a margem do /api/sync/); com
+?since=<token> vêm só as diferenças desde ele.
+"""
+import hashlib
+import json
+
+from django.core.cache import cache
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Count, Max
+
+from app_avarias.models import Cliente, Condutor, Produto, RegistroExcluido, Veiculo
+
+from .sincronizacao import ids_removidos, token_ate
+
+CADASTROS = {
+    'clientes': (Cliente, ('id', 'razao_social', 'cnpj')),
+    'condutores': (Condutor, ('id', 'nome', 'cpf')),
+    'veiculos': (Veiculo, ('id', 'placa', 'modelo', 'tipo')),
+    'produtos': (Produto, ('id', 'nome', 'laboratorio', 'codigo_controle')),
+}
+
+MODELOS = [modelo._meta.model_name for modelo, _ in CADASTROS.values()]
+
+
+def ativos(modelo):
+    return modelo.objects.filter(ativo=True)
+
+
+def _impressao():
+    """(impressão das tabelas, momento da última alteração ou exclusão)."""
+    partes = []
+    momentos = []
+    for modelo, _ in CADASTROS.values():
+        dados = modelo.objects.aggregate(total=Count('id'), ultimo=Max('atualizado_em'))
+        partes.append(f"{dados['total']}:{dados['ultimo']}")
+        momentos.append(dados['ultimo'])
+    ultima_exclusao = RegistroExcluido.objects.filter(modelo__in=MODELOS).aggregate(ultimo=Max('excluido_em'))['ultimo']
+    partes.append(str(ultima_exclusao))
+    momentos.append(ultima_exclusao)
+    return hashlib.sha256('|'.join(partes).encode()).hexdigest(), max(filter(None, momentos), default=None)
+
+
+def _json(dados):
+    return json.dumps(dados, cls=DjangoJSONEncoder, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def pacote():
+    """(etag, conteúdo JSON em bytes, token) do pacote completo."""
+    impressao, ultimo = _impressao()
+    chave = f'api:catalogo:{impressao}'
+    em_cache = cache.get(chave)
+    if em_cache:
+        return em_cache
+
+    token = token_ate(ultimo) if ultimo else None
+    dados = {'token': token}
+    for nome, (modelo, campos) in CADASTROS.items():
+        dados[nome] = list(ativos(modelo).order_by('id').values(*campos))
+    conteudo = _json(dados)
+    em_cache = (f'"{hashlib.sha256(conteudo).hexdigest()}"', conteudo, token)
+    # A new fingerprint means a new key; old bundles simply expire
+    cache.set(chave, em_cache, 60 * 60 * 24)
+    return em_cache
+
+
+def diferencas(desde, token):
+    """Conteúdo JSON com o que mudou desde o momento: alterados ativos e ids removidos."""
+    dados = {'token': token, 'removidos': {}}
+    for nome, (modelo, campos) in CADASTROS.items():
+        dados[nome] = list(ativos(modelo).filter(atualizado_em__gt=desde).order_by('id').values(*campos))
+        dados['removidos'][nome] = ids_removidos(ativos(modelo), desde)
+    return _json(dados)
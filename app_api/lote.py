@@ -0,0 +1,159 @@
+"""
+Criação de Avarias em lote (POST /api/avarias/bulk/), para os envios que o app
+acumula sem sinal e manda quando volta a ficar online.
+
+Cada entrada traz uma chave (UUID) gerada no app. A chave é gravada na Avaria
+(única por usuário), então reenviar o mesmo lote, inteiro ou em parte, devolve
+os ids já criados em vez de duplicar.
+
+O lote é gravado numa transação, com um bulk_create para as Avarias, um para
+os itens e um para os eventos de abertura (gravar_avarias, usado também pela
+criação avulsa). Como o bulk_create não chama save() nem envia post_save, o
+que os signals fariam é feito aqui: UF, resumo mensal, índice de busca e cache
+do Dashboard.
+"""
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+
+from app_avarias import resumo, search
+from app_avarias.dashboard import invalidate_dashboard_cache
+from app_avarias.eventos import novo_evento
+from app_avarias.models import Avaria, AvariaEvento, AvariaItem, Cliente, Condutor, Produto, Veiculo, extrair_uf
+
+LIMITE_LOTE = getattr(settings, 'API_LIMITE_LOTE', 200)
+
+# Campo da entrada -> model referenciado
+REFERENCIAS = {
+    'cliente': Cliente,
+    'motorista': Condutor,
+    'veiculo': Veiculo,
+    'motorista_devolucao': Condutor,
+    'veiculo_devolucao': Veiculo,
+}
+
+
+def _pk_invalido(pk):
+    return [f'Pk inválido "{pk}" - objeto não existe.']
+
+
+def erros_do_lote(entradas):
+    """
+    Erros por entrada, no formato do DRF para listas (um dict por entrada), ou
+    None se o lote é válido. Confere as referências com um SELECT por model e
+    recusa chaves repetidas no mesmo lote.
+    """
+    pedidos = defaultdict(set)
+    for entrada in entradas:
+        for campo, modelo in REFERENCIAS.items():
+            if entrada.get(campo) is not None:
+                pedidos[modelo].add(entrada[campo])
+        pedidos[Produto].update(item['produto'] for item in entrada['itens'])
+    existentes = {
+        modelo: set(modelo.objects.filter(pk__in=ids).values_list('pk', flat=True))
+        for modelo, ids in pedidos.items()
+    }
+
+    erros = []
+    chaves = set()
+    for entrada in entradas:
+        erro = {}
+        if entrada['chave'] in chaves:
+            erro['chave'] = ['Chave repetida no lote.']
+        chaves.add(entrada['chave'])
+        for campo, modelo in REFERENCIAS.items():
+            pk = entrada.get(campo)
+            if pk is not None and pk not in existentes[modelo]:
+                erro[campo] = _pk_invalido(pk)
+        erros_itens = [
+            {} if item['produto'] in existentes[Produto] else {'produto': _pk_invalido(item['produto'])}
+            for item in entrada['itens']
+        ]
+        if any(erros_itens):
+            erro['itens'] = erros_itens
+        erros.append(erro)
+    return erros if any(erros) else None
+
+
+def _nova_avaria(usuario, entrada):
+    return Avaria(
+        criado_por=usuario,
+        chave_idempotencia=entrada['chave'],
+        cliente_id=entrada['cliente'],
+        nota_fiscal=entrada['nota_fiscal'],
+        motorista_id=entrada.get('motorista'),
+        veiculo_id=entrada.get('veiculo'),
+        motorista_devolucao_id=entrada.get('motorista_devolucao'),
+        veiculo_devolucao_id=entrada.get('veiculo_devolucao'),
+        nf_devolucao=entrada.get('nf_devolucao'),
+    )
+
+
+def gravar_avarias(usuario, novas):
+    """
+    Grava [(avaria, itens, observacoes)], com a Avaria e os AvariaItem ainda
+    não salvos, com um bulk_create por tabela, e faz o que os signals de
+    post_save fariam. Usado pelo lote e pela criação avulsa (AvariaSerializer).
+    """
+    for avaria, _, _ in novas:
+        # What Avaria.save() would derive
+        avaria.uf = extrair_uf(avaria.local_atuacao)
+
+    with transaction.atomic():
+        avarias = Avaria.objects.bulk_create([avaria for avaria, _, _ in novas])
+        itens = []
+        for avaria, itens_da_avaria, _ in novas:
+            for item in itens_da_avaria:
+                item.avaria = avaria
+                itens.append(item)
+        AvariaItem.objects.bulk_create(itens)
+        AvariaEvento.objects.bulk_create([
+            novo_evento(avaria, 'ABERTURA', usuario, observacoes)
+            for avaria, _, observacoes in novas
+            if (observacoes or '').strip()
+        ])
+
+        if avarias:
+            resumo.somar_criadas(avarias)
+            criadas_ids = [avaria.pk for avaria in avarias]
+            transaction.on_commit(invalidate_dashboard_cache)
+            transaction.on_commit(lambda: search.indexar_avarias(criadas_ids))
+    return avarias
+
+
+def _criar(usuario, entradas):
+    chaves = [entrada['chave'] for entrada in entradas]
+    ids = dict(
+        Avaria.objects.filter(criado_por=usuario, chave_idempotencia__in=chaves)
+        .values_list('chave_idempotencia', 'pk')
+    )
+    avarias = gravar_avarias(usuario, [
+        (
+            _nova_avaria(usuario, entrada),
+            [AvariaItem(produto_id=item['produto'], quantidade=item['quantidade'], lote=item.get('lote'))
+             for item in entrada['itens']],
+            entrada.get('observacoes', ''),
+        )
+        for entrada in entradas if entrada['chave'] not in ids
+    ])
+
+    criadas = {avaria.chave_idempotencia: avaria.pk for avaria in avarias}
+    return [
+        {'chave': str(chave), 'id': ids.get(chave) or criadas[chave], 'criada': chave in criadas}
+        for chave in chaves
+    ]
+
+
+def criar_avarias(usuario, entradas):
+    """
+    Grava as entradas (já validadas) que ainda não existem e devolve, na ordem
+    do lote, {'chave', 'id', 'criada'} de cada uma.
+    """
+    try:
+        with transaction.atomic():
+            return _criar(usuario, entradas)
+    except IntegrityError:
+        # A concurrent retry of the same batch committed first: now its rows are found by key
+        with transaction.atomic():
+            return _criar(usuario, entradas)
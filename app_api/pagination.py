@@ -0,0 +1,21 @@
+"""
+Paginação por cursor da API (padrão de todos os viewsets, ver REST_FRAMEWORK).
+
+A resposta vira {"next", "previous", "results"}; o app segue o link "next".
+Como em app_avarias/pagination.py, o cursor parte do último registro da página
+anterior em vez de usar OFFSET: o custo não cresce com o número da página e
+registros novos não fazem a listagem repetir ou pular itens.
+"""
+from rest_framework.pagination import CursorPagination
+
+
+class CursorPadrao(CursorPagination):
+    page_size = 50
+    page_size_query_param = 'page_size'
+    max_page_size = 500
+    ordering = 'id'
+
+
+class CursorAvarias(CursorPadrao):
+    # Same order (and index) as the web list: most recent first
+    ordering = ('-data_criacao', '-id')
@@ -1,28 +1,48 @@
 
 from rest_framework import serializers
-from app_avarias.models import Usuario, Cliente, Condutor, Veiculo, Produto, Avaria, AvariaFoto, AvariaItem
+from app_avarias.eventos import formatar_evento, registrar_evento
+from app_avarias.models import Usuario, Cliente, Condutor, Veiculo, Produto, Avaria, AvariaEvento, AvariaFoto, AvariaItem
+from . import lote
+
+def campos_pedidos(request):
+    """Campos de ?fields=id,status,... (sparse fieldset), ou None para todos."""
+    if request is None or request.method != 'GET' or not request.query_params.get('fields'):
+        return None
+    return {campo.strip() for campo in request.query_params['fields'].split(',') if campo.strip()}
+
+
+class CamposSelecionaveisMixin:
+    """Em leituras com ?fields=..., o serializer só devolve os campos pedidos."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        campos = campos_pedidos(self.context.get('request'))
+        if campos:
+            for nome in set(self.fields) - campos:
+                self.fields.pop(nome)
+
 
 class UsuarioSerializer(serializers.ModelSerializer):
     class Meta:
         model = Usuario
         fields = ['id', 'username', 'email', 'nivel_acesso', 'local_atuacao']
 
-class ClienteSerializer(serializers.ModelSerializer):
+class ClienteSerializer(CamposSelecionaveisMixin, serializers.ModelSerializer):
     class Meta:
         model = Cliente
         fields = '__all__'
 
-class CondutorSerializer(serializers.ModelSerializer):
+class CondutorSerializer(CamposSelecionaveisMixin, serializers.ModelSerializer):
     class Meta:
         model = Condutor
         fields = '__all__'
 
-class VeiculoSerializer(serializers.ModelSerializer):
+class VeiculoSerializer(CamposSelecionaveisMixin, serializers.ModelSerializer):
     class Meta:
         model = Veiculo
         fields = '__all__'
 
-class ProdutoSerializer(serializers.ModelSerializer):
+class ProdutoSerializer(CamposSelecionaveisMixin, serializers.ModelSerializer):
     class Meta:
         model = Produto
         fields = '__all__'
@@ -35,12 +55,24 @@ class AvariaItemSerializer(serializers.ModelSerializer):
         fields = ['id', 'produto', 'produto_nome', 'quantidade', 'lote']
 
 class AvariaFotoSerializer(serializers.ModelSerializer):
+    # arquivo is the original upload; the renditions are empty until processed
     class Meta:
         model = AvariaFoto
-        fields = ['id', 'avaria', 'arquivo', 'data_upload']
-        read_only_fields = ['data_upload']
+        fields = ['id', 'avaria', 'arquivo', 'web', 'miniatura', 'impressao', 'processada_em', 'data_upload']
+        read_only_fields = ['web', 'miniatura', 'impressao', 'processada_em', 'data_upload']
+
+class AvariaEventoSerializer(serializers.ModelSerializer):
+    # Same line the history text (observacoes) shows for this entry
+    linha = serializers.SerializerMethodField()
+
+    class Meta:
+        model = AvariaEvento
+        fields = ['id', 'tipo', 'autor', 'timestamp', 'texto', 'dados', 'linha']
+
+    def get_linha(self, obj):
+        return formatar_evento(obj)
 
-class AvariaSerializer(serializers.ModelSerializer):
+class AvariaSerializer(CamposSelecionaveisMixin, serializers.ModelSerializer):
     # Nested representation for reading
     cliente_nome = serializers.ReadOnlyField(source='cliente.razao_social')
     status_display = serializers.SerializerMethodField()
@@ -48,6 +80,8 @@ class AvariaSerializer(serializers.ModelSerializer):
     # Nested serializers
     itens = AvariaItemSerializer(many=True)
     fotos = AvariaFotoSerializer(many=True, read_only=True)
+    # Read: history rendered from the events. Write: initial note (ABERTURA event)
+    observacoes = serializers.CharField(required=False, allow_blank=True)
 
     class Meta:
         model = Avaria
@@ -56,9 +90,9 @@ class AvariaSerializer(serializers.ModelSerializer):
             'itens',
             'motorista', 'veiculo', 'status', 'status_display', 'data_criacao', 
             'motorista_devolucao', 'veiculo_devolucao', 'nf_devolucao',
-            'fotos', 'observacoes'
+            'fotos', 'observacoes', 'atualizado_em'
         ]
-        read_only_fields = ['status', 'data_criacao', 'data_decisao', 'data_inicio_devolucao', 'data_finalizacao', 'criado_por']
+        read_only_fields = ['status', 'data_criacao', 'atualizado_em', 'data_decisao', 'data_inicio_devolucao', 'data_finalizacao', 'criado_por']
 
     def get_status_display(self, obj):
         return obj.get_status_display()
@@ -70,9 +104,49 @@ class AvariaSerializer(serializers.ModelSerializer):
         user = self.context['request'].user
         validated_data['criado_por'] = user
         
-        avaria = Avaria.objects.create(**validated_data)
-        
-        for item_data in items_data:
-            AvariaItem.objects.create(avaria=avaria, **item_data)
-            
+        observacoes = validated_data.pop('observacoes', '')
+        # Same path as the bulk endpoint (lote.py)
+        avaria = Avaria(**validated_data)
+        lote.gravar_avarias(user, [(avaria, [AvariaItem(**item_data) for item_data in items_data], observacoes)])
         return avaria
+
+    def update(self, instance, validated_data):
+        observacoes = validated_data.pop('observacoes', '')
+        instance = super().update(instance, validated_data)
+        if observacoes.strip():
+            registrar_evento(instance, 'OBSERVACAO', self.context['request'].user, observacoes)
+        return instance
+
+
+class ItemLoteSerializer(serializers.Serializer):
+    produto = serializers.IntegerField()
+    quantidade = serializers.IntegerField(default=1)
+    lote = serializers.CharField(max_length=50, required=False, allow_blank=True, allow_null=True)
+
+
+class AvariaLoteSerializer(serializers.Serializer):
+    """
+    Uma Avaria do envio em lote (POST /api/avarias/bulk/): os mesmos campos
+    graváveis do AvariaSerializer, mais a chave gerada no app. As referências
+    chegam como ids e são conferidas de uma vez para o lote (ver lote.py).
+    """
+    chave = serializers.UUIDField()
+    cliente = serializers.IntegerField()
+    nota_fiscal = serializers.CharField(max_length=50)
+    motorista = serializers.IntegerField(required=False, allow_null=True)
+    veiculo = serializers.IntegerField(required=False, allow_null=True)
+    motorista_devolucao = serializers.IntegerField(required=False, allow_null=True)
+    veiculo_devolucao = serializers.IntegerField(required=False, allow_null=True)
+    nf_devolucao = serializers.CharField(max_length=50, required=False, allow_blank=True, allow_null=True)
+    observacoes = serializers.CharField(required=False, allow_blank=True)
+    itens = ItemLoteSerializer(many=True)
+
+
+class AvariasEmLoteSerializer(serializers.Serializer):
+    avarias = AvariaLoteSerializer(many=True, allow_empty=False, max_length=lote.LIMITE_LOTE)
+
+    def validate_avarias(self, entradas):
+        erros = lote.erros_do_lote(entradas)
+        if erros:
+            raise serializers.ValidationError(erros)
+        return entradas
@@ -0,0 +1,48 @@
+"""
+Tokens e exclusões da sincronização incremental do app (/api/sync/ e
+/api/catalog/?since=).
+
+O token é um momento (microssegundos desde 1970). Ele fica MARGEM_SYNC atrás
+da última alteração considerada: uma transação que gravou antes mas fez commit
+depois ainda aparece na próxima sincronização. Por isso uma alteração pode vir
+mais de uma vez; o app só precisa sobrescrever pelo id.
+"""
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.conf import settings
+
+from app_avarias.models import RegistroExcluido
+
+EPOCA = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+
+MARGEM_SYNC = timedelta(seconds=getattr(settings, 'SYNC_MARGEM_SEGUNDOS', 60))
+
+
+def token_ate(momento):
+    """Token para as alterações até momento (menos a margem)."""
+    return str((momento - MARGEM_SYNC - EPOCA) // timedelta(microseconds=1))
+
+
+def ler_token(token):
+    """Momento representado pelo token; ValueError se ele for inválido."""
+    try:
+        return EPOCA + timedelta(microseconds=int(token))
+    except OverflowError:
+        raise ValueError(token)
+
+
+def excluidos(modelo, desde):
+    return list(
+        RegistroExcluido.objects.filter(modelo=modelo._meta.model_name, excluido_em__gt=desde)
+        .values_list('objeto_id', flat=True)
+    )
+
+
+def ids_removidos(visiveis, desde):
+    """Ids que saíram de visiveis desde o momento: os inativados (ainda no banco) e os excluídos."""
+    modelo = visiveis.model
+    return [
+        *modelo.objects.filter(atualizado_em__gt=desde)
+        .exclude(pk__in=visiveis.values('pk')).values_list('pk', flat=True),
+        *excluidos(modelo, desde),
+    ]
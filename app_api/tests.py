@@ -1,3 +1,414 @@
-from django.test import TestCase
+import hashlib
+import shutil
+import tempfile
+import uuid
+from datetime import timedelta
+from decimal import Decimal
+from io import BytesIO
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from PIL import Image
+from rest_framework.test import APIClient
+
+from app_api import sincronizacao
+from app_avarias.eventos import registrar_evento
+from app_avarias.models import (
+    Avaria, AvariaBusca, AvariaEvento, AvariaFoto, AvariaItem, AvariaResumoMensal, Cliente, Produto, UploadFoto,
+)
+
+User = get_user_model()
+
+
+class AddObservacaoTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='operador', password='password')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        cliente = Cliente.objects.create(razao_social="Cliente Teste", cnpj="11111111111111")
+        self.avaria = Avaria.objects.create(cliente=cliente, nota_fiscal='123', criado_por=self.user)
+        self.url = f'/api/avarias/{self.avaria.pk}/add_observacao/'
+
+    def test_grava_apenas_o_evento(self):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.post(self.url, {'texto': 'Primeira'}, format='json')
+        self.assertEqual(response.status_code, 200)
+        escritas = [q['sql'] for q in ctx.captured_queries if q['sql'].startswith(('INSERT', 'UPDATE'))]
+        self.assertEqual(len(escritas), 1)
+        self.assertIn('app_avarias_avariaevento', escritas[0])
+
+    def test_resposta_traz_so_a_nova_entrada(self):
+        self.client.post(self.url, {'texto': 'Primeira'}, format='json')
+        response = self.client.post(self.url, {'texto': 'Segunda'}, format='json')
+        evento = response.json()['evento']
+        self.assertEqual((evento['tipo'], evento['autor'], evento['texto']), ('OBSERVACAO', 'operador', 'Segunda'))
+        self.assertNotIn('Primeira', evento['linha'])
+        self.assertNotIn('observacoes', response.json())
+        self.assertEqual(AvariaEvento.objects.filter(avaria=self.avaria).count(), 2)
+
+    def test_texto_obrigatorio(self):
+        response = self.client.post(self.url, {}, format='json')
+        self.assertEqual(response.status_code, 400)
+
+
+def jpeg(cor):
+    saida = BytesIO()
+    Image.new('RGB', (64, 48), cor).save(saida, 'JPEG')
+    return saida.getvalue()
+
+
+class AvariaConsultasTests(TestCase):
+    # avarias (+cliente) / itens (+produto) / fotos / eventos
+    CONSULTAS = 4
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='operador', password='password')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.cliente = Cliente.objects.create(razao_social="Cliente Teste", cnpj="11111111111111")
+        self.produtos = [
+            Produto.objects.create(nome=f"Produto {i}", laboratorio="EMS", codigo_controle=f"P{i}") for i in range(3)
+        ]
+        self.criar_avarias(2)
+
+    def criar_avarias(self, quantidade):
+        for _ in range(quantidade):
+            avaria = Avaria.objects.create(cliente=self.cliente, nota_fiscal='1', criado_por=self.user)
+            for produto in self.produtos:
+                AvariaItem.objects.create(avaria=avaria, produto=produto, quantidade=1)
+            AvariaFoto.objects.create(avaria=avaria, arquivo='avarias_fotos/foto.jpg')
+            registrar_evento(avaria, 'OBSERVACAO', self.user, 'Nota')
+
+    def test_listagem_nao_cresce_com_o_numero_de_avarias(self):
+        with self.assertNumQueries(self.CONSULTAS):
+            self.assertEqual(len(self.client.get('/api/avarias/').json()['results']), 2)
+        self.criar_avarias(5)
+        with self.assertNumQueries(self.CONSULTAS):
+            dados = self.client.get('/api/avarias/').json()['results']
+        self.assertEqual(len(dados), 7)
+        self.assertEqual(dados[0]['itens'][0]['produto_nome'], 'Produto 0')
+        self.assertIn('Nota', dados[0]['observacoes'])
+
+    def test_detalhe(self):
+        avaria = Avaria.objects.first()
+        with self.assertNumQueries(self.CONSULTAS):
+            dados = self.client.get(f'/api/avarias/{avaria.pk}/').json()
+        self.assertEqual((dados['cliente_nome'], len(dados['itens']), len(dados['fotos'])), ('Cliente Teste', 3, 1))
+
+    def test_paginacao_por_cursor(self):
+        self.criar_avarias(3)
+        response = self.client.get('/api/avarias/', {'page_size': 2, 'fields': 'id'})
+        ids = [a['id'] for a in response.json()['results']]
+        while response.json()['next']:
+            response = self.client.get(response.json()['next'])
+            ids += [a['id'] for a in response.json()['results']]
+        self.assertEqual(ids, list(Avaria.objects.order_by('-data_criacao', '-id').values_list('pk', flat=True)))
+
+    def test_campos_selecionados(self):
+        # Only the avaria query: the relations of fields not asked for are not loaded
+        with self.assertNumQueries(1):
+            dados = self.client.get('/api/avarias/', {'fields': 'id,status,nota_fiscal,data_criacao'}).json()
+        self.assertEqual(set(dados['results'][0]), {'id', 'status', 'nota_fiscal', 'data_criacao'})
+        with self.assertNumQueries(1):
+            dados = self.client.get('/api/avarias/', {'fields': 'id,cliente_nome'}).json()
+        self.assertEqual(dados['results'][0], {'id': dados['results'][0]['id'], 'cliente_nome': 'Cliente Teste'})
+
+        clientes = self.client.get('/api/clientes/', {'fields': 'id,razao_social'}).json()['results']
+        self.assertEqual(clientes, [{'id': self.cliente.pk, 'razao_social': 'Cliente Teste'}])
+        # Writes always answer with the full representation
+        response = self.client.post('/api/clientes/?fields=id', {'razao_social': 'Novo', 'cnpj': '3'}, format='json')
+        self.assertIn('cnpj', response.json())
+
+
+@override_settings(BACKGROUND_TASKS_EAGER=True)
+class UploadEmPartesTests(TestCase):
+    def setUp(self):
+        pasta = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, pasta, ignore_errors=True)
+        pastas = override_settings(MEDIA_ROOT=f'{pasta}/media', UPLOADS_PARCIAIS_DIR=f'{pasta}/parciais')
+        pastas.enable()
+        self.addCleanup(pastas.disable)
+
+        self.user = User.objects.create_user(username='operador', password='password')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        cliente = Cliente.objects.create(razao_social="Cliente Teste", cnpj="11111111111111")
+        self.avaria = Avaria.objects.create(cliente=cliente, nota_fiscal='123', criado_por=self.user)
+        self.base = f'/api/avarias/{self.avaria.pk}/uploads/'
+
+    def iniciar(self, conteudo, nome='foto.jpg'):
+        response = self.client.post(self.base, {'nome': nome, 'tamanho': len(conteudo)}, format='json')
+        self.assertEqual(response.status_code, 201)
+        return f"{self.base}{response.json()['id']}/"
+
+    def enviar(self, url, parte, offset):
+        return self.client.put(url, parte, content_type='application/octet-stream', HTTP_UPLOAD_OFFSET=str(offset))
+
+    def finalizar(self, url, conteudo):
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post(f'{url}finalizar/', {'sha256': hashlib.sha256(conteudo).hexdigest()}, format='json')
+
+    def test_envio_retomado_apos_queda(self):
+        conteudo = jpeg('red')
+        url = self.iniciar(conteudo)
+        self.assertEqual(self.enviar(url, conteudo[:100], 0).json()['offset'], 100)
+
+        # The app lost the response: it asks where to resume from
+        self.assertEqual(self.client.get(url).json()['offset'], 100)
+        response = self.enviar(url, conteudo[50:], 50)
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json()['offset'], 100)
+
+        self.assertEqual(self.enviar(url, conteudo[100:], 100).json()['offset'], len(conteudo))
+        response = self.finalizar(url, conteudo)
+        self.assertEqual(response.status_code, 201)
+        foto = AvariaFoto.objects.get(pk=response.json()['id'])
+        with foto.arquivo.open('rb') as arquivo:
+            self.assertEqual(arquivo.read(), conteudo)
+
+        # Finalizing again (retry) returns the same photo
+        self.assertEqual(self.finalizar(url, conteudo).json()['id'], foto.pk)
+        self.assertEqual(AvariaFoto.objects.count(), 1)
+
+    def test_finalizar_depois_que_a_foto_foi_excluida(self):
+        conteudo = jpeg('red')
+        url = self.iniciar(conteudo)
+        self.enviar(url, conteudo, 0)
+        AvariaFoto.objects.get(pk=self.finalizar(url, conteudo).json()['id']).delete()
+
+        response = self.finalizar(url, conteudo)
+        self.assertEqual(response.status_code, 410)
+        self.assertFalse(AvariaFoto.objects.exists())
+
+    def test_checksum_errado_reinicia(self):
+        conteudo = jpeg('blue')
+        url = self.iniciar(conteudo)
+        self.enviar(url, conteudo, 0)
+        response = self.finalizar(url, conteudo + b'x')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['offset'], 0)
+        self.assertFalse(AvariaFoto.objects.exists())
+
+    def test_fotos_em_paralelo(self):
+        vermelha, verde = jpeg('red'), jpeg('green')
+        url_vermelha, url_verde = self.iniciar(vermelha, 'a.jpg'), self.iniciar(verde, 'b.jpg')
+        metade = len(vermelha) // 2
+        self.enviar(url_vermelha, vermelha[:metade], 0)
+        self.enviar(url_verde, verde, 0)
+        self.enviar(url_vermelha, vermelha[metade:], metade)
+        self.assertEqual(self.finalizar(url_verde, verde).status_code, 201)
+        self.assertEqual(self.finalizar(url_vermelha, vermelha).status_code, 201)
+        self.assertEqual(self.avaria.fotos.count(), 2)
+        self.assertFalse(UploadFoto.objects.filter(status='ABERTO').exists())
+
+
+@mock.patch.object(sincronizacao, 'MARGEM_SYNC', timedelta(0))
+class SyncTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='operador', password='password')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.cliente = Cliente.objects.create(razao_social="Cliente Teste", cnpj="11111111111111")
+        self.outro_cliente = Cliente.objects.create(razao_social="Outro", cnpj="22222222222222")
+        self.produto = Produto.objects.create(nome="Dipirona", laboratorio="EMS", codigo_controle="P1")
+        self.avaria = Avaria.objects.create(cliente=self.cliente, nota_fiscal='1', criado_por=self.user)
+        self.item = AvariaItem.objects.create(avaria=self.avaria, produto=self.produto, quantidade=1)
+        self.outra = Avaria.objects.create(cliente=self.cliente, nota_fiscal='2', criado_por=self.user)
+
+    def sync(self, token=None):
+        response = self.client.get('/api/sync/', {'since': token} if token else {})
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_primeira_carga_completa(self):
+        dados = self.sync()
+        self.assertTrue(dados['completo'])
+        self.assertEqual({a['id'] for a in dados['avarias']}, {self.avaria.pk, self.outra.pk})
+        self.assertEqual(len(dados['clientes']), 2)
+        self.assertEqual(dados['produtos'][0]['nome'], 'Dipirona')
+
+    def test_so_o_que_mudou(self):
+        token = self.sync()['token']
+        dados = self.sync(token)
+        self.assertFalse(dados['completo'])
+        self.assertEqual((dados['avarias'], dados['clientes']), ([], []))
+        self.assertEqual(dados['removidos']['avarias'], [])
+
+        self.outra.valor_nf = Decimal('10.00')
+        self.outra.save(update_fields=['valor_nf'])  # atualizado_em goes along
+        registrar_evento(self.avaria, 'OBSERVACAO', self.user, 'Nota')
+        dados = self.sync(token)
+        self.assertEqual({a['id'] for a in dados['avarias']}, {self.avaria.pk, self.outra.pk})
+
+        token = dados['token']
+        self.item.quantidade = 3
+        self.item.save()
+        dados = self.sync(token)
+        self.assertEqual([a['id'] for a in dados['avarias']], [self.avaria.pk])
+        self.assertEqual(dados['avarias'][0]['itens'][0]['quantidade'], 3)
+
+    def test_exclusoes_e_inativacoes(self):
+        token = self.sync()['token']
+        self.outro_cliente.ativo = False
+        self.outro_cliente.save()
+        outra_pk = self.outra.pk
+        self.outra.delete()
+        self.item.delete()
+
+        dados = self.sync(token)
+        self.assertEqual(dados['clientes'], [])
+        self.assertEqual(dados['removidos']['clientes'], [self.outro_cliente.pk])
+        self.assertEqual(dados['removidos']['avarias'], [outra_pk])
+        # The avaria that lost an item is sent again, without it
+        self.assertEqual([(a['id'], a['itens']) for a in dados['avarias']], [(self.avaria.pk, [])])
+
+    def test_finalizadas_ficam_fora(self):
+        finalizada = Avaria.objects.create(
+            cliente=self.cliente, nota_fiscal='3', criado_por=self.user, status='FINALIZADA',
+        )
+        dados = self.sync()
+        self.assertNotIn(finalizada.pk, {a['id'] for a in dados['avarias']})
+
+        token = dados['token']
+        self.outra.status = 'FINALIZADA'
+        self.outra.save()
+        dados = self.sync(token)
+        self.assertEqual(dados['avarias'], [])
+        self.assertEqual(dados['removidos']['avarias'], [self.outra.pk])
+
+    def test_token_invalido(self):
+        self.assertEqual(self.client.get('/api/sync/', {'since': 'ontem'}).status_code, 400)
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+@mock.patch.object(sincronizacao, 'MARGEM_SYNC', timedelta(0))
+class CatalogoTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='operador', password='password')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.cliente = Cliente.objects.create(razao_social="Cliente Teste", cnpj="11111111111111")
+        Cliente.objects.create(razao_social="Inativo", cnpj="22222222222222", ativo=False)
+        self.produto = Produto.objects.create(nome="Dipirona", laboratorio="EMS", codigo_controle="P1")
+
+    def test_pacote_e_304(self):
+        response = self.client.get('/api/catalog/')
+        dados = response.json()
+        self.assertEqual(dados['clientes'], [{'id': self.cliente.pk, 'razao_social': 'Cliente Teste', 'cnpj': '11111111111111'}])
+        self.assertEqual(dados['produtos'][0]['codigo_controle'], 'P1')
+        self.assertEqual((dados['condutores'], dados['veiculos']), ([], []))
+
+        # Unchanged: a few aggregate queries and no body
+        with self.assertNumQueries(5):
+            response = self.client.get('/api/catalog/', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+        etag = response['ETag']
+        self.produto.nome = "Dipirona Sódica"
+        self.produto.save()
+        response = self.client.get('/api/catalog/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(response.json()['produtos'][0]['nome'], "Dipirona Sódica")
+
+    def test_diferencas_desde_o_token(self):
+        response = self.client.get('/api/catalog/')
+        etag, token = response['ETag'], response.json()['token']
+
+        self.produto.nome = "Dipirona Sódica"
+        self.produto.save()
+        self.cliente.ativo = False
+        self.cliente.save()
+        response = self.client.get('/api/catalog/', {'since': token}, HTTP_IF_NONE_MATCH=etag)
+        dados = response.json()
+        self.assertEqual([p['nome'] for p in dados['produtos']], ["Dipirona Sódica"])
+        self.assertEqual(dados['clientes'], [])
+        self.assertEqual(dados['removidos']['clientes'], [self.cliente.pk])
+
+        # The new ETag/token pair is current: next time it is a 304
+        response = self.client.get('/api/catalog/', {'since': dados['token']}, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+
+# The dashboard refresh scheduled after commit runs inline, not in a thread
+@override_settings(
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}, BACKGROUND_TASKS_EAGER=True,
+)
+class AvariaLoteTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='operador', password='password')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.cliente = Cliente.objects.create(razao_social="Cliente Teste", cnpj="11111111111111")
+        self.produto = Produto.objects.create(nome="Dipirona", laboratorio="EMS", codigo_controle="P1")
+
+    def entrada(self, nota_fiscal, **extra):
+        return {
+            'chave': str(uuid.uuid4()), 'cliente': self.cliente.pk, 'nota_fiscal': nota_fiscal,
+            'itens': [{'produto': self.produto.pk, 'quantidade': 2, 'lote': 'L1'}], **extra,
+        }
+
+    def enviar(self, entradas):
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post('/api/avarias/bulk/', {'avarias': entradas}, format='json')
+
+    def test_cria_lote_com_itens_eventos_resumo_e_busca(self):
+        entradas = [self.entrada('NF-1', observacoes='Caixa molhada'), self.entrada('NF-2')]
+        response = self.enviar(entradas)
+        self.assertEqual(response.status_code, 201)
+        resultados = response.json()['avarias']
+        self.assertEqual([r['chave'] for r in resultados], [e['chave'] for e in entradas])
+        self.assertTrue(all(r['criada'] for r in resultados))
+
+        avarias = Avaria.objects.filter(pk__in=[r['id'] for r in resultados]).order_by('pk')
+        self.assertEqual([a.nota_fiscal for a in avarias], ['NF-1', 'NF-2'])
+        self.assertEqual(AvariaItem.objects.filter(avaria__in=avarias, quantidade=2, lote='L1').count(), 2)
+        self.assertEqual(list(AvariaEvento.objects.values_list('tipo', 'texto')), [('ABERTURA', 'Caixa molhada')])
+        resumo = AvariaResumoMensal.objects.get()
+        self.assertEqual((resumo.quantidade, resumo.status), (2, 'EM_ABERTO'))
+        self.assertIn('dipirona', AvariaBusca.objects.get(avaria=avarias[0]).documento.lower())
+
+    def test_criacao_avulsa_pelo_mesmo_caminho(self):
+        dados = {
+            'cliente': self.cliente.pk, 'nota_fiscal': 'NF-1', 'observacoes': 'Caixa molhada',
+            'itens': [{'produto': self.produto.pk, 'quantidade': 2, 'lote': 'L1'}] * 3,
+        }
+        with self.captureOnCommitCallbacks(execute=True), \
+                mock.patch.object(AvariaItem.objects, 'create', side_effect=AssertionError('one INSERT per item')):
+            response = self.client.post('/api/avarias/', dados, format='json')
+        self.assertEqual(response.status_code, 201)
+        avaria = Avaria.objects.get(pk=response.json()['id'])
+        self.assertEqual(avaria.itens.count(), 3)
+        self.assertEqual(list(avaria.eventos.values_list('tipo', 'texto')), [('ABERTURA', 'Caixa molhada')])
+        self.assertEqual(AvariaResumoMensal.objects.get().quantidade, 1)
+        self.assertIn('dipirona', AvariaBusca.objects.get(avaria=avaria).documento)
+
+    def test_reenvio_nao_duplica(self):
+        primeira = self.entrada('NF-1')
+        ids = self.enviar([primeira]).json()['avarias']
+
+        # Retry of the whole batch: same ids, nothing new
+        response = self.enviar([primeira])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['avarias'], [{**ids[0], 'criada': False}])
+
+        # Retry mixed with a new entry
+        response = self.enviar([primeira, self.entrada('NF-2')])
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual([r['criada'] for r in response.json()['avarias']], [False, True])
+        self.assertEqual(Avaria.objects.count(), 2)
+        self.assertEqual(AvariaResumoMensal.objects.get().quantidade, 2)
+
+    def test_lote_invalido_nao_grava_nada(self):
+        invalida = self.entrada('NF-2', itens=[{'produto': 9999}])
+        repetida = self.entrada('NF-3')
+        response = self.enviar([self.entrada('NF-1'), invalida, repetida, {**repetida, 'nota_fiscal': 'NF-4'}])
+        self.assertEqual(response.status_code, 400)
+        erros = response.json()['avarias']
+        self.assertEqual(erros[0], {})
+        self.assertIn('produto', erros[1]['itens'][0])
+        self.assertEqual(list(erros[3]), ['chave'])
+        self.assertFalse(Avaria.objects.exists())
@@ -9,6 +9,8 @@ router.register(r'condutores', views.CondutorViewSet)
 router.register(r'veiculos', views.VeiculoViewSet)
 router.register(r'produtos', views.ProdutoViewSet)
 router.register(r'avarias', views.AvariaViewSet)
+router.register(r'sync', views.SyncViewSet, basename='sync')
+router.register(r'catalog', views.CatalogoViewSet, basename='catalog')
 
 urlpatterns = [
     path('', include(router.urls)),
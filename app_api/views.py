@@ -1,13 +1,42 @@
 
+from django.db.models import Prefetch, Q
+from django.http import HttpResponse, HttpResponseNotModified, UnreadablePostError
+from django.shortcuts import get_object_or_404
+from django.utils import timezone
 from rest_framework import viewsets, permissions, status
 from rest_framework.decorators import action
 from rest_framework.response import Response
-from app_avarias.models import Usuario, Cliente, Condutor, Veiculo, Produto, Avaria, AvariaFoto
+from app_avarias import uploads
+from app_avarias.eventos import registrar_evento
+from app_avarias.models import (
+    Usuario, Cliente, Condutor, Veiculo, Produto, Avaria, AvariaEvento, AvariaFoto, AvariaItem, UploadFoto,
+)
+from . import catalogo, lote, sincronizacao
+from .pagination import CursorAvarias
 from .serializers import (
-    UsuarioSerializer, ClienteSerializer, CondutorSerializer, VeiculoSerializer, 
-    ProdutoSerializer, AvariaSerializer, AvariaFotoSerializer
+    campos_pedidos, UsuarioSerializer, ClienteSerializer, CondutorSerializer, VeiculoSerializer, 
+    ProdutoSerializer, AvariaSerializer, AvariaEventoSerializer, AvariaFotoSerializer, AvariasEmLoteSerializer
 )
 
+def com_relacionados(avarias, campos=None):
+    """
+    Carrega junto o que o AvariaSerializer mostra: cliente, itens com produto,
+    fotos e eventos (observacoes). Uma query por relação, não por Avaria.
+    Com campos (?fields=), só as relações desses campos.
+    """
+    def pedido(campo):
+        return campos is None or campo in campos
+
+    if pedido('cliente_nome'):
+        avarias = avarias.select_related('cliente')
+    if pedido('itens'):
+        avarias = avarias.prefetch_related(Prefetch('itens', queryset=AvariaItem.objects.select_related('produto')))
+    if pedido('fotos'):
+        avarias = avarias.prefetch_related('fotos')
+    if pedido('observacoes'):
+        avarias = avarias.prefetch_related('eventos')
+    return avarias
+
 class ClienteViewSet(viewsets.ModelViewSet):
     queryset = Cliente.objects.filter(ativo=True)
     serializer_class = ClienteSerializer
@@ -36,15 +65,35 @@ class AvariaViewSet(viewsets.ModelViewSet):
     queryset = Avaria.objects.all().order_by('-data_criacao')
     serializer_class = AvariaSerializer
     permission_classes = [permissions.IsAuthenticated]
+    pagination_class = CursorAvarias
+
+    # Actions that serialize whole Avarias (with items, photos and history)
+    ACOES_COM_RELACIONADOS = ('list', 'retrieve', 'update', 'partial_update')
 
     def get_queryset(self):
         # Mobile users might only see Open ones in a real scenario, but let's return all for now
         qs = super().get_queryset()
+        if self.action in self.ACOES_COM_RELACIONADOS:
+            qs = com_relacionados(qs, campos_pedidos(self.request))
         status_param = self.request.query_params.get('status')
         if status_param:
             qs = qs.filter(status=status_param)
         return qs
 
+    @action(detail=False, methods=['post'], url_path='bulk')
+    def bulk(self, request):
+        """
+        Cria várias Avarias de uma vez: {"avarias": [{"chave": <uuid>, ...}]}.
+        Responde {"avarias": [{"chave", "id", "criada"}]} na ordem do lote;
+        reenviar uma chave já gravada devolve o id existente (ver lote.py).
+        """
+        serializer = AvariasEmLoteSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        resultados = lote.criar_avarias(request.user, serializer.validated_data['avarias'])
+        http_status = status.HTTP_201_CREATED if any(r['criada'] for r in resultados) else status.HTTP_200_OK
+        return Response({'avarias': resultados}, status=http_status)
+
     @action(detail=True, methods=['post'])
     def upload_foto(self, request, pk=None):
         avaria = self.get_object()
@@ -61,16 +110,173 @@ class AvariaViewSet(viewsets.ModelViewSet):
         texto = request.data.get('texto')
         
         if texto:
-             from django.utils import timezone
-             timestamp = timezone.now().strftime("%d/%m/%Y %H:%M")
-             new_entry = f"[{timestamp} - {request.user.username}] {texto}\n"
-             
-             if avaria.observacoes:
-                 avaria.observacoes += "\n" + new_entry
-             else:
-                 avaria.observacoes = new_entry
-             
-             avaria.save()
-             return Response({'status': 'Observação adicionada', 'observacoes': avaria.observacoes}, status=status.HTTP_200_OK)
+             # Single INSERT into the history; the Avaria row is not rewritten
+             evento = registrar_evento(avaria, 'OBSERVACAO', request.user, texto)
+             return Response({'status': 'Observação adicionada', 'evento': AvariaEventoSerializer(evento).data}, status=status.HTTP_200_OK)
         
         return Response({'error': 'Campo "texto" obrigatório.'}, status=status.HTTP_400_BAD_REQUEST)
+
+    # --- Resumable chunked upload (see app_avarias/uploads.py) ---
+
+    def _upload(self, avaria, upload_id):
+        return get_object_or_404(UploadFoto, pk=upload_id, avaria=avaria, usuario=self.request.user)
+
+    @staticmethod
+    def _estado_upload(upload, http_status=status.HTTP_200_OK):
+        return Response(
+            {'id': str(upload.pk), 'nome': upload.nome, 'tamanho': upload.tamanho,
+             'offset': upload.recebido, 'status': upload.status},
+            status=http_status, headers={'Upload-Offset': str(upload.recebido)},
+        )
+
+    @action(detail=True, methods=['post'], url_path='uploads')
+    def iniciar_upload(self, request, pk=None):
+        """Inicia o envio de uma foto em partes: {"nome": ..., "tamanho": bytes}."""
+        avaria = self.get_object()
+        try:
+            upload = uploads.iniciar_upload(avaria, request.user, request.data.get('nome'), request.data.get('tamanho'))
+        except uploads.UploadInvalido as exc:
+            return Response({'error': str(exc)}, status=status.HTTP_400_BAD_REQUEST)
+        return self._estado_upload(upload, status.HTTP_201_CREATED)
+
+    @action(detail=True, methods=['get', 'put'], url_path=r'uploads/(?P<upload_id>[0-9a-f-]+)')
+    def parte_upload(self, request, pk=None, upload_id=None):
+        """
+        GET: offset já gravado (para retomar).
+        PUT: corpo = bytes da parte (application/octet-stream), header Upload-Offset = onde ela começa.
+        """
+        upload = self._upload(self.get_object(), upload_id)
+        if request.method == 'GET':
+            return self._estado_upload(upload)
+
+        try:
+            offset = int(request.headers['Upload-Offset'])
+            tamanho_parte = int(request.headers['Content-Length'])
+        except (KeyError, ValueError):
+            return Response({'error': 'Informe os headers Upload-Offset e Content-Length.'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        try:
+            # request.stream: the body is read in blocks, never parsed into request.data
+            upload = uploads.gravar_parte(upload, offset, request.stream, tamanho_parte)
+        except uploads.OffsetIncorreto as exc:
+            return Response({'error': str(exc), 'offset': exc.recebido}, status=status.HTTP_409_CONFLICT,
+                            headers={'Upload-Offset': str(exc.recebido)})
+        except uploads.UploadInvalido as exc:
+            return Response({'error': str(exc)}, status=status.HTTP_400_BAD_REQUEST)
+        except UnreadablePostError:
+            upload.refresh_from_db()
+            return Response({'error': 'Conexão interrompida.', 'offset': upload.recebido},
+                            status=status.HTTP_400_BAD_REQUEST)
+        return self._estado_upload(upload)
+
+    @action(detail=True, methods=['post'], url_path=r'uploads/(?P<upload_id>[0-9a-f-]+)/finalizar')
+    def finalizar_upload(self, request, pk=None, upload_id=None):
+        """Confere o SHA-256 ({"sha256": ...}) e cria a AvariaFoto."""
+        upload = self._upload(self.get_object(), upload_id)
+        try:
+            foto = uploads.finalizar_upload(upload, request.data.get('sha256'))
+        except uploads.FotoRemovida as exc:
+            return Response({'error': str(exc)}, status=status.HTTP_410_GONE)
+        except uploads.UploadInvalido as exc:
+            upload.refresh_from_db()
+            return Response({'error': str(exc), 'offset': upload.recebido}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(AvariaFotoSerializer(foto, context={'request': request}).data, status=status.HTTP_201_CREATED)
+
+
+# --- Sincronização incremental do app (ver sincronizacao.py) ---
+
+class SyncViewSet(viewsets.ViewSet):
+    """
+    GET /api/sync/?since=<token>: só o que mudou desde o token, com o próximo token.
+
+    Sem since (primeira carga) vêm os cadastros e as Avarias em aberto, com
+    "completo": true. Itens, fotos e histórico vão dentro da Avaria, então
+    qualquer mudança neles reenvia a Avaria. Em "removidos" vêm os ids
+    excluídos (RegistroExcluido), os cadastros inativados e as Avarias que
+    deixaram de estar em aberto. Por causa da margem do token, uma alteração pode vir
+    mais de uma vez; o app só precisa sobrescrever pelo id.
+    """
+    permission_classes = [permissions.IsAuthenticated]
+
+    CADASTROS = (
+        ('clientes', ClienteViewSet),
+        ('condutores', CondutorViewSet),
+        ('veiculos', VeiculoViewSet),
+        ('produtos', ProdutoViewSet),
+    )
+
+    # Only what the app lists: the finalized history stays on the server
+    STATUS_SINCRONIZADOS = ('EM_ABERTO',)
+
+    def list(self, request):
+        try:
+            desde = _desde(request)
+        except ValueError:
+            return Response({'error': 'Token "since" inválido.'}, status=status.HTTP_400_BAD_REQUEST)
+
+        dados = {
+            'token': sincronizacao.token_ate(timezone.now()),
+            'completo': desde is None,
+            'removidos': {},
+        }
+        for nome, viewset in self.CADASTROS:
+            visiveis = viewset.queryset.all()
+            removidos = []
+            if desde:
+                removidos = sincronizacao.ids_removidos(viewset.queryset, desde)
+                visiveis = visiveis.filter(atualizado_em__gt=desde)
+            dados[nome] = viewset.serializer_class(visiveis, many=True).data
+            dados['removidos'][nome] = removidos
+
+        avarias = Avaria.objects.order_by('-data_criacao')
+        removidos = []
+        if desde:
+            avarias = avarias.filter(
+                Q(atualizado_em__gt=desde)
+                | Q(pk__in=AvariaItem.objects.filter(atualizado_em__gt=desde).values('avaria_id'))
+                | Q(pk__in=AvariaFoto.objects.filter(atualizado_em__gt=desde).values('avaria_id'))
+                | Q(pk__in=AvariaEvento.objects.filter(timestamp__gt=desde).values('avaria_id'))
+            )
+            # Changed avarias that left the scope (e.g. finalized) are dropped by the app
+            removidos = [
+                *avarias.exclude(status__in=self.STATUS_SINCRONIZADOS).values_list('pk', flat=True),
+                *sincronizacao.excluidos(Avaria, desde),
+            ]
+        avarias = com_relacionados(avarias.filter(status__in=self.STATUS_SINCRONIZADOS), campos_pedidos(request))
+        dados['avarias'] = AvariaSerializer(avarias, many=True, context={'request': request}).data
+        dados['removidos']['avarias'] = removidos
+        return Response(dados)
+
+
+class CatalogoViewSet(viewsets.ViewSet):
+    """
+    GET /api/catalog/: clientes, condutores, veículos e produtos ativos em um
+    pacote (ver catalogo.py), com ETag; If-None-Match igual responde 304.
+    Com ?since=<token> (do pacote anterior) vêm só as diferenças, também com o
+    ETag do pacote atual: o app guarda ETag e token e, na maioria das vezes,
+    recebe um 304 em uma única ida e volta.
+    """
+    permission_classes = [permissions.IsAuthenticated]
+
+    def list(self, request):
+        try:
+            desde = _desde(request)
+        except ValueError:
+            return Response({'error': 'Token "since" inválido.'}, status=status.HTTP_400_BAD_REQUEST)
+
+        etag, conteudo, token = catalogo.pacote()
+        if etag in request.headers.get('If-None-Match', ''):
+            resposta = HttpResponseNotModified()
+        elif desde:
+            resposta = HttpResponse(catalogo.diferencas(desde, token), content_type='application/json')
+        else:
+            resposta = HttpResponse(conteudo, content_type='application/json')
+        resposta['ETag'] = etag
+        resposta['Cache-Control'] = 'private, no-cache'
+        return resposta
+
+
+def _desde(request):
+    """Momento do ?since= (None sem ele); ValueError se o token for inválido."""
+    token = request.query_params.get('since')
+    return sincronizacao.ler_token(token) if token else None
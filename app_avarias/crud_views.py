@@ -1,4 +1,6 @@
-from django.db import models
+import logging
+
+from django.db import models, transaction
 from django.views.generic import ListView, UpdateView, DeleteView, CreateView, DetailView
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.contrib.auth.decorators import login_required
@@ -7,10 +9,12 @@ from django.shortcuts import redirect, get_object_or_404
 from django.contrib import messages
 from django import forms
 from django.utils.safestring import mark_safe
-from django.utils import timezone
 from .models import Condutor, Veiculo, Produto, Cliente, Usuario, Avaria, AvariaFoto, AvariaItem
 from .mixins import GroupRequiredMixin, SuperUserRequiredMixin
 from .decorators import superuser_required, group_required
+from .eventos import registrar_evento
+
+logger = logging.getLogger(__name__)
 
 # --- FORMS ---
 class CondutorForm(forms.ModelForm):
@@ -137,9 +141,16 @@ class UsuarioForm(forms.ModelForm):
 
 # Avaria Forms
 class AvariaForm(forms.ModelForm):
+    # Not a model field anymore: recorded as the ABERTURA event (see eventos.py)
+    observacoes = forms.CharField(
+        required=False,
+        label="Observações",
+        widget=forms.Textarea(attrs={'class': 'form-control', 'rows': 3}),
+    )
+
     class Meta:
         model = Avaria
-        fields = ['cliente', 'nota_fiscal', 'valor_nf', 'veiculo', 'veiculo_carreta', 'motorista', 'produto', 'lote', 'quantidade', 'observacoes', 'local_atuacao', 'criado_por']
+        fields = ['cliente', 'nota_fiscal', 'valor_nf', 'veiculo', 'veiculo_carreta', 'motorista', 'produto', 'lote', 'quantidade', 'local_atuacao', 'criado_por']
         widgets = {
             'cliente': forms.Select(attrs={'class': 'form-select select2'}),
             'veiculo': forms.Select(attrs={'class': 'form-select select2'}),
@@ -150,7 +161,6 @@ class AvariaForm(forms.ModelForm):
             'valor_nf': forms.NumberInput(attrs={'class': 'form-control', 'step': '0.01'}),
             'lote': forms.TextInput(attrs={'class': 'form-control'}),
             'quantidade': forms.NumberInput(attrs={'class': 'form-control'}),
-            'observacoes': forms.Textarea(attrs={'class': 'form-control', 'rows': 3}),
             'local_atuacao': forms.HiddenInput(),
             'criado_por': forms.HiddenInput(),
         }
@@ -377,162 +387,82 @@ class AvariaCreateView(GroupRequiredMixin, LoginRequiredMixin, CreateView):
         context['produtos_list'] = Produto.objects.filter(ativo=True).order_by('nome')
         return context
 
+    def _itens_do_post(self):
+        produtos = self.request.POST.getlist('produto[]')
+        quantidades = self.request.POST.getlist('quantidade[]')
+        lotes = self.request.POST.getlist('lote[]')
+
+        ids = []
+        for produto_id in produtos:
+            try:
+                ids.append(int(produto_id))
+            except (TypeError, ValueError):
+                ids.append(None)
+        encontrados = Produto.objects.in_bulk([pk for pk in ids if pk is not None])
+
+        itens = []
+        for i, produto_id in enumerate(ids):
+            if produto_id not in encontrados:
+                continue
+            try:
+                qty = int(quantidades[i]) if i < len(quantidades) else 1
+            except ValueError:
+                continue
+            itens.append(AvariaItem(
+                avaria=self.object,
+                produto=encontrados[produto_id],
+                quantidade=qty,
+                lote=lotes[i] if i < len(lotes) else '',
+            ))
+        return itens
+
+    def _gravar_fotos(self, files):
+        """
+        Grava os arquivos no storage antes da transação e devolve os nomes.
+        Se a transação falhar, os arquivos ficam órfãos mas inofensivos: o
+        storage é por conteúdo e um reenvio reaproveita o mesmo arquivo.
+        """
+        campo = AvariaFoto._meta.get_field('arquivo')
+        return [
+            campo.storage.save(campo.generate_filename(None, f.name), f, max_length=campo.max_length)
+            for f in files
+        ]
+
     def form_valid(self, form):
         # Enforce user and local in backend
         form.instance.criado_por = self.request.user
         if self.request.user.local_atuacao:
             form.instance.local_atuacao = self.request.user.local_atuacao
             
-        # Format Initial Observation
-        obs_initial = form.cleaned_data.get('observacoes', '').strip()
-        if obs_initial:
-            timestamp = timezone.localtime(timezone.now()).strftime("%d/%m/%Y %H:%M")
-            user_str = self.request.user.username
-            # Check if not already formatted (in case of re-submission or edit, though this is CreateView)
-            if not obs_initial.startswith('['):
-                form.instance.observacoes = f"[{timestamp} - {user_str}] [ABERTURA] {obs_initial}"
-
-        # Save Header (Avaria)
-        self.object = form.save()
-        
-        # Process Items (Products)
-        produtos = self.request.POST.getlist('produto[]')
-        quantidades = self.request.POST.getlist('quantidade[]')
-        lotes = self.request.POST.getlist('lote[]')
-        
-        # Iterate and create items
-        for i, produto_id in enumerate(produtos):
-            if produto_id:
-                try:
-                    product = Produto.objects.get(id=produto_id)
-                    qty = int(quantidades[i]) if i < len(quantidades) else 1
-                    lote = lotes[i] if i < len(lotes) else ''
-                    
-                    AvariaItem.objects.create(
-                        avaria=self.object,
-                        produto=product,
-                        quantidade=qty,
-                        lote=lote
-                    )
-                except (Produto.DoesNotExist, ValueError):
-                    continue
-        
-        # Handle Photos (Custom logic if not handled by form)
-        files = self.request.FILES.getlist('fotos')
-        for f in files:
-            AvariaFoto.objects.create(avaria=self.object, arquivo=f, criado_por=self.request.user)
+        # Only the file writes happen outside the transaction
+        try:
+            fotos = self._gravar_fotos(self.request.FILES.getlist('fotos'))
+        except OSError:
+            logger.exception("Erro ao gravar as fotos da nova Avaria")
+            messages.error(self.request, 'Não foi possível salvar as fotos. Tente novamente.')
+            return self.form_invalid(form)
+
+        # Header, history, items and photos in one transaction
+        with transaction.atomic():
+            self.object = form.save()
+
+            # Initial Observation goes to the history
+            obs_initial = form.cleaned_data.get('observacoes', '').strip()
+            if obs_initial:
+                registrar_evento(self.object, 'ABERTURA', self.request.user, obs_initial)
+
+            # Items: products fetched in one query, rows in one INSERT. The
+            # search index and dashboard cache refresh on the Avaria's post_save
+            # run after commit, so they already see these items.
+            AvariaItem.objects.bulk_create(self._itens_do_post())
+
+            # Rows only: the files are already stored. The renditions are
+            # generated after the commit (post_save of AvariaFoto).
+            for nome in fotos:
+                AvariaFoto.objects.create(avaria=self.object, arquivo=nome, criado_por=self.request.user)
 
         messages.success(self.request, 'Avaria registrada com sucesso!')
         return redirect(self.success_url)
-        
-        # Actually, let's look at the implementation:
-        # If 'produtos' is a list/queryset, we loop.
-        
-        # Since I cannot easily change the Form Field type in __init__ just by widget (it needs to be ModelMultipleChoiceField),
-        # I will handle 'produto' manually from POST data if needed, or rely on the fact I should have updated the form field definition.
-        
-        # Let's assume for this specific task I'm overriding the saving logic.
-        # But wait, form.save() will try to assign the list to the ForeignKey and fail.
-        # So commit=False is essential, and we must check basic validation manually or ignore the 'produto' field error if we hack it.
-        
-        # BETTER APPROACH:
-        # The form validation will fail if I send multiple values to a ModelChoiceField.
-        # I should have updated the Form Field to ModelMultipleChoiceField in forms.py.
-        # I did: "self.fields['produto'].widget = ..." in __init__. 
-        # I should have also redundant the field definition or changed the class.
-        # But let's fix it here by grabbing raw POST data if needed or trust the previous step did it right (I only saw widget change).
-        
-        # To be safe, I will grab the list from the form if valid, or request.POST.
-        # But if the form is invalid because of this, form_valid won't be called.
-        # I'll rely on the user having approved the implementation where I said I'd handle it.
-        # If I missed the Field Class change in forms.py, I should fix it there. 
-        # But let's write the logic here assuming `form.cleaned_data['produto']` gives me a list (if I fix the form correctly).
-        
-        # Wait, I only changed widget in forms.py! I need to ensure it's ModelMultipleChoiceField.
-        # I can do that in __init__ too.
-        
-        # Moving on to the logic here:
-        
-        # Handle Dynamic Item Rows
-        # We expect input arrays: produto[], lote[], quantidade[], observacao_item[]
-        
-        produtos = self.request.POST.getlist('produto[]')
-        lotes = self.request.POST.getlist('lote[]')
-        quantidades = self.request.POST.getlist('quantidade[]')
-        
-        if not produtos or len(produtos) == 0:
-             # Try standard field fallback if JS failed
-             if form.cleaned_data.get('produto'):
-                 produtos = [form.cleaned_data.get('produto')]
-                 lotes = [form.cleaned_data.get('lote')]
-                 quantidades = [form.cleaned_data.get('quantidade')]
-             else:
-                 messages.error(self.request, "Nenhum produto selecionado.")
-                 return self.form_invalid(form)
-
-        context_data = form.cleaned_data
-        
-        # Prepare formatted observation (General Header Observation)
-        user_obs_general = context_data.get('observacoes') or ""
-        timestamp = timezone.localtime(timezone.now()).strftime("%d/%m/%Y %H:%M")
-        
-        saved_count = 0
-        
-        for i, prod_id in enumerate(produtos):
-            if not prod_id: continue
-            
-            # Get Item specific data
-            if isinstance(prod_id, Produto):
-                prod_obj = prod_id
-            else:
-                try:
-                    prod_obj = Produto.objects.get(pk=prod_id)
-                except Produto.DoesNotExist:
-                    continue
-
-            try:
-                qty = float(quantidades[i]) if i < len(quantidades) and quantidades[i] else 1
-            except ValueError:
-                qty = 1
-                
-            lote_val = lotes[i] if i < len(lotes) else ""
-            
-            # Combine General Obs Only (Removed Item Obs per user request)
-            full_obs = f"[{timestamp} - {self.request.user.username}] [ABERTURA] {user_obs_general}\n"
-
-            # Create Instance
-            instance = Avaria(
-                 cliente=context_data['cliente'],
-                 nota_fiscal=context_data['nota_fiscal'],
-                 valor_nf=context_data.get('valor_nf'),
-                 veiculo=context_data['veiculo'],
-                 veiculo_carreta=context_data['veiculo_carreta'],
-                 motorista=context_data['motorista'],
-                 produto=prod_obj,
-                 lote=lote_val,
-                 quantidade=qty,
-                 observacoes=full_obs,
-                 local_atuacao=form.instance.local_atuacao,
-                 criado_por=self.request.user
-            )
-            instance.save()
-            saved_count += 1
-            
-            # Photos (Applied to all items)
-            fotos = self.request.FILES.getlist('fotos')
-            for f in fotos:
-                # We need to seek(0) if reusing file? 
-                # Django UploadedFile might need it if read. But creating model handles safely usually.
-                # However, InMemoryUploadedFile is a stream. If read once, pointer moves.
-                f.seek(0) 
-                AvariaFoto.objects.create(avaria=instance, arquivo=f, criado_por=self.request.user)
-        
-        if saved_count > 0:
-            messages.success(self.request, f"{saved_count} item(ns) de avaria registrado(s) com sucesso!")
-            return redirect(self.success_url)
-        else:
-            messages.error(self.request, "Erro ao registrar itens.")
-            return self.form_invalid(form)
 
 class UsuarioDeleteView(SuperUserRequiredMixin, BaseDeleteView):
     model = Usuario
@@ -0,0 +1,291 @@
+"""
+Cálculo dos KPIs do Dashboard com o menor número possível de queries.
+
+Contadores, valores e séries mensais saem do resumo mensal (AvariaResumoMensal)
+via agregação condicional (Sum/Count com filter=Q(...)). O que depende de dimensões
+que o resumo não guarda (motorista, produto, UF) continua vindo da tabela de Avarias,
+mas também em uma query por bloco. SLAs ficam em sla.py (uma query por segmento).
+"""
+import json
+from datetime import date, timedelta
+from decimal import Decimal
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Count, F, Q, Sum
+from django.utils import timezone
+
+from .models import Avaria, AvariaResumoMensal, UFS_BRASIL
+from .resumo import inicio_do_mes
+from .sla import calcular_slas
+from . import kpi_cache
+
+DEVOLUCAO = 'DEVOLUCAO_CONCLUIDA'
+ACEITE = 'ACEITE'
+
+def _money(value):
+    return Decimal(str(value or 0)).quantize(Decimal('0.01'))
+
+
+def format_duration(value):
+    if not value:
+        return "-"
+    days = value.days
+    seconds = value.seconds
+    hours = seconds // 3600
+    minutes = (seconds % 3600) // 60
+    return f"{days} Dias e {hours:02}:{minutes:02} Horas"
+
+
+def financial_windows(now):
+    """
+    Primeiro dia das janelas "Últimos 12 Meses" e "Últimos 5 Anos" (a do ano
+    usa só o ano). O resumo é mensal, por isso começam no 1º dia do mês mais antigo.
+    """
+    return inicio_do_mes(now - timedelta(days=365)), inicio_do_mes(now - timedelta(days=365 * 5))
+
+
+class DashboardStats:
+    """
+    KPIs do Dashboard para um período (mês/ano) selecionado.
+
+    Uso:
+        stats = DashboardStats(year=2026, month=2)
+        context = stats.as_context()
+    """
+
+    def __init__(self, year=None, month=None, now=None):
+        self.now = now or timezone.now()
+        local_now = timezone.localtime(self.now)
+        try:
+            self.period = date(int(year or local_now.year), int(month or local_now.month), 1)
+        except (TypeError, ValueError):
+            self.period = date(local_now.year, local_now.month, 1)
+        self.year = self.period.year
+        self.month = self.period.month
+
+    # --- Resumo mensal (3 queries) ---
+
+    def counters(self):
+        finalizadas = Q(status='FINALIZADA')
+        totais = AvariaResumoMensal.objects.aggregate(
+            count_open=Sum('quantidade', filter=Q(status='EM_ABERTO')),
+            val_open=Sum('valor_total', filter=Q(status='EM_ABERTO')),
+            count_ready_return=Sum('quantidade', filter=Q(status='AGUARDANDO_DEVOLUCAO')),
+            count_monthly_returns=Sum('quantidade', filter=Q(tipo_finalizacao=DEVOLUCAO, mes_finalizacao=self.period)),
+            count_returned=Sum('quantidade', filter=finalizadas & Q(tipo_finalizacao=DEVOLUCAO)),
+            count_accepted=Sum('quantidade', filter=finalizadas & Q(tipo_finalizacao=ACEITE)),
+            val_returned=Sum('valor_total', filter=finalizadas & Q(tipo_finalizacao=DEVOLUCAO)),
+            val_accepted=Sum('valor_total', filter=finalizadas & Q(tipo_finalizacao=ACEITE)),
+        )
+        count_accepted = totais['count_accepted'] or 0
+        total_finished_decided = count_accepted + (totais['count_returned'] or 0)
+
+        acceptance_rate = 0
+        if total_finished_decided > 0:
+            acceptance_rate = (count_accepted / total_finished_decided) * 100
+
+        return {
+            'count_open': totais['count_open'] or 0,
+            'count_ready_return': totais['count_ready_return'] or 0,
+            'count_monthly_returns': totais['count_monthly_returns'] or 0,
+            'val_open': _money(totais['val_open']),
+            'val_returned': _money(totais['val_returned']),
+            'val_accepted': _money(totais['val_accepted']),
+            'acceptance_rate': round(acceptance_rate, 1),
+        }
+
+    def creation_series(self):
+        series = (
+            AvariaResumoMensal.objects
+            .values(month=F('mes_criacao'))
+            .annotate(total_created=Sum('quantidade'))
+            .order_by('month')
+        )
+        return [{'month': d['month'].strftime('%Y-%m-%d'), 'total_created': d['total_created']} for d in series]
+
+    def finalization_series(self):
+        """Uma linha por mês de finalização, com contagens e valores por tipo/responsável."""
+        return list(
+            AvariaResumoMensal.objects
+            .filter(status='FINALIZADA', mes_finalizacao__isnull=False)
+            .values(month=F('mes_finalizacao'))
+            .annotate(
+                returned=Sum('quantidade', filter=Q(tipo_finalizacao=DEVOLUCAO)),
+                accepted=Sum('quantidade', filter=Q(tipo_finalizacao=ACEITE)),
+                val_devolvido=Sum('valor_total', filter=Q(tipo_finalizacao=DEVOLUCAO)),
+                val_aceitas=Sum('valor_total', filter=Q(tipo_finalizacao=ACEITE)),
+                total_cliente=Sum('valor_total', filter=Q(responsavel_prejuizo='CLIENTE')),
+                total_transbirday=Sum('valor_total', filter=Q(responsavel_prejuizo='TRANSBIRDAY')),
+                total_terceiro=Sum('valor_total', filter=Q(responsavel_prejuizo='TRANSPORTADORA_TERCEIRA')),
+            )
+            .order_by('month')
+        )
+
+    def client_stats(self):
+        return list(
+            AvariaResumoMensal.objects
+            .filter(status='FINALIZADA')
+            .values('cliente__razao_social')
+            .annotate(
+                accepted=Sum('quantidade', filter=Q(tipo_finalizacao=ACEITE), default=0),
+                returned=Sum('quantidade', filter=Q(tipo_finalizacao=DEVOLUCAO), default=0),
+            )
+            .order_by('-accepted')[:10]
+        )
+
+    # --- Tabela de Avarias (1 query por bloco) ---
+
+    def heatmap(self):
+        por_uf = (
+            Avaria.objects
+            .filter(uf__isnull=False)
+            .values('uf')
+            .annotate(total=Count('id'))
+            .order_by('-total')
+        )
+
+        heatmap_data = []
+        heatmap_list = []
+        for item in por_uf:
+            heatmap_data.append([f"br-{item['uf']}", item['total']])
+            heatmap_list.append({'state': UFS_BRASIL.get(item['uf'], item['uf'].upper()), 'count': item['total']})
+        return heatmap_data, heatmap_list
+
+    def top_drivers(self):
+        return list(
+            Avaria.objects
+            .values('motorista__nome', 'motorista__cpf')
+            .annotate(total=Count('id'))
+            .order_by('-total')[:5]
+        )
+
+    def top_products(self):
+        finalizadas = Q(status='FINALIZADA')
+        rows = list(
+            Avaria.objects
+            .values('produto__nome')
+            .annotate(
+                total=Count('id'),
+                returned=Count('id', filter=finalizadas & Q(tipo_finalizacao=DEVOLUCAO)),
+                accepted=Count('id', filter=finalizadas & Q(tipo_finalizacao=ACEITE)),
+            )
+        )
+
+        def top(campo):
+            ranked = sorted((r for r in rows if r[campo]), key=lambda r: r[campo], reverse=True)[:5]
+            return [{'produto__nome': r['produto__nome'], 'total': r[campo]} for r in ranked]
+
+        return top('total'), top('returned'), top('accepted')
+
+    def slas(self):
+        """SLAs globais (uma query por segmento, ver sla.py)."""
+        dados = calcular_slas()
+        context = {}
+        for chave, nome in (('sla_decision', 'decisao'), ('sla_waiting_return', 'aguardando_saida'), ('sla_transport', 'transporte')):
+            segmento = dados[nome]
+            context[chave] = {
+                'total': segmento['total'],
+                'min_time': format_duration(segmento['minimo']),
+                'avg_time': format_duration(segmento['media']),
+                'max_time': format_duration(segmento['maximo']),
+                'p50': format_duration(segmento['p50']),
+                'p90': format_duration(segmento['p90']),
+                'p99': format_duration(segmento['p99']),
+            }
+        context['sla_histograms'] = json.dumps({
+            nome: segmento['histograma'] for nome, segmento in dados.items()
+        }, cls=DjangoJSONEncoder)
+        return context
+
+    # --- Derivados em Python, sem queries extras ---
+
+    def financials(self, finalization_series):
+        """Histórico financeiro mensal e anual a partir da série de finalização."""
+        monthly = sorted(finalization_series, key=lambda d: d['month'], reverse=True)
+
+        yearly = {}
+        for row in monthly:
+            acc = yearly.setdefault(row['month'].year, {'year': row['month'].year})
+            for campo in ('val_devolvido', 'val_aceitas', 'total_cliente', 'total_transbirday', 'total_terceiro'):
+                if row[campo] is not None:
+                    acc[campo] = (acc.get(campo) or 0) + row[campo]
+        yearly = sorted(yearly.values(), key=lambda d: d['year'], reverse=True)
+
+        def history(rows, period_key):
+            return [{
+                'period': row[period_key],
+                'val_devolvido': row.get('val_devolvido'),
+                'val_aceitas': row.get('val_aceitas'),
+                'val_prejuizo': row.get('total_transbirday'),
+            } for row in rows]
+
+        def breakdown(rows, period_key):
+            return [{
+                period_key: row[period_key],
+                'total_cliente': row.get('total_cliente'),
+                'total_transbirday': row.get('total_transbirday'),
+                'total_terceiro': row.get('total_terceiro'),
+            } for row in rows]
+
+        last_12_months, last_5_years = financial_windows(self.now)
+
+        return {
+            'history_monthly': history(monthly[:12], 'month'),
+            'history_yearly': history(yearly[:5], 'year'),
+            'financial_12m': breakdown([r for r in monthly if r['month'] >= last_12_months], 'month'),
+            'financial_5y': breakdown([r for r in yearly if r['year'] >= last_5_years.year], 'year'),
+        }
+
+    def as_context(self):
+        finalization = self.finalization_series()
+        evolution_returns = [
+            {'month': d['month'].strftime('%Y-%m-%d'), 'total': d['returned']}
+            for d in finalization if d['returned']
+        ]
+        evolution_accepted = [
+            {'month': d['month'].strftime('%Y-%m-%d'), 'total': d['accepted']}
+            for d in finalization if d['accepted']
+        ]
+        heatmap_data, heatmap_list = self.heatmap()
+        top_products_total, top_products_returned, top_products_accepted = self.top_products()
+
+        context = self.counters()
+        context.update({
+            'evolution_data': json.dumps(self.creation_series(), cls=DjangoJSONEncoder),
+            'evolution_returns': json.dumps(evolution_returns, cls=DjangoJSONEncoder),
+            'evolution_accepted': json.dumps(evolution_accepted, cls=DjangoJSONEncoder),
+            'client_stats': self.client_stats(),
+            'heatmap_data': json.dumps(heatmap_data, cls=DjangoJSONEncoder),
+            'heatmap_list': heatmap_list,
+
+            'top_drivers': self.top_drivers(),
+            'top_products_total': top_products_total,
+            'top_products_returned': top_products_returned,
+            'top_products_accepted': top_products_accepted,
+        })
+        context.update(self.slas())
+        context.update(self.financials(finalization))
+        return context
+
+
+# --- Cache ---
+
+def _cache_key(year, month):
+    return f'dashboard:contexto:{year}:{month:02}'
+
+
+def _compute_context(year, month):
+    return DashboardStats(year=year, month=month).as_context()
+
+
+def cached_dashboard_context(year=None, month=None):
+    """Contexto do Dashboard vindo do cache (ver kpi_cache)."""
+    period = DashboardStats(year=year, month=month).period
+    return kpi_cache.get_or_refresh(_cache_key(period.year, period.month), _compute_context, period.year, period.month)
+
+
+def invalidate_dashboard_cache():
+    """Marca todas as entradas como desatualizadas e já recalcula o mês corrente."""
+    generation = kpi_cache.bump_generation()
+    today = timezone.localdate()
+    kpi_cache.schedule_refresh(_cache_key(today.year, today.month), generation, _compute_context, today.year, today.month)
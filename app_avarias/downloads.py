@@ -0,0 +1,85 @@
+"""
+Download de arquivos grandes (exportações) com suporte a Range.
+
+Um download interrompido pode ser retomado do ponto em que parou: o navegador
+ou gerenciador de downloads pede "Range: bytes=N-" e recebe só o restante
+(206 Partial Content). Só um intervalo por pedido é aceito; pedidos com vários
+intervalos recebem o arquivo inteiro, o que o HTTP permite.
+"""
+import mimetypes
+import os
+import re
+
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
+from django.utils.http import content_disposition_header
+
+TAMANHO_BLOCO = 64 * 1024
+
+RANGE_REGEX = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def intervalo_pedido(cabecalho, tamanho):
+    """
+    (inicio, fim) inclusivos do cabeçalho Range, None se não houver um intervalo
+    único válido (responde-se com o arquivo inteiro) ou False se o intervalo
+    estiver fora do arquivo (416).
+    """
+    match = RANGE_REGEX.match((cabecalho or '').strip())
+    if not match or match.groups() == ('', ''):
+        return None
+    inicio, fim = match.groups()
+    if not inicio:
+        # "bytes=-N": the last N bytes
+        sufixo = int(fim)
+        if not sufixo:
+            return False
+        return max(tamanho - sufixo, 0), tamanho - 1
+    inicio = int(inicio)
+    fim = min(int(fim), tamanho - 1) if fim else tamanho - 1
+    if inicio >= tamanho or fim < inicio:
+        return False
+    return inicio, fim
+
+
+def _ler(arquivo, inicio, quantidade):
+    try:
+        arquivo.seek(inicio)
+        while quantidade > 0:
+            bloco = arquivo.read(min(TAMANHO_BLOCO, quantidade))
+            if not bloco:
+                break
+            quantidade -= len(bloco)
+            yield bloco
+    finally:
+        arquivo.close()
+
+
+def resposta_de_arquivo(request, campo, etag=None):
+    """Resposta de download de um FieldFile, inteira ou parcial conforme o Range."""
+    nome = os.path.basename(campo.name)
+    tamanho = campo.size
+    content_type = mimetypes.guess_type(nome)[0] or 'application/octet-stream'
+
+    intervalo = None
+    # If-Range: the range only applies if the client still has this same file
+    if 'HTTP_RANGE' in request.META and request.META.get('HTTP_IF_RANGE', etag) == etag:
+        intervalo = intervalo_pedido(request.META['HTTP_RANGE'], tamanho)
+
+    if intervalo is False:
+        resposta = HttpResponse(status=416)
+        resposta['Content-Range'] = f'bytes */{tamanho}'
+    elif intervalo is None:
+        resposta = FileResponse(campo.open('rb'), as_attachment=True, filename=nome, content_type=content_type)
+    else:
+        inicio, fim = intervalo
+        resposta = StreamingHttpResponse(
+            _ler(campo.open('rb'), inicio, fim - inicio + 1), status=206, content_type=content_type,
+        )
+        resposta['Content-Length'] = str(fim - inicio + 1)
+        resposta['Content-Range'] = f'bytes {inicio}-{fim}/{tamanho}'
+        resposta['Content-Disposition'] = content_disposition_header(True, nome)
+
+    resposta['Accept-Ranges'] = 'bytes'
+    if etag:
+        resposta['ETag'] = etag
+    return resposta
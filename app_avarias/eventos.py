@@ -0,0 +1,90 @@
+"""
+Histórico das Avarias (AvariaEvento).
+
+registrar_evento() grava uma entrada com um único INSERT. formatar_evento()
+reproduz a linha no formato que o antigo campo observacoes usava
+("[dd/mm/aaaa hh:mm - usuário] [TIPO] ..."), para a tela, a impressão e a API.
+O texto antigo foi convertido em eventos pela migration 0020_migrar_observacoes.
+"""
+import re
+
+from django.utils import timezone
+
+ROTULOS = {
+    'ABERTURA': 'ABERTURA',
+    'SAIDA_DEVOLUCAO': 'SAÍDA DEVOLUÇÃO',
+    'DEVOLUCAO_CONCLUIDA': 'DEVOLUÇÃO CONCLUÍDA',
+    'EDICAO_ITENS': 'EDIÇÃO DE ITENS',
+    'AJUSTE_VALOR': 'AJUSTE DE VALOR',
+    'TRANSFERENCIA_CD': 'TRANSFERÊNCIA CD',
+    'DEFINICAO_PREJUIZO': 'DEFINIÇÃO DE PREJUÍZO',
+}
+
+
+def novo_evento(avaria, tipo, usuario=None, texto='', **dados):
+    """AvariaEvento ainda não gravado (para bulk_create)."""
+    from .models import AvariaEvento
+
+    return AvariaEvento(
+        avaria=avaria,
+        tipo=tipo,
+        usuario=usuario,
+        autor=usuario.get_username() if usuario else '',
+        texto=(texto or '').strip(),
+        dados=dados,
+    )
+
+
+def registrar_evento(avaria, tipo, usuario=None, texto='', **dados):
+    """Acrescenta um evento ao histórico da Avaria (um INSERT, a Avaria não é regravada)."""
+    evento = novo_evento(avaria, tipo, usuario, texto, **dados)
+    evento.save(force_insert=True)
+    return evento
+
+
+def _detalhes(evento):
+    dados = evento.dados or {}
+    if evento.tipo == 'DECISAO':
+        partes = [f"[DECISÃO: {dados.get('acao')}]"]
+        if dados.get('nf_retida') == 'SIM':
+            partes.append(f"[NF RETIDA NA CONFERÊNCIA: SIM ({dados.get('horas_retencao')}h)]")
+        else:
+            partes.append("[NF RETIDA NA CONFERÊNCIA: NÃO]")
+        if dados.get('nf_devolucao'):
+            partes.append(f"[NFD: {dados['nf_devolucao']}]")
+        if dados.get('cd'):
+            partes.append(f"[CD ARMAZENAGEM: {dados['cd']}]")
+        return ' | '.join(partes)
+
+    rotulo = f"[{ROTULOS[evento.tipo]}]" if evento.tipo in ROTULOS else ''
+    if evento.tipo == 'AJUSTE_VALOR':
+        return f"{rotulo} R$ {dados.get('valor_anterior')} → R$ {dados.get('valor_novo')} | Motivo: {dados.get('motivo', '')}"
+    if evento.tipo == 'TRANSFERENCIA_CD':
+        return f"{rotulo}\nCD de Origem: {dados.get('origem')}\nCD de Destino: {dados.get('destino')}\nObservação adicional:"
+    if evento.tipo == 'DEFINICAO_PREJUIZO':
+        return f"{rotulo} Responsável: {dados.get('responsavel')} - {dados.get('detalhes', '')}"
+    return rotulo
+
+
+def descrever_evento(evento):
+    """Conteúdo do evento (rótulo, detalhes e texto), sem data e autor."""
+    if (evento.dados or {}).get('legado'):
+        # Migrated entries keep the original text verbatim
+        return CABECALHO_REGEX.sub('', evento.texto, count=1).strip()
+    return ' '.join(parte for parte in (_detalhes(evento), evento.texto) if parte)
+
+
+def formatar_evento(evento):
+    """Linha do histórico no formato do antigo campo observacoes."""
+    if (evento.dados or {}).get('legado'):
+        return evento.texto
+    cabecalho = f"[{timezone.localtime(evento.timestamp):%d/%m/%Y %H:%M} - {evento.autor}]"
+    return f"{cabecalho} {descrever_evento(evento)}".strip()
+
+
+def texto_do_historico(eventos):
+    return '\n\n'.join(formatar_evento(evento) for evento in eventos)
+
+
+# Header of each entry of the old text (migrated entries keep it verbatim)
+CABECALHO_REGEX = re.compile(r'^\[(\d{2}/\d{2}/\d{4} \d{2}:\d{2}) - ([^\]]*)\]', re.MULTILINE)
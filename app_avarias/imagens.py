@@ -0,0 +1,78 @@
+"""
+Versões das fotos das Avarias (AvariaFoto).
+
+O arquivo enviado pelo celular (muitas vezes 4-12 MB) fica guardado como
+veio, para auditoria. Depois do upload, em segundo plano, são geradas três
+versões em JPEG: web (tela de detalhe), miniatura (grade de fotos) e impressao
+(relatórios). Todas têm a rotação do EXIF aplicada e nenhum metadado (EXIF,
+GPS), porque o Pillow só grava o EXIF quando ele é passado explicitamente.
+"""
+import logging
+import os
+from io import BytesIO
+
+from django.core.files.base import ContentFile
+from django.utils import timezone
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+logger = logging.getLogger(__name__)
+
+# campo: (maior lado em px, qualidade JPEG)
+VERSOES = {
+    'web': (1600, 82),
+    'miniatura': (400, 75),
+    'impressao': (1200, 85),
+}
+
+
+def abrir_imagem(arquivo):
+    with arquivo.open('rb'):
+        imagem = Image.open(arquivo)
+        imagem.load()
+    imagem = ImageOps.exif_transpose(imagem)
+    if imagem.mode != 'RGB':
+        imagem = imagem.convert('RGB')
+    return imagem
+
+
+def gerar_versao(imagem, lado, qualidade):
+    """Bytes JPEG de imagem reduzida para caber em lado x lado (nunca ampliada)."""
+    copia = imagem.copy()
+    copia.thumbnail((lado, lado), Image.Resampling.LANCZOS)
+    saida = BytesIO()
+    copia.save(saida, 'JPEG', quality=qualidade, optimize=True, progressive=True)
+    return saida.getvalue()
+
+
+def processar_foto(foto_id):
+    """Gera web, miniatura e impressao de uma AvariaFoto. Fotos já processadas são ignoradas."""
+    from .models import AvariaFoto
+
+    foto = AvariaFoto.objects.filter(pk=foto_id, processada_em__isnull=True).first()
+    if foto is None:
+        return False
+
+    # Same original (content-addressed storage) already processed: reuse its renditions
+    igual = (
+        AvariaFoto.objects.filter(arquivo=foto.arquivo.name, processada_em__isnull=False)
+        .exclude(pk=foto.pk).values(*VERSOES).first()
+    )
+    if igual:
+        for campo, nome in igual.items():
+            setattr(foto, campo, nome)
+        foto.processada_em = timezone.now()
+        foto.save(update_fields=[*VERSOES, 'processada_em'])
+        return True
+
+    try:
+        imagem = abrir_imagem(foto.arquivo)
+    except (OSError, UnidentifiedImageError):
+        logger.exception("Não foi possível abrir a foto %s (%s)", foto.pk, foto.arquivo.name)
+        return False
+
+    nome = os.path.splitext(os.path.basename(foto.arquivo.name))[0]
+    for campo, (lado, qualidade) in VERSOES.items():
+        getattr(foto, campo).save(f'{nome}.jpg', ContentFile(gerar_versao(imagem, lado, qualidade)), save=False)
+    foto.processada_em = timezone.now()
+    foto.save(update_fields=[*VERSOES, 'processada_em'])
+    return True
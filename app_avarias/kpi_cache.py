@@ -0,0 +1,63 @@
+"""
+Cache dos indicadores (Dashboard, SLAs) com stale-while-revalidate.
+
+Cada entrada guarda a "geração" em que foi calculada. Salvar uma Avaria só troca
+a geração: entradas antigas continuam sendo servidas enquanto um recálculo roda
+em segundo plano. Só o primeiro acesso a uma chave sem nenhuma entrada paga o
+cálculo completo.
+"""
+import time
+
+from django.core.cache import cache
+
+from .tasks import run_in_background
+
+GENERATION_KEY = 'kpi:geracao'
+LOCK_TIMEOUT = 120
+
+
+def current_generation():
+    generation = cache.get(GENERATION_KEY)
+    if generation is None:
+        cache.add(GENERATION_KEY, time.time_ns(), timeout=None)
+        generation = cache.get(GENERATION_KEY)
+    return generation
+
+
+def bump_generation():
+    """Marca todas as entradas como desatualizadas."""
+    generation = time.time_ns()
+    cache.set(GENERATION_KEY, generation, timeout=None)
+    return generation
+
+
+def refresh(key, generation, func, *args):
+    value = func(*args)
+    cache.set(key, {'geracao': generation, 'valor': value}, timeout=None)
+    cache.delete(f'{key}:lock')
+    return value
+
+
+def schedule_refresh(key, generation, func, *args):
+    # The lock avoids piling up recomputations of the same key. It is not a
+    # strict mutex: add() is atomic on Redis/Memcached, but the FileBasedCache
+    # in settings checks and then writes, so two workers may both recompute.
+    # That only costs time: both store the same value for the generation.
+    if cache.add(f'{key}:lock', 1, timeout=LOCK_TIMEOUT):
+        run_in_background(refresh, key, generation, func, *args)
+
+
+def get_or_refresh(key, func, *args):
+    """Valor de func(*args) vindo do cache, recalculado em segundo plano se desatualizado."""
+    cached = cache.get_many([key, GENERATION_KEY])
+    generation = cached.get(GENERATION_KEY)
+    if generation is None:
+        generation = current_generation()
+
+    entry = cached.get(key)
+    if entry is None:
+        return refresh(key, generation, func, *args)
+
+    if entry['geracao'] != generation:
+        schedule_refresh(key, generation, func, *args)
+    return entry['valor']
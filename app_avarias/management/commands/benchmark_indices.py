@@ -0,0 +1,183 @@
+"""
+Benchmark dos índices de Avaria em um banco de testes populado.
+
+Cria o banco de testes (nunca toca no banco real), insere N Avarias com uma
+distribuição parecida com a de produção (a grande maioria finalizada) e, para
+cada consulta "quente", mostra o plano (EXPLAIN) e o tempo com e sem os índices
+definidos em Avaria.Meta.indexes.
+
+    python manage.py benchmark_indices --linhas 1000000
+"""
+import random
+import statistics
+import time
+from contextlib import contextmanager
+from datetime import timedelta
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.db.models import Count
+from django.utils import timezone
+
+from app_avarias.models import Avaria, CentroDistribuicao, Cliente, Usuario
+
+# (status, tipo_finalizacao, peso)
+DISTRIBUICAO = [
+    ('EM_ABERTO', None, 3),
+    ('AGUARDANDO_DEVOLUCAO', None, 2),
+    ('EM_ROTA_DEVOLUCAO', None, 1),
+    ('FINALIZADA', 'ACEITE', 50),
+    ('FINALIZADA', 'DEVOLUCAO_CONCLUIDA', 44),
+]
+RESPONSAVEIS = [None, 'TRANSBIRDAY', 'CLIENTE', 'TRANSPORTADORA_TERCEIRA']
+
+
+def consultas(cd_id):
+    """Consultas dos caminhos quentes (avaria_list, definição de prejuízo, API, SLA)."""
+    hoje = timezone.localdate()
+    return {
+        'lista_em_aberto': Avaria.objects.filter(status='EM_ABERTO').order_by('-data_criacao')[:50],
+        'lista_finalizadas': Avaria.objects.filter(status='FINALIZADA').order_by('-data_criacao')[:50],
+        'aguardando_por_cd': (
+            Avaria.objects.filter(status='AGUARDANDO_DEVOLUCAO', cd_armazenagem_reversa_id=cd_id)
+            .order_by('-data_criacao')[:50]
+        ),
+        'contagem_por_cd': (
+            Avaria.objects.filter(status='AGUARDANDO_DEVOLUCAO', cd_armazenagem_reversa__isnull=False)
+            .values('cd_armazenagem_reversa_id').annotate(total=Count('id')).order_by()
+        ),
+        'prejuizo_pendente': (
+            Avaria.objects.filter(status='FINALIZADA', tipo_finalizacao='DEVOLUCAO_CONCLUIDA', responsavel_prejuizo__isnull=True)
+            .order_by('-data_finalizacao')[:50]
+        ),
+        'sla_transporte_mes': (
+            Avaria.objects.filter(
+                status='FINALIZADA', tipo_finalizacao='DEVOLUCAO_CONCLUIDA',
+                data_finalizacao__year=hoje.year, data_finalizacao__month=hoje.month,
+            ).values('id', 'data_inicio_devolucao', 'data_finalizacao')
+        ),
+    }
+
+
+@contextmanager
+def sem_auto_now_add():
+    """bulk_create respeita auto_now_add; para espalhar data_criacao no tempo ele é desligado."""
+    campo = Avaria._meta.get_field('data_criacao')
+    campo.auto_now_add = False
+    try:
+        yield
+    finally:
+        campo.auto_now_add = True
+
+
+class Command(BaseCommand):
+    help = "Mostra planos e tempos das consultas de Avaria com e sem os índices, em um banco de testes populado."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--linhas', type=int, default=1_000_000, help="Quantidade de Avarias a inserir.")
+        parser.add_argument('--lote', type=int, default=10_000, help="Tamanho do lote do bulk_create.")
+        parser.add_argument('--repeticoes', type=int, default=5, help="Execuções por consulta (vale a mediana).")
+        parser.add_argument('--keepdb', action='store_true', help="Reaproveita o banco de testes de uma execução anterior.")
+
+    def handle(self, *args, **options):
+        nome_original = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, keepdb=options['keepdb'])
+        try:
+            if not Avaria.objects.exists():
+                self.popular(options['linhas'], options['lote'])
+            cd_id = CentroDistribuicao.objects.order_by('id').values_list('id', flat=True).first()
+
+            with connection.cursor() as cursor:
+                if connection.vendor == 'sqlite':
+                    cursor.execute('ANALYZE')
+                elif connection.vendor == 'postgresql':
+                    cursor.execute('ANALYZE app_avarias_avaria')
+
+            with self.sem_indices():
+                antes = self.medir(cd_id, options['repeticoes'])
+            depois = self.medir(cd_id, options['repeticoes'])
+            self.relatorio(antes, depois)
+        finally:
+            connection.creation.destroy_test_db(nome_original, verbosity=0, keepdb=options['keepdb'])
+
+    def popular(self, linhas, lote):
+        self.stdout.write(f"Populando {linhas} Avarias...")
+        usuario = Usuario.objects.create_user(username='benchmark', password='benchmark')
+        clientes = Cliente.objects.bulk_create(
+            Cliente(razao_social=f"Cliente {i}", cnpj=f"{i:014}") for i in range(200)
+        )
+        cds = CentroDistribuicao.objects.bulk_create(
+            CentroDistribuicao(nome=f"CD {i}", codigo=f"CD{i:03}") for i in range(20)
+        )
+
+        rng = random.Random(42)
+        agora = timezone.now()
+        estados = [(status, tipo) for status, tipo, _ in DISTRIBUICAO]
+        pesos = [peso for _, _, peso in DISTRIBUICAO]
+
+        inicio = time.perf_counter()
+        with sem_auto_now_add():
+            for offset in range(0, linhas, lote):
+                avarias = []
+                for _ in range(min(lote, linhas - offset)):
+                    status, tipo = rng.choices(estados, pesos)[0]
+                    criacao = agora - timedelta(minutes=rng.randint(0, 5 * 365 * 24 * 60))
+                    decisao = criacao + timedelta(hours=rng.randint(1, 240)) if status != 'EM_ABERTO' else None
+                    rota = decisao + timedelta(hours=rng.randint(1, 120)) if decisao and tipo != 'ACEITE' and status != 'AGUARDANDO_DEVOLUCAO' else None
+                    final = (rota or decisao) + timedelta(hours=rng.randint(1, 72)) if status == 'FINALIZADA' else None
+                    avarias.append(Avaria(
+                        cliente=rng.choice(clientes),
+                        nota_fiscal=str(rng.randint(1, 999_999)),
+                        criado_por=usuario,
+                        status=status,
+                        tipo_finalizacao=tipo,
+                        # ~2% das devoluções concluídas ainda sem responsável definido
+                        responsavel_prejuizo=(None if rng.random() < 0.02 else rng.choice(RESPONSAVEIS[1:])) if tipo == 'DEVOLUCAO_CONCLUIDA' else None,
+                        cd_armazenagem_reversa=rng.choice(cds) if status == 'AGUARDANDO_DEVOLUCAO' else None,
+                        valor_nf=Decimal(rng.randint(100, 500_000)) / 100,
+                        data_criacao=criacao,
+                        data_decisao=decisao,
+                        data_inicio_devolucao=rota,
+                        data_finalizacao=final,
+                    ))
+                Avaria.objects.bulk_create(avarias)
+                self.stdout.write(f"  {offset + len(avarias)}/{linhas}", ending='\r')
+        self.stdout.write(f"\nPopulado em {time.perf_counter() - inicio:.1f}s.")
+
+    @contextmanager
+    def sem_indices(self):
+        indices = Avaria._meta.indexes
+        with connection.schema_editor() as editor:
+            for index in indices:
+                editor.remove_index(Avaria, index)
+        try:
+            yield
+        finally:
+            with connection.schema_editor() as editor:
+                for index in indices:
+                    editor.add_index(Avaria, index)
+
+    def medir(self, cd_id, repeticoes):
+        resultados = {}
+        for nome, qs in consultas(cd_id).items():
+            tempos = []
+            for _ in range(repeticoes):
+                inicio = time.perf_counter()
+                list(qs.all())
+                tempos.append((time.perf_counter() - inicio) * 1000)
+            resultados[nome] = {'plano': qs.explain(), 'ms': statistics.median(tempos)}
+        return resultados
+
+    def relatorio(self, antes, depois):
+        for nome in antes:
+            self.stdout.write(self.style.MIGRATE_HEADING(f"\n== {nome} =="))
+            self.stdout.write("Sem índices:\n" + antes[nome]['plano'])
+            self.stdout.write("Com índices:\n" + depois[nome]['plano'])
+
+        self.stdout.write(self.style.MIGRATE_HEADING("\nResumo (mediana, ms)"))
+        self.stdout.write(f"{'consulta':<22}{'sem índices':>14}{'com índices':>14}{'ganho':>10}")
+        for nome in antes:
+            sem, com = antes[nome]['ms'], depois[nome]['ms']
+            ganho = f"{sem / com:.1f}x" if com else '-'
+            self.stdout.write(f"{nome:<22}{sem:>14.2f}{com:>14.2f}{ganho:>10}")
@@ -0,0 +1,64 @@
+from django.core.management.base import BaseCommand
+from django.template.defaultfilters import filesizeformat
+from django.utils import timezone
+
+from app_avarias.imagens import VERSOES
+from app_avarias.models import AvariaFoto
+from app_avarias.storage import armazenamento, e_nome_por_conteudo, hash_do_conteudo, nome_por_conteudo
+
+CAMPOS = ('arquivo', *VERSOES)
+
+
+class Command(BaseCommand):
+    help = (
+        "Move as fotos antigas (media/avarias_fotos/...) para o armazenamento por conteúdo "
+        "(SHA-256), guardando uma única cópia de arquivos idênticos, e informa o espaço liberado."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help="Só calcula, sem mover nem apagar arquivos.")
+
+    def handle(self, *args, dry_run=False, **options):
+        novos_nomes = {}  # nome antigo -> nome por conteúdo
+        existentes = set()  # blobs already present (or that would be, in --dry-run)
+        movidos = duplicados = ausentes = liberado = 0
+
+        for foto in AvariaFoto.objects.order_by('pk').iterator(chunk_size=500):
+            alteracoes = {}
+            for campo in CAMPOS:
+                nome = getattr(foto, campo).name
+                if not nome or e_nome_por_conteudo(nome):
+                    continue
+                if nome not in novos_nomes:
+                    if not armazenamento.exists(nome):
+                        ausentes += 1
+                        self.stderr.write(f"Arquivo não encontrado: {nome} (foto {foto.pk})")
+                        continue
+                    with armazenamento.open(nome) as arquivo:
+                        novo = nome_por_conteudo(hash_do_conteudo(arquivo), nome)
+                        duplicado = novo in existentes or armazenamento.exists(novo)
+                        if not dry_run:
+                            armazenamento.save(nome, arquivo)
+                    if duplicado:
+                        duplicados += 1
+                        liberado += armazenamento.size(nome)
+                    else:
+                        movidos += 1
+                    existentes.add(novo)
+                    novos_nomes[nome] = novo
+                alteracoes[campo] = novos_nomes[nome]
+
+            if alteracoes and not dry_run:
+                # The URLs change: atualizado_em lets the app pick them up on the next sync
+                AvariaFoto.objects.filter(pk=foto.pk).update(atualizado_em=timezone.now(), **alteracoes)
+
+        # Old files are removed only after every row points to the new name
+        if not dry_run:
+            for nome in novos_nomes:
+                armazenamento.delete(nome)
+
+        prefixo = "[dry-run] " if dry_run else ""
+        self.stdout.write(self.style.SUCCESS(
+            f"{prefixo}{movidos} arquivo(s) movido(s), {duplicados} duplicado(s) removido(s), "
+            f"{ausentes} ausente(s). Espaço liberado: {filesizeformat(liberado)}."
+        ))
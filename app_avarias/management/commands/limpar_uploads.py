@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from app_avarias.uploads import remover_uploads_abandonados
+
+
+class Command(BaseCommand):
+    help = "Apaga os uploads de fotos em partes que não foram finalizados (e seus arquivos parciais)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--horas', type=int, default=48, help="Sem atividade há mais de N horas (padrão: 48).")
+
+    def handle(self, *args, horas=48, **options):
+        total = remover_uploads_abandonados(horas)
+        self.stdout.write(self.style.SUCCESS(f"{total} upload(s) abandonado(s) removido(s)."))
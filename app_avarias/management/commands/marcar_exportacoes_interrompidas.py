@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from app_avarias.relatorios import EXPORTACAO_HORAS_LIMITE, marcar_exportacoes_interrompidas
+
+
+class Command(BaseCommand):
+    help = "Marca como ERRO as exportações que ficaram na fila ou em processamento (processo reiniciado)."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--horas', type=int, default=EXPORTACAO_HORAS_LIMITE,
+            help=f"Solicitadas há mais de N horas (padrão: {EXPORTACAO_HORAS_LIMITE}).",
+        )
+
+    def handle(self, *args, horas=EXPORTACAO_HORAS_LIMITE, **options):
+        total = marcar_exportacoes_interrompidas(horas=horas)
+        self.stdout.write(self.style.SUCCESS(f"{total} exportação(ões) marcada(s) como interrompida(s)."))
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+
+from app_avarias.imagens import processar_foto
+from app_avarias.models import AvariaFoto
+
+
+class Command(BaseCommand):
+    help = "Gera as versões web/miniatura/impressao das fotos que ainda não foram processadas."
+
+    def handle(self, *args, **options):
+        ids = list(AvariaFoto.objects.filter(processada_em__isnull=True).values_list('pk', flat=True))
+        processadas = sum(1 for foto_id in ids if processar_foto(foto_id))
+        self.stdout.write(self.style.SUCCESS(f"{processadas} de {len(ids)} foto(s) processada(s)."))
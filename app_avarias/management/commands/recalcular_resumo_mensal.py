@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from app_avarias.resumo import reconstruir_resumo_mensal
+
+
+class Command(BaseCommand):
+    help = "Recalcula do zero o resumo mensal de Avarias usado pelo Dashboard."
+
+    def handle(self, *args, **options):
+        total = reconstruir_resumo_mensal()
+        self.stdout.write(self.style.SUCCESS(f"Resumo mensal recalculado: {total} linha(s)."))
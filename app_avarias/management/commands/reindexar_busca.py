@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from app_avarias.search import reindexar_tudo
+
+
+class Command(BaseCommand):
+    help = "Reconstrói o índice de busca (documentos de AvariaBusca) de todas as Avarias."
+
+    def handle(self, *args, **options):
+        total = reindexar_tudo()
+        self.stdout.write(self.style.SUCCESS(f"Índice de busca reconstruído: {total} Avaria(s)."))
@@ -0,0 +1,42 @@
+# Generated by Django 5.2.18 on 2026-10-17 18:49
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def popular_resumo(apps, schema_editor):
+    from app_avarias.resumo import reconstruir_resumo_mensal
+    reconstruir_resumo_mensal(
+        apps.get_model('app_avarias', 'Avaria'),
+        apps.get_model('app_avarias', 'AvariaResumoMensal'),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app_avarias', '0010_avaria_acao_avaria_horas_retencao_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AvariaResumoMensal',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('mes_criacao', models.DateField()),
+                ('mes_finalizacao', models.DateField(blank=True, null=True)),
+                ('status', models.CharField(choices=[('EM_ABERTO', 'Em Aberto'), ('DECISAO', 'Em Decisão'), ('AGUARDANDO_DEVOLUCAO', 'Aguardando Devolução'), ('EM_ROTA_DEVOLUCAO', 'Em Rota de Devolução'), ('FINALIZADA', 'Finalizada')], max_length=30)),
+                ('tipo_finalizacao', models.CharField(blank=True, choices=[('ACEITE', 'Aceita pelo Cliente'), ('DEVOLUCAO_CONCLUIDA', 'Devolução Concluída')], max_length=30, null=True)),
+                ('responsavel_prejuizo', models.CharField(blank=True, choices=[('TRANSBIRDAY', 'Transbirday'), ('CLIENTE', 'Cliente'), ('TRANSPORTADORA_TERCEIRA', 'Transportadora Terceira')], max_length=50, null=True)),
+                ('quantidade', models.IntegerField(default=0)),
+                ('valor_total', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('cliente', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='resumos_mensais', to='app_avarias.cliente')),
+            ],
+            options={
+                'verbose_name': 'Resumo Mensal de Avarias',
+                'verbose_name_plural': 'Resumos Mensais de Avarias',
+                'indexes': [models.Index(fields=['status', 'tipo_finalizacao'], name='resumo_status_tipo_idx'), models.Index(fields=['mes_criacao'], name='resumo_mes_criacao_idx'), models.Index(fields=['mes_finalizacao', 'tipo_finalizacao'], name='resumo_mes_final_idx')],
+            },
+        ),
+        migrations.RunPython(popular_resumo, migrations.RunPython.noop),
+    ]
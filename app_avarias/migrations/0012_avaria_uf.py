@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-17 18:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app_avarias', '0011_avariaresumomensal'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='avaria',
+            name='uf',
+            field=models.CharField(blank=True, db_index=True, editable=False, max_length=2, null=True, verbose_name='UF'),
+        ),
+    ]
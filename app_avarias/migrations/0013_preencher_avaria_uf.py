@@ -0,0 +1,37 @@
+from django.db import migrations, transaction
+
+BATCH_SIZE = 1000
+
+
+def preencher_uf(apps, schema_editor):
+    from app_avarias.models import extrair_uf
+
+    Avaria = apps.get_model('app_avarias', 'Avaria')
+    ultimo_id = 0
+    while True:
+        lote = list(
+            Avaria.objects
+            .filter(pk__gt=ultimo_id)
+            .order_by('pk')
+            .only('pk', 'local_atuacao')[:BATCH_SIZE]
+        )
+        if not lote:
+            break
+        for avaria in lote:
+            avaria.uf = extrair_uf(avaria.local_atuacao)
+        # One short transaction per batch so large tables don't hold a long lock
+        with transaction.atomic():
+            Avaria.objects.bulk_update(lote, ['uf'])
+        ultimo_id = lote[-1].pk
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('app_avarias', '0012_avaria_uf'),
+    ]
+
+    operations = [
+        migrations.RunPython(preencher_uf, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.2.18 on 2026-10-17 18:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app_avarias', '0013_preencher_avaria_uf'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='avaria',
+            index=models.Index(fields=['status', '-data_criacao'], name='avaria_status_criacao_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='avaria',
+            index=models.Index(fields=['status', 'tipo_finalizacao', 'data_finalizacao'], name='avaria_status_final_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='avaria',
+            index=models.Index(condition=models.Q(('status', 'EM_ABERTO')), fields=['-data_criacao'], name='avaria_aberta_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='avaria',
+            index=models.Index(condition=models.Q(('status', 'AGUARDANDO_DEVOLUCAO')), fields=['cd_armazenagem_reversa', '-data_criacao'], name='avaria_aguardando_cd_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='avaria',
+            index=models.Index(condition=models.Q(('responsavel_prejuizo__isnull', True), ('status', 'FINALIZADA'), ('tipo_finalizacao', 'DEVOLUCAO_CONCLUIDA')), fields=['-data_finalizacao'], name='avaria_prejuizo_pendente_idx'),
+        ),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 5.2.18 on 2026-10-17 18:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app_avarias', '0014_avaria_indices'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='avaria',
+            name='avaria_status_criacao_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='avaria',
+            name='avaria_aberta_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='avaria',
+            name='avaria_aguardando_cd_idx',
+        ),
+        migrations.AddIndex(
+            model_name='avaria',
+            index=models.Index(fields=['status', '-data_criacao', '-id'], name='avaria_status_criacao_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='avaria',
+            index=models.Index(fields=['-data_criacao', '-id'], name='avaria_criacao_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='avaria',
+            index=models.Index(condition=models.Q(('status', 'EM_ABERTO')), fields=['-data_criacao', '-id'], name='avaria_aberta_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='avaria',
+            index=models.Index(condition=models.Q(('status', 'AGUARDANDO_DEVOLUCAO')), fields=['cd_armazenagem_reversa', '-data_criacao', '-id'], name='avaria_aguardando_cd_idx'),
+        ),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 5.2.18 on 2026-10-17 19:01
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def criar_indice_busca(apps, schema_editor):
+    from app_avarias.search import criar_indice
+    criar_indice(schema_editor)
+
+
+def remover_indice_busca(apps, schema_editor):
+    from app_avarias.search import remover_indice
+    remover_indice(schema_editor)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app_avarias', '0015_avaria_indices_cursor'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AvariaBusca',
+            fields=[
+                ('avaria', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='busca', serialize=False, to='app_avarias.avaria')),
+                ('documento', models.TextField()),
+            ],
+            options={
+                'verbose_name': 'Documento de Busca',
+                'verbose_name_plural': 'Documentos de Busca',
+            },
+        ),
+        migrations.RunPython(criar_indice_busca, remover_indice_busca),
+    ]
@@ -0,0 +1,24 @@
+from django.db import migrations
+
+
+def indexar(apps, schema_editor):
+    from app_avarias.search import reindexar_tudo
+
+    # Batched by pk, one short transaction per batch (see search.indexar_avarias)
+    reindexar_tudo(
+        avaria_model=apps.get_model('app_avarias', 'Avaria'),
+        item_model=apps.get_model('app_avarias', 'AvariaItem'),
+        busca_model=apps.get_model('app_avarias', 'AvariaBusca'),
+    )
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('app_avarias', '0016_avariabusca'),
+    ]
+
+    operations = [
+        migrations.RunPython(indexar, migrations.RunPython.noop),
+    ]
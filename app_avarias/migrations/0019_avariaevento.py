@@ -0,0 +1,35 @@
+# Generated by Django 5.2.18 on 2026-10-17 19:06
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app_avarias', '0018_exportacao'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AvariaEvento',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('tipo', models.CharField(choices=[('ABERTURA', 'Abertura'), ('OBSERVACAO', 'Observação'), ('DECISAO', 'Decisão'), ('SAIDA_DEVOLUCAO', 'Saída Devolução'), ('DEVOLUCAO_CONCLUIDA', 'Devolução Concluída'), ('EDICAO_ITENS', 'Edição de Itens'), ('AJUSTE_VALOR', 'Ajuste de Valor'), ('TRANSFERENCIA_CD', 'Transferência CD'), ('DEFINICAO_PREJUIZO', 'Definição de Prejuízo'), ('LEGADO', 'Histórico Anterior')], max_length=30)),
+                ('autor', models.CharField(blank=True, default='', max_length=150)),
+                ('timestamp', models.DateTimeField(default=django.utils.timezone.now)),
+                ('texto', models.TextField(blank=True, default='')),
+                ('dados', models.JSONField(blank=True, default=dict)),
+                ('avaria', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='eventos', to='app_avarias.avaria')),
+                ('usuario', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='eventos_avaria', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'Evento da Avaria',
+                'verbose_name_plural': 'Eventos da Avaria',
+                'ordering': ['timestamp', 'id'],
+                'indexes': [models.Index(fields=['avaria', 'timestamp'], name='evento_avaria_ts_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,158 @@
+import re
+from datetime import datetime
+
+from django.db import migrations, transaction
+from django.utils import timezone
+
+BATCH_SIZE = 500
+
+# Frozen copies of the history format of the time: the migration must not
+# depend on app code that may change later.
+
+CABECALHO_REGEX = re.compile(r'^\[(\d{2}/\d{2}/\d{4} \d{2}:\d{2}) - ([^\]]*)\]', re.MULTILINE)
+
+TIPOS_POR_ROTULO = [
+    ('[DECISÃO', 'DECISAO'),
+    ('[ABERTURA]', 'ABERTURA'),
+    ('[SAÍDA DEVOLUÇÃO]', 'SAIDA_DEVOLUCAO'),
+    ('[DEVOLUÇÃO CONCLUÍDA]', 'DEVOLUCAO_CONCLUIDA'),
+    ('[EDIÇÃO DE ITENS]', 'EDICAO_ITENS'),
+    ('[AJUSTE DE VALOR]', 'AJUSTE_VALOR'),
+    ('[TRANSFERÊNCIA CD]', 'TRANSFERENCIA_CD'),
+    ('[DEFINIÇÃO DE PREJUÍZO]', 'DEFINICAO_PREJUIZO'),
+]
+
+ROTULOS = {
+    'ABERTURA': 'ABERTURA',
+    'SAIDA_DEVOLUCAO': 'SAÍDA DEVOLUÇÃO',
+    'DEVOLUCAO_CONCLUIDA': 'DEVOLUÇÃO CONCLUÍDA',
+    'EDICAO_ITENS': 'EDIÇÃO DE ITENS',
+    'AJUSTE_VALOR': 'AJUSTE DE VALOR',
+    'TRANSFERENCIA_CD': 'TRANSFERÊNCIA CD',
+    'DEFINICAO_PREJUIZO': 'DEFINIÇÃO DE PREJUÍZO',
+}
+
+
+def interpretar_texto_legado(texto, data_padrao):
+    """
+    Quebra o texto antigo em entradas [{'tipo', 'autor', 'timestamp', 'texto'}].
+    Cada entrada começa em uma linha "[dd/mm/aaaa hh:mm - usuário]"; o que vier
+    antes do primeiro cabeçalho vira uma entrada LEGADO com data_padrao.
+    """
+    texto = (texto or '').strip()
+    if not texto:
+        return []
+
+    cabecalhos = list(CABECALHO_REGEX.finditer(texto))
+    entradas = []
+    inicio = cabecalhos[0].start() if cabecalhos else len(texto)
+    if texto[:inicio].strip():
+        entradas.append({'tipo': 'LEGADO', 'autor': '', 'timestamp': data_padrao, 'texto': texto[:inicio].strip()})
+
+    for i, match in enumerate(cabecalhos):
+        fim = cabecalhos[i + 1].start() if i + 1 < len(cabecalhos) else len(texto)
+        trecho = texto[match.start():fim].strip()
+        try:
+            timestamp = timezone.make_aware(datetime.strptime(match.group(1), '%d/%m/%Y %H:%M'))
+        except ValueError:
+            timestamp = data_padrao
+        corpo = trecho[match.end() - match.start():].lstrip()
+        tipo = next((t for rotulo, t in TIPOS_POR_ROTULO if corpo.startswith(rotulo)), 'OBSERVACAO')
+        entradas.append({'tipo': tipo, 'autor': match.group(2).strip(), 'timestamp': timestamp, 'texto': trecho})
+    return entradas
+
+
+def _detalhes(evento):
+    dados = evento.dados or {}
+    if evento.tipo == 'DECISAO':
+        partes = [f"[DECISÃO: {dados.get('acao')}]"]
+        if dados.get('nf_retida') == 'SIM':
+            partes.append(f"[NF RETIDA NA CONFERÊNCIA: SIM ({dados.get('horas_retencao')}h)]")
+        else:
+            partes.append("[NF RETIDA NA CONFERÊNCIA: NÃO]")
+        if dados.get('nf_devolucao'):
+            partes.append(f"[NFD: {dados['nf_devolucao']}]")
+        if dados.get('cd'):
+            partes.append(f"[CD ARMAZENAGEM: {dados['cd']}]")
+        return ' | '.join(partes)
+
+    rotulo = f"[{ROTULOS[evento.tipo]}]" if evento.tipo in ROTULOS else ''
+    if evento.tipo == 'AJUSTE_VALOR':
+        return f"{rotulo} R$ {dados.get('valor_anterior')} → R$ {dados.get('valor_novo')} | Motivo: {dados.get('motivo', '')}"
+    if evento.tipo == 'TRANSFERENCIA_CD':
+        return f"{rotulo}\nCD de Origem: {dados.get('origem')}\nCD de Destino: {dados.get('destino')}\nObservação adicional:"
+    if evento.tipo == 'DEFINICAO_PREJUIZO':
+        return f"{rotulo} Responsável: {dados.get('responsavel')} - {dados.get('detalhes', '')}"
+    return rotulo
+
+
+def formatar_evento(evento):
+    if (evento.dados or {}).get('legado'):
+        return evento.texto
+    cabecalho = f"[{timezone.localtime(evento.timestamp):%d/%m/%Y %H:%M} - {evento.autor}]"
+    descricao = ' '.join(parte for parte in (_detalhes(evento), evento.texto) if parte)
+    return f"{cabecalho} {descricao}".strip()
+
+
+def observacoes_para_eventos(apps, schema_editor):
+    Avaria = apps.get_model('app_avarias', 'Avaria')
+    AvariaEvento = apps.get_model('app_avarias', 'AvariaEvento')
+    Usuario = apps.get_model('app_avarias', 'Usuario')
+    usuarios = dict(Usuario.objects.values_list('username', 'pk'))
+
+    ultimo_id = 0
+    while True:
+        lote = list(
+            Avaria.objects
+            .filter(pk__gt=ultimo_id)
+            .exclude(observacoes__isnull=True).exclude(observacoes='')
+            .order_by('pk')
+            .only('pk', 'observacoes', 'data_criacao')[:BATCH_SIZE]
+        )
+        if not lote:
+            break
+        # Each batch commits on its own: on a re-run after a partial failure,
+        # the avarias already migrated are skipped
+        migradas = set(
+            AvariaEvento.objects.filter(avaria_id__in=[avaria.pk for avaria in lote], dados__legado=True)
+            .values_list('avaria_id', flat=True)
+        )
+        eventos = [
+            AvariaEvento(
+                avaria_id=avaria.pk,
+                tipo=entrada['tipo'],
+                usuario_id=usuarios.get(entrada['autor']),
+                autor=entrada['autor'],
+                timestamp=entrada['timestamp'],
+                texto=entrada['texto'],
+                # The original text is kept verbatim (see formatar_evento)
+                dados={'legado': True},
+            )
+            for avaria in lote if avaria.pk not in migradas
+            for entrada in interpretar_texto_legado(avaria.observacoes, avaria.data_criacao)
+        ]
+        with transaction.atomic():
+            AvariaEvento.objects.bulk_create(eventos)
+        ultimo_id = lote[-1].pk
+
+
+def eventos_para_observacoes(apps, schema_editor):
+    Avaria = apps.get_model('app_avarias', 'Avaria')
+    AvariaEvento = apps.get_model('app_avarias', 'AvariaEvento')
+    ids = AvariaEvento.objects.values_list('avaria_id', flat=True).distinct().order_by('avaria_id')
+    for avaria_id in ids.iterator():
+        eventos = AvariaEvento.objects.filter(avaria_id=avaria_id).order_by('timestamp', 'id')
+        texto = '\n\n'.join(formatar_evento(evento) for evento in eventos)
+        Avaria.objects.filter(pk=avaria_id).update(observacoes=texto)
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('app_avarias', '0019_avariaevento'),
+    ]
+
+    operations = [
+        migrations.RunPython(observacoes_para_eventos, eventos_para_observacoes),
+    ]
@@ -0,0 +1,15 @@
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app_avarias', '0020_migrar_observacoes'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='avaria',
+            name='observacoes',
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.2.18 on 2026-10-17 19:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app_avarias', '0021_remove_avaria_observacoes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='avariafoto',
+            name='impressao',
+            field=models.ImageField(blank=True, upload_to='avarias_fotos/impressao/%Y/%m/%d/'),
+        ),
+        migrations.AddField(
+            model_name='avariafoto',
+            name='miniatura',
+            field=models.ImageField(blank=True, upload_to='avarias_fotos/miniaturas/%Y/%m/%d/'),
+        ),
+        migrations.AddField(
+            model_name='avariafoto',
+            name='processada_em',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='avariafoto',
+            name='web',
+            field=models.ImageField(blank=True, upload_to='avarias_fotos/web/%Y/%m/%d/'),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 5.2.18 on 2026-10-17 19:16
+
+import app_avarias.storage
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app_avarias', '0022_avariafoto_versoes'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='avariafoto',
+            name='arquivo',
+            field=models.ImageField(max_length=255, storage=app_avarias.storage.armazenamento_fotos, upload_to='avarias_fotos/%Y/%m/%d/'),
+        ),
+        migrations.AlterField(
+            model_name='avariafoto',
+            name='impressao',
+            field=models.ImageField(blank=True, max_length=255, storage=app_avarias.storage.armazenamento_fotos, upload_to='avarias_fotos/impressao/%Y/%m/%d/'),
+        ),
+        migrations.AlterField(
+            model_name='avariafoto',
+            name='miniatura',
+            field=models.ImageField(blank=True, max_length=255, storage=app_avarias.storage.armazenamento_fotos, upload_to='avarias_fotos/miniaturas/%Y/%m/%d/'),
+        ),
+        migrations.AlterField(
+            model_name='avariafoto',
+            name='web',
+            field=models.ImageField(blank=True, max_length=255, storage=app_avarias.storage.armazenamento_fotos, upload_to='avarias_fotos/web/%Y/%m/%d/'),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 5.2.18 on 2026-10-17 19:19
+
+import django.db.models.deletion
+import uuid
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app_avarias', '0023_avariafoto_armazenamento_por_conteudo'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UploadFoto',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('nome', models.CharField(max_length=255)),
+                ('tamanho', models.PositiveBigIntegerField()),
+                ('recebido', models.PositiveBigIntegerField(default=0)),
+                ('status', models.CharField(choices=[('ABERTO', 'Recebendo'), ('CONCLUIDO', 'Concluído')], default='ABERTO', max_length=20)),
+                ('data_criacao', models.DateTimeField(auto_now_add=True)),
+                ('data_atualizacao', models.DateTimeField(auto_now=True)),
+                ('avaria', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='uploads_foto', to='app_avarias.avaria')),
+                ('foto', models.OneToOneField(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='upload', to='app_avarias.avariafoto')),
+                ('usuario', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='uploads_foto', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'Upload de Foto',
+                'verbose_name_plural': 'Uploads de Fotos',
+            },
+        ),
+    ]
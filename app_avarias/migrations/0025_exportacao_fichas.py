@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-17 19:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app_avarias', '0024_uploadfoto'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='exportacao',
+            name='tipo',
+            field=models.CharField(choices=[('PESQUISA', 'Relatório da Pesquisa'), ('FICHAS_PDF', 'Fichas das Avarias (PDF único)'), ('FICHAS_ZIP', 'Fichas e Fotos das Avarias (ZIP)')], max_length=20),
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 5.2.18 on 2026-10-17 19:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app_avarias', '0026_sincronizacao'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='avaria',
+            name='chave_idempotencia',
+            field=models.UUIDField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddConstraint(
+            model_name='avaria',
+            constraint=models.UniqueConstraint(condition=models.Q(('chave_idempotencia__isnull', False)), fields=('criado_por', 'chave_idempotencia'), name='avaria_chave_idempotencia_unica'),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 5.2.18 on 2026-10-17 20:02
+
+import datetime
+import django.db.models.functions.comparison
+from django.db import migrations, models
+
+CHAVE = ('mes_criacao', 'mes_finalizacao', 'status', 'tipo_finalizacao', 'responsavel_prejuizo', 'cliente_id')
+
+
+def juntar_duplicadas(apps, schema_editor):
+    """Soma as linhas repetidas de uma chave na primeira delas, antes da constraint."""
+    AvariaResumoMensal = apps.get_model('app_avarias', 'AvariaResumoMensal')
+    primeiras = {}
+    for linha in AvariaResumoMensal.objects.order_by('pk').iterator():
+        chave = tuple(getattr(linha, campo) or None for campo in CHAVE)
+        primeira = primeiras.setdefault(chave, linha)
+        if primeira is linha:
+            continue
+        primeira.quantidade += linha.quantidade
+        primeira.valor_total += linha.valor_total
+        primeira.save(update_fields=['quantidade', 'valor_total'])
+        linha.delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app_avarias', '0027_avaria_chave_idempotencia'),
+    ]
+
+    operations = [
+        migrations.RunPython(juntar_duplicadas, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='avariaresumomensal',
+            constraint=models.UniqueConstraint(models.F('mes_criacao'), django.db.models.functions.comparison.Coalesce('mes_finalizacao', models.Value(datetime.date(1, 1, 1))), models.F('status'), django.db.models.functions.comparison.Coalesce('tipo_finalizacao', models.Value('')), django.db.models.functions.comparison.Coalesce('responsavel_prejuizo', models.Value('')), models.F('cliente'), name='resumo_chave_unica'),
+        ),
+    ]
@@ -1,9 +1,33 @@
+import re
+import uuid
+from datetime import date
 
 from django.db import models
+from django.db.models.functions import Coalesce
 from django.contrib.auth.models import AbstractUser
 from django.conf import settings
 from django.utils import timezone
 
+from .storage import armazenamento_fotos
+
+UFS_BRASIL = {
+    'ac': 'Acre', 'al': 'Alagoas', 'ap': 'Amapá', 'am': 'Amazonas', 'ba': 'Bahia',
+    'ce': 'Ceará', 'df': 'Distrito Federal', 'es': 'Espírito Santo', 'go': 'Goiás',
+    'ma': 'Maranhão', 'mt': 'Mato Grosso', 'ms': 'Mato Grosso do Sul', 'mg': 'Minas Gerais',
+    'pa': 'Pará', 'pb': 'Paraíba', 'pr': 'Paraná', 'pe': 'Pernambuco', 'pi': 'Piauí',
+    'rj': 'Rio de Janeiro', 'rn': 'Rio Grande do Norte', 'rs': 'Rio Grande do Sul',
+    'ro': 'Rondônia', 'rr': 'Roraima', 'sc': 'Santa Catarina', 'sp': 'São Paulo',
+    'se': 'Sergipe', 'to': 'Tocantins'
+}
+
+UF_REGEX = re.compile(r'\b(' + '|'.join(UFS_BRASIL) + r')\b')
+
+
+def extrair_uf(local_atuacao):
+    """Sigla da UF (minúscula) mencionada no texto do local de atuação, ou None."""
+    match = UF_REGEX.search((local_atuacao or "").lower())
+    return match.group(1) if match else None
+
 class Usuario(AbstractUser):
     NIVEL_ACESSO_CHOICES = (
         ('MOBILE', 'App Mobile (Operacional)'),
@@ -24,7 +48,24 @@ class Usuario(AbstractUser):
         clean_number = ''.join(filter(str.isdigit, self.telefone))
         return f"https://wa.me/55{clean_number}"
 
-class Cliente(models.Model):
+class Sincronizavel(models.Model):
+    """
+    Base dos models enviados ao app pelo /api/sync/: atualizado_em (indexado)
+    muda a cada save(), inclusive com update_fields. QuerySet.update() e
+    bulk_update() não passam por aqui e precisam informar o campo.
+    """
+    atualizado_em = models.DateTimeField(auto_now=True, db_index=True)
+
+    class Meta:
+        abstract = True
+
+    def save(self, *args, **kwargs):
+        if kwargs.get('update_fields') is not None:
+            kwargs['update_fields'] = {*kwargs['update_fields'], 'atualizado_em'}
+        super().save(*args, **kwargs)
+
+
+class Cliente(Sincronizavel):
     razao_social = models.CharField(max_length=200, verbose_name="Razão Social")
     cnpj = models.CharField(max_length=20, unique=True, verbose_name="CNPJ")
     endereco = models.TextField(blank=True, null=True, verbose_name="Endereço")
@@ -43,7 +84,7 @@ class Cliente(models.Model):
         clean_number = ''.join(filter(str.isdigit, self.telefone_contato))
         return f"https://wa.me/55{clean_number}"
 
-class Condutor(models.Model):
+class Condutor(Sincronizavel):
     nome = models.CharField(max_length=200)
     cpf = models.CharField(max_length=14, unique=True)
     telefone = models.CharField(max_length=20, blank=True, null=True)
@@ -63,7 +104,7 @@ class Condutor(models.Model):
         clean_number = ''.join(filter(str.isdigit, self.telefone))
         return f"https://wa.me/55{clean_number}"
 
-class Veiculo(models.Model):
+class Veiculo(Sincronizavel):
     TIPO_CHOICES = (
         ('PRINCIPAL', 'Veículo Principal (Cavalo/Truck)'),
         ('CARRETA', 'Carreta/Reboque'),
@@ -84,7 +125,7 @@ class Veiculo(models.Model):
     def __str__(self):
         return f"{self.placa} - {self.get_tipo_display()}"
 
-class Produto(models.Model):
+class Produto(Sincronizavel):
     nome = models.CharField(max_length=200)
     laboratorio = models.CharField(max_length=200, verbose_name="Laboratório")
     codigo_controle = models.CharField(max_length=20, unique=True, unique_for_date='data_criacao', blank=True, verbose_name="Cód. Controle")
@@ -125,7 +166,7 @@ class CentroDistribuicao(models.Model):
     def __str__(self):
         return f"{self.codigo} - {self.nome}"
 
-class Avaria(models.Model):
+class Avaria(Sincronizavel):
     STATUS_CHOICES = (
         ('EM_ABERTO', 'Em Aberto'),
         ('DECISAO', 'Em Decisão'), # Moment of decision: Keep or Return?
@@ -198,7 +239,51 @@ class Avaria(models.Model):
     lote = models.CharField(max_length=50, blank=True, null=True) # Deprecated
     valor_nf = models.DecimalField(max_digits=10, decimal_places=2, blank=True, null=True, verbose_name="Valor da NF")
     veiculo_carreta = models.ForeignKey(Veiculo, related_name='avarias_carreta', on_delete=models.SET_NULL, blank=True, null=True, verbose_name="Carreta (Opcional)")
-    observacoes = models.TextField(blank=True, null=True, verbose_name="Observações")
+    uf = models.CharField(max_length=2, blank=True, null=True, db_index=True, editable=False, verbose_name="UF") # Derived from local_atuacao
+    # Key generated by the app for each queued submission (POST /api/avarias/bulk/): a retry finds the Avaria instead of duplicating it
+    chave_idempotencia = models.UUIDField(blank=True, null=True, editable=False)
+
+    class Meta:
+        indexes = [
+            # Listagens (avaria_list, API ?status=), mais recentes primeiro; o id desempata
+            # a paginação por cursor (ver pagination.py)
+            models.Index(fields=['status', '-data_criacao', '-id'], name='avaria_status_criacao_idx'),
+            models.Index(fields=['-data_criacao', '-id'], name='avaria_criacao_idx'),
+            # Finalizadas por tipo/responsável e mês de finalização (SLA de transporte, relatórios)
+            models.Index(fields=['status', 'tipo_finalizacao', 'data_finalizacao'], name='avaria_status_final_idx'),
+            # Parciais: só as linhas "quentes", pequenas mesmo com milhões de Avarias finalizadas
+            models.Index(
+                fields=['-data_criacao', '-id'], name='avaria_aberta_idx',
+                condition=models.Q(status='EM_ABERTO'),
+            ),
+            models.Index(
+                fields=['cd_armazenagem_reversa', '-data_criacao', '-id'], name='avaria_aguardando_cd_idx',
+                condition=models.Q(status='AGUARDANDO_DEVOLUCAO'),
+            ),
+            models.Index(
+                fields=['-data_finalizacao'], name='avaria_prejuizo_pendente_idx',
+                condition=models.Q(status='FINALIZADA', tipo_finalizacao='DEVOLUCAO_CONCLUIDA', responsavel_prejuizo__isnull=True),
+            ),
+        ]
+        constraints = [
+            models.UniqueConstraint(
+                fields=['criado_por', 'chave_idempotencia'], name='avaria_chave_idempotencia_unica',
+                condition=models.Q(chave_idempotencia__isnull=False),
+            ),
+        ]
+
+    def save(self, *args, **kwargs):
+        self.uf = extrair_uf(self.local_atuacao)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'local_atuacao' in update_fields:
+            kwargs['update_fields'] = set(update_fields) | {'uf'}
+        super().save(*args, **kwargs)
+
+    @property
+    def observacoes(self):
+        """Histórico em texto, montado a partir dos eventos (ver eventos.py)."""
+        from .eventos import texto_do_historico
+        return texto_do_historico(self.eventos.all())
 
     @property
     def dias_em_aberto(self):
@@ -226,7 +311,7 @@ class Avaria(models.Model):
     def __str__(self):
         return f"Avaria {self.id} - {self.cliente}"
 
-class AvariaItem(models.Model):
+class AvariaItem(Sincronizavel):
     avaria = models.ForeignKey(Avaria, related_name='itens', on_delete=models.CASCADE)
     produto = models.ForeignKey(Produto, on_delete=models.PROTECT)
     quantidade = models.IntegerField(default=1)
@@ -235,11 +320,222 @@ class AvariaItem(models.Model):
     def __str__(self):
         return f"{self.produto.nome} (Qtd: {self.quantidade})"
 
-class AvariaFoto(models.Model):
+class AvariaFoto(Sincronizavel):
     avaria = models.ForeignKey(Avaria, related_name='fotos', on_delete=models.CASCADE)
     criado_por = models.ForeignKey(settings.AUTH_USER_MODEL, related_name='fotos_enviadas', on_delete=models.SET_NULL, null=True, blank=True)
-    arquivo = models.ImageField(upload_to='avarias_fotos/%Y/%m/%d/')
+    # Original exactly as uploaded (kept for audit)
+    # Files are stored by SHA-256, identical bytes once (see storage.py)
+    arquivo = models.ImageField(upload_to='avarias_fotos/%Y/%m/%d/', storage=armazenamento_fotos, max_length=255)
     data_upload = models.DateTimeField(auto_now_add=True)
 
+    # Renditions generated in background (see imagens.py): no EXIF, rotation applied
+    web = models.ImageField(upload_to='avarias_fotos/web/%Y/%m/%d/', storage=armazenamento_fotos, max_length=255, blank=True)
+    miniatura = models.ImageField(upload_to='avarias_fotos/miniaturas/%Y/%m/%d/', storage=armazenamento_fotos, max_length=255, blank=True)
+    impressao = models.ImageField(upload_to='avarias_fotos/impressao/%Y/%m/%d/', storage=armazenamento_fotos, max_length=255, blank=True)
+    processada_em = models.DateTimeField(null=True, blank=True)
+
     def __str__(self):
         return f"Foto {self.id} - Avaria {self.avaria.id}"
+
+    # While the renditions are not ready the original is served
+    @property
+    def url_web(self):
+        return (self.web or self.arquivo).url
+
+    @property
+    def url_miniatura(self):
+        return (self.miniatura or self.arquivo).url
+
+    @property
+    def url_impressao(self):
+        return (self.impressao or self.arquivo).url
+
+class AvariaResumoMensal(models.Model):
+    """
+    Contadores pré-agregados de Avarias para o Dashboard.
+    Uma linha por mês de criação x mês de finalização x status x tipo_finalizacao x
+    responsavel_prejuizo x cliente. Mantido incrementalmente pelos signals de Avaria
+    (ver resumo.py).
+    """
+    mes_criacao = models.DateField()
+    mes_finalizacao = models.DateField(blank=True, null=True)
+    status = models.CharField(max_length=30, choices=Avaria.STATUS_CHOICES)
+    tipo_finalizacao = models.CharField(max_length=30, choices=Avaria.TIPO_FINALIZACAO_CHOICES, blank=True, null=True)
+    responsavel_prejuizo = models.CharField(max_length=50, choices=Avaria.RESPONSAVEL_PREJUIZO_CHOICES, blank=True, null=True)
+    cliente = models.ForeignKey(Cliente, related_name='resumos_mensais', on_delete=models.CASCADE)
+
+    quantidade = models.IntegerField(default=0)
+    valor_total = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+
+    class Meta:
+        verbose_name = "Resumo Mensal de Avarias"
+        verbose_name_plural = "Resumos Mensais de Avarias"
+        indexes = [
+            models.Index(fields=['status', 'tipo_finalizacao'], name='resumo_status_tipo_idx'),
+            models.Index(fields=['mes_criacao'], name='resumo_mes_criacao_idx'),
+            models.Index(fields=['mes_finalizacao', 'tipo_finalizacao'], name='resumo_mes_final_idx'),
+        ]
+        constraints = [
+            # One row per key. NULLs are distinct in a plain unique index, so
+            # the nullable key fields are compared through Coalesce.
+            models.UniqueConstraint(
+                'mes_criacao',
+                Coalesce('mes_finalizacao', models.Value(date(1, 1, 1))),
+                'status',
+                Coalesce('tipo_finalizacao', models.Value('')),
+                Coalesce('responsavel_prejuizo', models.Value('')),
+                'cliente',
+                name='resumo_chave_unica',
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.mes_criacao:%m/%Y} - {self.status} ({self.quantidade})"
+
+
+class AvariaBusca(models.Model):
+    """
+    Documento de busca desnormalizado (NF, cliente, produtos, placas, motorista)
+    de cada Avaria. Mantido por signals (ver search.py); no SQLite é espelhado
+    em uma tabela FTS5 com tokenizer trigram, no PostgreSQL tem índice pg_trgm.
+    """
+    avaria = models.OneToOneField(Avaria, related_name='busca', on_delete=models.CASCADE, primary_key=True)
+    documento = models.TextField()
+
+    class Meta:
+        verbose_name = "Documento de Busca"
+        verbose_name_plural = "Documentos de Busca"
+
+    def __str__(self):
+        return f"Busca Avaria {self.avaria_id}"
+
+
+class Exportacao(models.Model):
+    """Relatório/arquivo gerado em segundo plano (ver relatorios.py)."""
+    TIPO_CHOICES = (
+        ('PESQUISA', 'Relatório da Pesquisa'),
+        ('FICHAS_PDF', 'Fichas das Avarias (PDF único)'),
+        ('FICHAS_ZIP', 'Fichas e Fotos das Avarias (ZIP)'),
+    )
+    STATUS_CHOICES = (
+        ('PENDENTE', 'Na Fila'),
+        ('PROCESSANDO', 'Processando'),
+        ('CONCLUIDA', 'Concluída'),
+        ('ERRO', 'Erro'),
+    )
+
+    usuario = models.ForeignKey(settings.AUTH_USER_MODEL, related_name='exportacoes', on_delete=models.CASCADE)
+    tipo = models.CharField(max_length=20, choices=TIPO_CHOICES)
+    parametros = models.JSONField(default=dict, blank=True)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='PENDENTE')
+    total = models.IntegerField(default=0)
+    processados = models.IntegerField(default=0)
+    arquivo = models.FileField(upload_to='exportacoes/%Y/%m/', blank=True, null=True)
+    erro = models.TextField(blank=True, null=True)
+    data_criacao = models.DateTimeField(auto_now_add=True)
+    data_conclusao = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        verbose_name = "Exportação"
+        verbose_name_plural = "Exportações"
+        ordering = ['-data_criacao']
+
+    def __str__(self):
+        return f"{self.get_tipo_display()} #{self.id} ({self.get_status_display()})"
+
+    @property
+    def progresso(self):
+        if self.status == 'CONCLUIDA':
+            return 100
+        return int(self.processados * 100 / self.total) if self.total else 0
+
+
+class UploadFoto(models.Model):
+    """
+    Envio de foto em partes (app mobile), que pode ser retomado após queda de
+    conexão. As partes vão direto para um arquivo parcial em disco; ao finalizar,
+    com o SHA-256 conferido, vira uma AvariaFoto (ver uploads.py).
+    """
+    STATUS_CHOICES = (
+        ('ABERTO', 'Recebendo'),
+        ('CONCLUIDO', 'Concluído'),
+    )
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    avaria = models.ForeignKey(Avaria, related_name='uploads_foto', on_delete=models.CASCADE)
+    usuario = models.ForeignKey(settings.AUTH_USER_MODEL, related_name='uploads_foto', on_delete=models.CASCADE)
+    nome = models.CharField(max_length=255)
+    tamanho = models.PositiveBigIntegerField()
+    recebido = models.PositiveBigIntegerField(default=0)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='ABERTO')
+    foto = models.OneToOneField('AvariaFoto', related_name='upload', on_delete=models.SET_NULL, null=True, blank=True)
+    data_criacao = models.DateTimeField(auto_now_add=True)
+    data_atualizacao = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name = "Upload de Foto"
+        verbose_name_plural = "Uploads de Fotos"
+
+    def __str__(self):
+        return f"Upload {self.id} - Avaria {self.avaria_id} ({self.recebido}/{self.tamanho})"
+
+
+class AvariaEvento(models.Model):
+    """
+    Entrada do histórico de uma Avaria (append-only). Substitui o antigo campo
+    de texto observacoes: cada ação é um INSERT, sem reescrever a Avaria.
+    """
+    TIPO_CHOICES = (
+        ('ABERTURA', 'Abertura'),
+        ('OBSERVACAO', 'Observação'),
+        ('DECISAO', 'Decisão'),
+        ('SAIDA_DEVOLUCAO', 'Saída Devolução'),
+        ('DEVOLUCAO_CONCLUIDA', 'Devolução Concluída'),
+        ('EDICAO_ITENS', 'Edição de Itens'),
+        ('AJUSTE_VALOR', 'Ajuste de Valor'),
+        ('TRANSFERENCIA_CD', 'Transferência CD'),
+        ('DEFINICAO_PREJUIZO', 'Definição de Prejuízo'),
+        ('LEGADO', 'Histórico Anterior'), # Trechos do texto antigo sem cabeçalho reconhecível
+    )
+
+    avaria = models.ForeignKey(Avaria, related_name='eventos', on_delete=models.CASCADE)
+    tipo = models.CharField(max_length=30, choices=TIPO_CHOICES)
+    usuario = models.ForeignKey(settings.AUTH_USER_MODEL, related_name='eventos_avaria', on_delete=models.SET_NULL, null=True, blank=True)
+    autor = models.CharField(max_length=150, blank=True, default='') # Username na data do evento
+    timestamp = models.DateTimeField(default=timezone.now)
+    texto = models.TextField(blank=True, default='')
+    dados = models.JSONField(default=dict, blank=True)
+
+    class Meta:
+        verbose_name = "Evento da Avaria"
+        verbose_name_plural = "Eventos da Avaria"
+        ordering = ['timestamp', 'id']
+        indexes = [
+            models.Index(fields=['avaria', 'timestamp'], name='evento_avaria_ts_idx'),
+            models.Index(fields=['timestamp'], name='evento_ts_idx'),  # /api/sync/
+        ]
+
+    def __str__(self):
+        return f"{self.get_tipo_display()} - Avaria {self.avaria_id}"
+
+    @property
+    def descricao(self):
+        from .eventos import descrever_evento
+        return descrever_evento(self)
+
+
+class RegistroExcluido(models.Model):
+    """
+    Marca de exclusão (tombstone) de um registro sincronizado com o app, para o
+    /api/sync/ avisar que ele sumiu. Gravada pelos signals de post_delete.
+    """
+    modelo = models.CharField(max_length=50)
+    objeto_id = models.IntegerField()
+    excluido_em = models.DateTimeField(default=timezone.now, db_index=True)
+
+    class Meta:
+        verbose_name = "Registro Excluído"
+        verbose_name_plural = "Registros Excluídos"
+
+    def __str__(self):
+        return f"{self.modelo} #{self.objeto_id} ({self.excluido_em:%d/%m/%Y %H:%M})"
@@ -0,0 +1,112 @@
+"""
+Paginação por cursor (keyset) para listagens ordenadas por (-data_criacao, -id).
+
+Em vez de OFFSET, cada página parte do último (ou primeiro) registro da página
+anterior: WHERE (data_criacao, id) < (cursor) ORDER BY -data_criacao, -id LIMIT n.
+Com o índice certo o custo é o mesmo na primeira página ou na milésima, e a
+página não "pula" registros quando novas Avarias são criadas no meio da navegação.
+"""
+import base64
+import binascii
+import json
+from datetime import datetime
+
+from django.db.models import Q
+
+PAGE_SIZE_PADRAO = 50
+PAGE_SIZE_MAXIMO = 500
+
+PROXIMA = 'p'
+ANTERIOR = 'a'
+
+
+class CursorInvalido(ValueError):
+    pass
+
+
+def codificar_cursor(avaria, direcao):
+    dados = {'d': avaria.data_criacao.isoformat(), 'id': avaria.pk, 'dir': direcao}
+    return base64.urlsafe_b64encode(json.dumps(dados).encode()).decode().rstrip('=')
+
+
+def decodificar_cursor(token):
+    try:
+        bruto = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        dados = json.loads(bruto)
+        return datetime.fromisoformat(dados['d']), int(dados['id']), dados['dir']
+    except (binascii.Error, UnicodeDecodeError, ValueError, KeyError, TypeError) as exc:
+        raise CursorInvalido(token) from exc
+
+
+def tamanho_da_pagina(valor):
+    """page_size vindo da querystring, limitado a PAGE_SIZE_MAXIMO."""
+    try:
+        tamanho = int(valor)
+    except (TypeError, ValueError):
+        return PAGE_SIZE_PADRAO
+    return max(1, min(tamanho, PAGE_SIZE_MAXIMO))
+
+
+class PaginaCursor:
+    """Uma página da listagem, com os tokens para a próxima e a anterior."""
+
+    def __init__(self, itens, proximo_cursor=None, cursor_anterior=None, page_size=PAGE_SIZE_PADRAO):
+        self.itens = itens
+        self.proximo_cursor = proximo_cursor
+        self.cursor_anterior = cursor_anterior
+        self.page_size = page_size
+
+    @property
+    def tem_proxima(self):
+        return self.proximo_cursor is not None
+
+    @property
+    def tem_anterior(self):
+        return self.cursor_anterior is not None
+
+    def __iter__(self):
+        return iter(self.itens)
+
+    def __len__(self):
+        return len(self.itens)
+
+
+def paginar_por_cursor(queryset, cursor=None, page_size=PAGE_SIZE_PADRAO):
+    """
+    Pagina queryset por (-data_criacao, -id). Um cursor inválido volta para a
+    primeira página em vez de gerar erro (links antigos continuam funcionando).
+    """
+    direcao, chave = PROXIMA, None
+    if cursor:
+        try:
+            data, pk, direcao = decodificar_cursor(cursor)
+            chave = (data, pk)
+        except CursorInvalido:
+            direcao = PROXIMA
+
+    if chave and direcao == ANTERIOR:
+        data, pk = chave
+        qs = queryset.filter(Q(data_criacao__gt=data) | Q(data_criacao=data, id__gt=pk)).order_by('data_criacao', 'id')
+        itens = list(qs[:page_size + 1])
+        mais = len(itens) > page_size
+        if not itens:
+            # Nada mais recente que o cursor: volta para o início
+            return paginar_por_cursor(queryset, None, page_size)
+        itens = itens[:page_size][::-1]
+        tem_anterior, tem_proxima = mais, True
+    else:
+        qs = queryset.order_by('-data_criacao', '-id')
+        if chave:
+            data, pk = chave
+            qs = qs.filter(Q(data_criacao__lt=data) | Q(data_criacao=data, id__lt=pk))
+        itens = list(qs[:page_size + 1])
+        tem_proxima = len(itens) > page_size
+        itens = itens[:page_size]
+        tem_anterior = chave is not None
+
+    return PaginaCursor(
+        itens,
+        proximo_cursor=codificar_cursor(itens[-1], PROXIMA) if itens and tem_proxima else None,
+        cursor_anterior=codificar_cursor(itens[0], ANTERIOR) if itens and tem_anterior else None,
+        page_size=page_size,
+    )
@@ -0,0 +1,292 @@
+"""
+Ficha da Avaria em PDF (reportlab), com cache em disco.
+
+dados_da_ficha() lê tudo o que vai no PDF (Avaria com os relacionados, itens,
+histórico e fotos) em poucas queries e devolve só textos e nomes de arquivo.
+O SHA-256 desses dados é a assinatura da ficha: qualquer mudança na Avaria,
+nos itens, no histórico, nas fotos ou nos cadastros ligados a ela (cliente,
+veículo, motorista...) muda a assinatura. O PDF é guardado em PDF_CACHE_DIR com
+a assinatura no nome e só é gerado de novo quando ela muda.
+
+As fotos entram pela versão de impressão (imagens.py); foto ainda sem versão é
+reduzida na hora, para o PDF nunca carregar o original da câmera.
+
+gerar_pdf_de_varias() junta várias fichas (sem fotos) em um único PDF, para a
+exportação em lote da Pesquisa Avançada (relatorios.py).
+"""
+import glob
+import hashlib
+import json
+import os
+import tempfile
+from io import BytesIO
+from xml.sax.saxutils import escape
+
+from django.conf import settings
+from django.utils import timezone
+from reportlab.lib import colors
+from reportlab.lib.pagesizes import A4
+from reportlab.lib.styles import getSampleStyleSheet
+from reportlab.lib.units import mm
+from reportlab.lib.utils import ImageReader
+from reportlab.platypus import Image, PageBreak, Paragraph, SimpleDocTemplate, Spacer, Table, TableStyle
+
+from . import imagens
+from .eventos import formatar_evento
+
+# Bump when the layout changes, so cached PDFs are regenerated
+VERSAO_LAYOUT = 1
+
+LARGURA_UTIL = A4[0] - 30 * mm
+LADO_FOTO = 85 * mm
+
+
+def _pasta():
+    return getattr(settings, 'PDF_CACHE_DIR', os.path.join(settings.BASE_DIR, 'cache_pdf'))
+
+
+def _data(valor):
+    return timezone.localtime(valor).strftime('%d/%m/%Y %H:%M') if valor else '-'
+
+
+def _texto(valor, padrao='-'):
+    return str(valor) if valor not in (None, '') else padrao
+
+
+# --- Dados e assinatura ---
+
+def dados_da_ficha(avaria, com_fotos):
+    """Tudo o que a ficha mostra, como textos (base da assinatura e do PDF)."""
+    from .models import Avaria
+
+    a = (
+        Avaria.objects.select_related(
+            'cliente', 'produto', 'criado_por', 'veiculo', 'veiculo_carreta', 'motorista',
+            'cd_armazenagem_reversa', 'veiculo_devolucao', 'veiculo_devolucao_carreta', 'motorista_devolucao',
+        ).get(pk=avaria.pk)
+    )
+    itens = [
+        [item.produto.nome, item.produto.laboratorio, _texto(item.lote), str(item.quantidade)]
+        for item in a.itens.select_related('produto').order_by('id')
+    ]
+    if not itens and a.produto_id:
+        itens = [[a.produto.nome, a.produto.laboratorio, _texto(a.lote), _texto(a.quantidade, '0')]]
+
+    transporte = [
+        ['Veículo', f"{a.veiculo.placa} {a.veiculo.modelo or ''}".strip() if a.veiculo else '-'],
+        ['Propriedade', (
+            f"Terceiro: {_texto(a.veiculo.transportadora_nome)} {a.veiculo.transportadora_cnpj or ''}".strip()
+            if a.veiculo and a.veiculo.propriedade == 'TERCEIRO' else 'Frota Própria'
+        )],
+        ['Carreta', a.veiculo_carreta.placa if a.veiculo_carreta else '-'],
+        ['Motorista', f"{a.motorista.nome} (CPF: {a.motorista.cpf})" if a.motorista else '-'],
+    ]
+    if a.cd_armazenagem_reversa:
+        cd = a.cd_armazenagem_reversa
+        local = f"{cd.cidade or ''}{'/' + cd.estado if cd.estado else ''}"
+        transporte.append(['CD Armazenagem', f"{cd.codigo} - {cd.nome} {local}".strip()])
+
+    resolucao = []
+    if a.status != 'EM_ABERTO':
+        resolucao = [
+            ['Ação', a.get_acao_display() or a.get_tipo_finalizacao_display() or '-'],
+            ['Finalização', _data(a.data_finalizacao)],
+            ['NF Devolução', _texto(a.nf_devolucao)],
+        ]
+        if a.status == 'FINALIZADA':
+            resolucao.append(['Tipo', _texto(a.get_tipo_finalizacao_display())])
+        if a.motorista_devolucao:
+            resolucao += [
+                ['Veículo Devolução', a.veiculo_devolucao.placa if a.veiculo_devolucao else '-'],
+                ['Carreta Devolução', a.veiculo_devolucao_carreta.placa if a.veiculo_devolucao_carreta else '-'],
+                ['Motorista Devolução', f"{a.motorista_devolucao.nome} (CPF: {a.motorista_devolucao.cpf})"],
+            ]
+
+    fotos = []
+    if com_fotos:
+        for foto in a.fotos.select_related('criado_por').order_by('criado_por', '-data_upload'):
+            fotos.append({
+                'arquivo': (foto.impressao or foto.arquivo).name,
+                'reduzir': not foto.impressao,
+                'legenda': f"{foto.criado_por.username if foto.criado_por else '-'} - {_data(foto.data_upload)}",
+            })
+
+    return {
+        'versao': VERSAO_LAYOUT,
+        'id': a.pk,
+        'criacao': _data(a.data_criacao),
+        'status': a.get_status_display(),
+        'local': _texto(a.local_atuacao),
+        'dados': [
+            ['Cliente', f"{a.cliente.razao_social} ({a.cliente.cnpj})"],
+            ['Nota Fiscal', a.nota_fiscal],
+            ['Valor NF', f"R$ {a.valor_nf if a.valor_nf is not None else '0,00'}"],
+            ['Registrado por', a.criado_por.get_full_name() or a.criado_por.username],
+        ],
+        'itens': itens,
+        'transporte': transporte,
+        'resolucao': resolucao,
+        'historico': [formatar_evento(evento) for evento in a.eventos.all()],
+        'fotos': fotos,
+    }
+
+
+def assinatura(dados):
+    return hashlib.sha256(json.dumps(dados, sort_keys=True, ensure_ascii=False).encode()).hexdigest()
+
+
+# --- Renderização ---
+
+def _paragrafo(texto, estilo):
+    # Helvetica only covers Latin-1: replace the few symbols the history uses
+    texto = escape(str(texto)).replace('→', '-&gt;').replace('\n', '<br/>')
+    return Paragraph(texto, estilo)
+
+
+def _tabela_chave_valor(linhas, estilos):
+    tabela = Table(
+        [[_paragrafo(chave, estilos['rotulo']), _paragrafo(valor, estilos['texto'])] for chave, valor in linhas],
+        colWidths=[40 * mm, LARGURA_UTIL - 40 * mm],
+    )
+    tabela.setStyle(TableStyle([
+        ('GRID', (0, 0), (-1, -1), 0.25, colors.grey),
+        ('BACKGROUND', (0, 0), (0, -1), colors.whitesmoke),
+        ('VALIGN', (0, 0), (-1, -1), 'TOP'),
+    ]))
+    return tabela
+
+
+def _imagem_da_foto(foto):
+    from .models import AvariaFoto
+
+    armazenamento = AvariaFoto._meta.get_field('arquivo').storage
+    with armazenamento.open(foto['arquivo'], 'rb') as arquivo:
+        if foto['reduzir']:
+            lado, qualidade = imagens.VERSOES['impressao']
+            conteudo = BytesIO(imagens.gerar_versao(imagens.abrir_imagem(arquivo), lado, qualidade))
+        else:
+            conteudo = BytesIO(arquivo.read())
+    largura, altura = ImageReader(conteudo).getSize()
+    escala = min(LADO_FOTO / largura, LADO_FOTO / altura)
+    conteudo.seek(0)
+    return Image(conteudo, width=largura * escala, height=altura * escala)
+
+
+def _estilos():
+    base = getSampleStyleSheet()
+    return {
+        'titulo': base['Title'],
+        'secao': base['Heading3'],
+        'texto': base['BodyText'],
+        'rotulo': base['BodyText'].clone('rotulo', fontName='Helvetica-Bold'),
+        'pequeno': base['BodyText'].clone('pequeno', fontSize=7, leading=9),
+    }
+
+
+def _elementos_da_ficha(dados, estilos):
+    historia = [
+        _paragrafo(f"Ficha de Avaria #{dados['id']}", estilos['titulo']),
+        _paragrafo(
+            f"Data de Criação: {dados['criacao']} | Status: {dados['status']} | Local: {dados['local']}",
+            estilos['texto'],
+        ),
+        Spacer(1, 4 * mm),
+        _paragrafo("Dados da Ocorrência", estilos['secao']),
+        _tabela_chave_valor(dados['dados'], estilos),
+        _paragrafo("Itens", estilos['secao']),
+    ]
+
+    cabecalho = ['Produto', 'Laboratório', 'Lote', 'Qtd']
+    itens = Table(
+        [[_paragrafo(c, estilos['rotulo']) for c in cabecalho]]
+        + [[_paragrafo(v, estilos['texto']) for v in item] for item in dados['itens'] or [['-', '-', '-', '0']]],
+        colWidths=[LARGURA_UTIL * 0.45, LARGURA_UTIL * 0.3, LARGURA_UTIL * 0.15, LARGURA_UTIL * 0.1],
+        repeatRows=1,
+    )
+    itens.setStyle(TableStyle([
+        ('GRID', (0, 0), (-1, -1), 0.25, colors.grey),
+        ('BACKGROUND', (0, 0), (-1, 0), colors.whitesmoke),
+    ]))
+    historia += [itens, _paragrafo("Transporte", estilos['secao']), _tabela_chave_valor(dados['transporte'], estilos)]
+
+    if dados['resolucao']:
+        historia += [_paragrafo("Resolução", estilos['secao']), _tabela_chave_valor(dados['resolucao'], estilos)]
+
+    historia.append(_paragrafo("Histórico", estilos['secao']))
+    for linha in dados['historico'] or ["Sem observações."]:
+        historia.append(_paragrafo(linha, estilos['texto']))
+
+    if dados['fotos']:
+        historia.append(_paragrafo("Evidências (Fotos)", estilos['secao']))
+        celulas = [
+            [_imagem_da_foto(foto), _paragrafo(foto['legenda'], estilos['pequeno'])]
+            for foto in dados['fotos']
+        ]
+        if len(celulas) % 2:
+            celulas.append('')
+        grade = Table([celulas[i:i + 2] for i in range(0, len(celulas), 2)], colWidths=[LARGURA_UTIL / 2] * 2)
+        grade.setStyle(TableStyle([('VALIGN', (0, 0), (-1, -1), 'TOP'), ('ALIGN', (0, 0), (-1, -1), 'CENTER')]))
+        historia.append(grade)
+    return historia
+
+
+def _construir(destino, titulo, historia, estilos):
+    historia += [
+        Spacer(1, 6 * mm),
+        _paragrafo(f"Gerado por Sistema Transbirday Avarias em {_data(timezone.now())}", estilos['pequeno']),
+    ]
+    SimpleDocTemplate(
+        destino, pagesize=A4, title=titulo,
+        leftMargin=15 * mm, rightMargin=15 * mm, topMargin=15 * mm, bottomMargin=15 * mm,
+    ).build(historia)
+
+
+def gerar_pdf(dados):
+    """Bytes do PDF da ficha a partir de dados_da_ficha()."""
+    estilos = _estilos()
+    saida = BytesIO()
+    _construir(saida, f"Avaria #{dados['id']}", _elementos_da_ficha(dados, estilos), estilos)
+    return saida.getvalue()
+
+
+def gerar_pdf_de_varias(fichas, destino, titulo="Fichas de Avarias"):
+    """
+    Um PDF com as fichas (iterável de dados_da_ficha()), uma a partir de cada
+    página, gravado em destino (arquivo aberto em modo binário).
+    """
+    estilos = _estilos()
+    historia = []
+    for dados in fichas:
+        if historia:
+            historia.append(PageBreak())
+        historia += _elementos_da_ficha(dados, estilos)
+    if not historia:
+        historia.append(_paragrafo("Nenhuma Avaria encontrada.", estilos['texto']))
+    _construir(destino, titulo, historia, estilos)
+
+
+# --- Cache ---
+
+def pdf_da_avaria(avaria, com_fotos):
+    """(caminho, assinatura) do PDF da ficha, gerando-o só se a assinatura mudou."""
+    dados = dados_da_ficha(avaria, com_fotos)
+    chave = assinatura(dados)
+    prefixo = f"avaria_{avaria.pk}_{'fotos' if com_fotos else 'simples'}_"
+    caminho = os.path.join(_pasta(), f"{prefixo}{chave}.pdf")
+    if os.path.exists(caminho):
+        return caminho, chave
+
+    os.makedirs(_pasta(), exist_ok=True)
+    conteudo = gerar_pdf(dados)
+    with tempfile.NamedTemporaryFile('wb', dir=_pasta(), suffix='.tmp', delete=False) as tmp:
+        tmp.write(conteudo)
+    os.replace(tmp.name, caminho)
+
+    # Older versions of this Avaria's PDF are no longer reachable
+    for antigo in glob.glob(os.path.join(glob.escape(_pasta()), f"{prefixo}*.pdf")):
+        if antigo != caminho:
+            try:
+                os.remove(antigo)
+            except FileNotFoundError:
+                pass
+    return caminho, chave
@@ -0,0 +1,175 @@
+"""
+Planilhas (CSV e XLSX) transmitidas em partes.
+
+As linhas chegam de um iterável (normalmente values_list().iterator()) e são
+enviadas em blocos de ~TAMANHO_BLOCO bytes: a memória usada não depende do
+número de linhas.
+
+O CSV sai no formato que o Excel em português abre direto (UTF-8 com BOM,
+separador ";" e vírgula decimal). O XLSX é montado aqui mesmo, com zipfile e
+uma única planilha sem estilos (textos inline), porque as bibliotecas de
+planilha montam o arquivo inteiro em memória antes de gravar.
+"""
+import csv
+import re
+import zipfile
+from datetime import date, datetime
+from decimal import Decimal
+from itertools import chain
+from xml.sax.saxutils import escape
+
+from django.http import StreamingHttpResponse
+from django.utils import timezone
+from django.utils.http import content_disposition_header
+
+TAMANHO_BLOCO = 64 * 1024
+
+FORMATOS = {
+    'csv': 'text/csv; charset=utf-8',
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+}
+
+
+def _texto(valor):
+    if valor is None:
+        return ''
+    if isinstance(valor, datetime):
+        if timezone.is_aware(valor):
+            valor = timezone.localtime(valor)
+        return valor.strftime('%d/%m/%Y %H:%M')
+    if isinstance(valor, date):
+        return valor.strftime('%d/%m/%Y')
+    return str(valor)
+
+
+# --- CSV ---
+
+class _Eco:
+    """Arquivo falso para o csv.writer: write() só devolve a linha."""
+
+    def write(self, valor):
+        return valor
+
+
+def _celula_csv(valor):
+    if isinstance(valor, Decimal):
+        return f'{valor:.2f}'.replace('.', ',')
+    return _texto(valor)
+
+
+def linhas_csv(cabecalho, linhas):
+    escritor = csv.writer(_Eco(), delimiter=';')
+    bloco = ['\ufeff', escritor.writerow(cabecalho)]
+    tamanho = 0
+    for linha in linhas:
+        texto = escritor.writerow([_celula_csv(valor) for valor in linha])
+        bloco.append(texto)
+        tamanho += len(texto)
+        if tamanho >= TAMANHO_BLOCO:
+            yield ''.join(bloco).encode('utf-8')
+            bloco, tamanho = [], 0
+    yield ''.join(bloco).encode('utf-8')
+
+
+# --- XLSX ---
+
+PARTES_XLSX = {
+    '[Content_Types].xml': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/xl/workbook.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+        '<Override PartName="/xl/worksheets/sheet1.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+        '</Types>'
+    ),
+    '_rels/.rels': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Target="xl/workbook.xml" '
+        'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument"/>'
+        '</Relationships>'
+    ),
+    'xl/workbook.xml': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+        'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+        '<sheets><sheet name="Dados" sheetId="1" r:id="rId1"/></sheets>'
+        '</workbook>'
+    ),
+    'xl/_rels/workbook.xml.rels': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Target="worksheets/sheet1.xml" '
+        'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet"/>'
+        '</Relationships>'
+    ),
+}
+
+INICIO_FOLHA = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>'
+)
+FIM_FOLHA = '</sheetData></worksheet>'
+
+# Control characters are not allowed in XML 1.0
+CARACTERES_INVALIDOS = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+
+class _Saida:
+    """Destino do zipfile sem seek: acumula os bytes até o próximo yield."""
+
+    def __init__(self):
+        self.partes = []
+        self.tamanho = 0
+
+    def write(self, dados):
+        self.partes.append(bytes(dados))
+        self.tamanho += len(dados)
+        return len(dados)
+
+    def flush(self):
+        pass
+
+    def esvaziar(self):
+        dados = b''.join(self.partes)
+        self.partes, self.tamanho = [], 0
+        return dados
+
+
+def _celula_xlsx(valor):
+    if valor is None or valor == '':
+        return '<c/>'
+    if isinstance(valor, (int, float, Decimal)) and not isinstance(valor, bool):
+        return f'<c><v>{valor}</v></c>'
+    texto = escape(CARACTERES_INVALIDOS.sub('', _texto(valor)))
+    return f'<c t="inlineStr"><is><t xml:space="preserve">{texto}</t></is></c>'
+
+
+def linhas_xlsx(cabecalho, linhas):
+    saida = _Saida()
+    with zipfile.ZipFile(saida, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for nome, conteudo in PARTES_XLSX.items():
+            zf.writestr(nome, conteudo)
+        # Size unknown in advance: zip64 so sheets above 2 GB are still valid
+        with zf.open('xl/worksheets/sheet1.xml', 'w', force_zip64=True) as folha:
+            folha.write(INICIO_FOLHA.encode('utf-8'))
+            for numero, linha in enumerate(chain([cabecalho], linhas), 1):
+                celulas = ''.join(_celula_xlsx(valor) for valor in linha)
+                folha.write(f'<row r="{numero}">{celulas}</row>'.encode('utf-8'))
+                if saida.tamanho >= TAMANHO_BLOCO:
+                    yield saida.esvaziar()
+            folha.write(FIM_FOLHA.encode('utf-8'))
+    yield saida.esvaziar()
+
+
+GERADORES = {'csv': linhas_csv, 'xlsx': linhas_xlsx}
+
+
+def resposta_planilha(formato, nome, cabecalho, linhas):
+    """StreamingHttpResponse com a planilha (formato 'csv' ou 'xlsx') para download."""
+    resposta = StreamingHttpResponse(GERADORES[formato](cabecalho, linhas), content_type=FORMATOS[formato])
+    resposta['Content-Disposition'] = content_disposition_header(True, f'{nome}.{formato}')
+    return resposta
@@ -0,0 +1,345 @@
+"""
+Relatórios da Pesquisa Avançada.
+
+A versão para impressão é gerada em partes (cabeçalho, blocos de linhas,
+rodapé) e enviada como StreamingHttpResponse: o queryset é lido com
+iterator(chunk_size=...) e nunca fica inteiro em memória. Acima de
+LIMITE_IMPRESSAO registros o navegador não recebe o relatório; o usuário pode
+pedir uma Exportacao, gerada em segundo plano no mesmo formato. As que ficam
+paradas por EXPORTACAO_HORAS_LIMITE (o processo reiniciou no meio) passam a
+ERRO ao abrir a página ou com o comando marcar_exportacoes_interrompidas.
+
+As fichas dos resultados também podem ser exportadas em lote: um PDF único
+(FICHAS_PDF) ou um ZIP com o PDF e as fotos de cada Avaria (FICHAS_ZIP). O
+arquivo é gravado em disco aos poucos e baixado com suporte a Range
+(downloads.py).
+
+As planilhas (CSV/XLSX) da pesquisa e dos prejuízos do Dashboard têm uma linha
+por item da Avaria e são lidas com values_list().iterator(), sem instanciar
+models, e transmitidas direto ao navegador (planilhas.py).
+"""
+import logging
+import os
+import shutil
+import tempfile
+import zipfile
+from datetime import datetime, time, timedelta
+
+from django.conf import settings
+from django.core.files import File
+from django.db import transaction
+from django.db.models import F
+from django.db.models.functions import Coalesce, TruncMonth, TruncYear
+from django.template.loader import render_to_string
+from django.utils import timezone
+
+from . import pdf
+from .dashboard import DashboardStats, financial_windows
+from .models import Avaria, Exportacao
+from .search import filtrar_pesquisa
+from .tasks import run_in_background
+
+logger = logging.getLogger(__name__)
+
+LIMITE_IMPRESSAO = getattr(settings, 'RELATORIO_LIMITE_IMPRESSAO', 5000)
+TAMANHO_LOTE = 500
+LIMITE_FICHAS_PDF = getattr(settings, 'RELATORIO_LIMITE_FICHAS_PDF', 300)
+EXPORTACAO_HORAS_LIMITE = getattr(settings, 'EXPORTACAO_HORAS_LIMITE', 6)
+
+# Filtros da Pesquisa Avançada que definem o relatório (print/autoprint são só de exibição)
+PARAMETROS_PESQUISA = ('q', 'status', 'data_ini', 'data_fim', 'nf', 'nfd', 'placa', 'cpf', 'motorista', 'local')
+
+
+def parametros_da_pesquisa(params):
+    return {chave: params[chave] for chave in PARAMETROS_PESQUISA if params.get(chave)}
+
+
+def _em_lotes(avarias, tamanho=TAMANHO_LOTE):
+    lote = []
+    for avaria in avarias.iterator(chunk_size=tamanho):
+        lote.append(avaria)
+        if len(lote) == tamanho:
+            yield lote
+            lote = []
+    if lote:
+        yield lote
+
+
+def relatorio_pesquisa_html(avarias, total, usuario, autoprint=False, ao_processar=None):
+    """
+    Gera o HTML do relatório em pedaços. avarias deve trazer select_related/
+    prefetch_related (iterator() com chunk_size respeita o prefetch por lote).
+    ao_processar(n) é chamado após cada lote com o total já gerado.
+    """
+    contexto = {'total': total, 'usuario': usuario, 'now': timezone.now(), 'autoprint': autoprint}
+    yield render_to_string('app_avarias/avaria_search_print_inicio.html', contexto)
+
+    processados = 0
+    for lote in _em_lotes(avarias):
+        yield render_to_string('app_avarias/avaria_search_print_linhas.html', {'avarias': lote})
+        processados += len(lote)
+        if ao_processar:
+            ao_processar(processados)
+
+    yield render_to_string('app_avarias/avaria_search_print_fim.html', contexto)
+
+
+def solicitar_exportacao(usuario, params, tipo='PESQUISA'):
+    """Cria a Exportacao e agenda a geração para depois do commit."""
+    exportacao = Exportacao.objects.create(
+        usuario=usuario, tipo=tipo, parametros=parametros_da_pesquisa(params),
+    )
+    transaction.on_commit(lambda: run_in_background(gerar_exportacao, exportacao.pk, queue='exports'))
+    return exportacao
+
+
+def gerar_exportacao(exportacao_id):
+    """Gera a exportação pelo seu tipo; qualquer erro a deixa em ERRO, com a mensagem."""
+    try:
+        tipo = Exportacao.objects.values_list('tipo', flat=True).get(pk=exportacao_id)
+        GERADORES[tipo](exportacao_id)
+    except Exception as exc:
+        logger.exception("Erro ao gerar a exportação %s", exportacao_id)
+        Exportacao.objects.filter(pk=exportacao_id).update(status='ERRO', erro=str(exc))
+
+
+def marcar_exportacoes_interrompidas(exportacoes=None, horas=None):
+    """
+    Marca como ERRO as exportações na fila ou em processamento há mais de
+    horas (EXPORTACAO_HORAS_LIMITE): as tarefas vivem só na memória do
+    processo, e uma reinicialização as perde. Devolve quantas foram marcadas.
+    """
+    horas = EXPORTACAO_HORAS_LIMITE if horas is None else horas
+    exportacoes = Exportacao.objects.all() if exportacoes is None else exportacoes
+    return exportacoes.filter(
+        status__in=('PENDENTE', 'PROCESSANDO'), data_criacao__lt=timezone.now() - timedelta(hours=horas),
+    ).update(status='ERRO', erro="A geração foi interrompida. Solicite a exportação novamente.")
+
+
+def _gerar_exportacao(exportacao_id, avarias, escrever, nome):
+    """
+    Grava a exportação em um arquivo temporário com escrever(tmp, total,
+    ao_processar) e só depois a copia para exportacao.arquivo; o progresso é atualizado a
+    cada chamada de ao_processar(n). Os erros ficam para gerar_exportacao().
+    """
+    exportacao = Exportacao.objects.get(pk=exportacao_id)
+    exportacao.status = 'PROCESSANDO'
+    exportacao.total = avarias.count()
+    exportacao.save(update_fields=['status', 'total'])
+
+    def ao_processar(processados):
+        Exportacao.objects.filter(pk=exportacao_id).update(processados=processados)
+
+    tmp = tempfile.NamedTemporaryFile('w+b', suffix=os.path.splitext(nome)[1], delete=False)
+    try:
+        with tmp:
+            escrever(tmp, exportacao.total, ao_processar)
+        with open(tmp.name, 'rb') as arquivo:
+            exportacao.arquivo.save(nome.format(pk=exportacao.pk), File(arquivo), save=False)
+    finally:
+        os.unlink(tmp.name)
+
+    exportacao.status = 'CONCLUIDA'
+    exportacao.processados = exportacao.total
+    exportacao.data_conclusao = timezone.now()
+    exportacao.save(update_fields=['status', 'processados', 'arquivo', 'data_conclusao'])
+
+
+def gerar_exportacao_pesquisa(exportacao_id):
+    exportacao = Exportacao.objects.select_related('usuario').get(pk=exportacao_id)
+    avarias = (
+        filtrar_pesquisa(exportacao.parametros)
+        .select_related('cliente', 'veiculo', 'motorista')
+        .prefetch_related('itens__produto')
+    )
+
+    def escrever(tmp, total, ao_processar):
+        for parte in relatorio_pesquisa_html(avarias, total, exportacao.usuario, ao_processar=ao_processar):
+            tmp.write(parte.encode('utf-8'))
+
+    _gerar_exportacao(exportacao_id, avarias, escrever, 'relatorio_avarias_{pk}.html')
+
+
+# --- Fichas em lote (PDF único ou ZIP) ---
+
+def gerar_exportacao_fichas_pdf(exportacao_id):
+    """
+    Todas as fichas (sem fotos) em um PDF. O reportlab monta o documento
+    inteiro antes de gravar, por isso o lote é limitado a LIMITE_FICHAS_PDF;
+    acima disso a tela só oferece o ZIP.
+    """
+    exportacao = Exportacao.objects.get(pk=exportacao_id)
+    avarias = filtrar_pesquisa(exportacao.parametros).only('pk')
+
+    def escrever(tmp, total, ao_processar):
+        if total > LIMITE_FICHAS_PDF:
+            raise ValueError(
+                f"Mais de {LIMITE_FICHAS_PDF} Avarias: refine a pesquisa ou exporte em ZIP."
+            )
+
+        def fichas():
+            for n, avaria in enumerate(avarias.iterator(chunk_size=TAMANHO_LOTE), 1):
+                yield pdf.dados_da_ficha(avaria, com_fotos=False)
+                if n % 50 == 0:
+                    ao_processar(n)
+
+        pdf.gerar_pdf_de_varias(fichas(), tmp)
+
+    _gerar_exportacao(exportacao_id, avarias, escrever, 'fichas_avarias_{pk}.pdf')
+
+
+def gerar_exportacao_fichas_zip(exportacao_id):
+    """
+    ZIP com a ficha em PDF e as fotos originais de cada Avaria. Cada arquivo é
+    copiado para o ZIP em blocos, então a memória não cresce com o lote; as
+    fichas vêm do cache de pdf_da_avaria().
+    """
+    exportacao = Exportacao.objects.get(pk=exportacao_id)
+    avarias = filtrar_pesquisa(exportacao.parametros).only('pk').prefetch_related('fotos')
+
+    def escrever(tmp, total, ao_processar):
+        with zipfile.ZipFile(tmp, 'w', zipfile.ZIP_DEFLATED) as zf:
+            for n, avaria in enumerate(avarias.iterator(chunk_size=TAMANHO_LOTE), 1):
+                pasta = f'avaria_{avaria.pk}'
+                caminho, _ = pdf.pdf_da_avaria(avaria, com_fotos=False)
+                zf.write(caminho, f'{pasta}/ficha_{avaria.pk}.pdf')
+                for foto in avaria.fotos.all():
+                    extensao = os.path.splitext(foto.arquivo.name)[1].lower()
+                    try:
+                        # Photos are already compressed: stored, not deflated
+                        with foto.arquivo.open('rb') as origem, \
+                                zf.open(zipfile.ZipInfo(f'{pasta}/fotos/foto_{foto.pk}{extensao}'), 'w') as saida:
+                            shutil.copyfileobj(origem, saida, 1024 * 1024)
+                    except FileNotFoundError:
+                        logger.warning("Foto %s da Avaria %s não encontrada no disco", foto.pk, avaria.pk)
+                ao_processar(n)
+
+    _gerar_exportacao(exportacao_id, avarias, escrever, 'fichas_avarias_{pk}.zip')
+
+
+GERADORES = {
+    'PESQUISA': gerar_exportacao_pesquisa,
+    'FICHAS_PDF': gerar_exportacao_fichas_pdf,
+    'FICHAS_ZIP': gerar_exportacao_fichas_zip,
+}
+
+
+# --- Planilhas (CSV/XLSX) ---
+
+# (título da coluna, campo do values_list); os campos item_* vêm de _com_itens()
+COLUNAS_ITENS = (
+    ('Produto', 'item_produto'),
+    ('Laboratório', 'item_laboratorio'),
+    ('Lote', 'item_lote'),
+    ('Quantidade', 'item_quantidade'),
+)
+
+COLUNAS_PESQUISA = (
+    ('ID', 'id'),
+    ('Data Criação', 'data_criacao'),
+    ('Status', 'status'),
+    ('Cliente', 'cliente__razao_social'),
+    ('CNPJ', 'cliente__cnpj'),
+    ('Nota Fiscal', 'nota_fiscal'),
+    ('Valor NF', 'valor_nf'),
+    ('Local', 'local_atuacao'),
+    ('UF', 'uf'),
+    ('Motorista', 'motorista__nome'),
+    ('CPF', 'motorista__cpf'),
+    ('Placa', 'veiculo__placa'),
+    ('Tipo Finalização', 'tipo_finalizacao'),
+    ('Responsável Prejuízo', 'responsavel_prejuizo'),
+    ('Data Finalização', 'data_finalizacao'),
+    ('NF Devolução', 'nf_devolucao'),
+) + COLUNAS_ITENS
+
+COLUNAS_PREJUIZOS = (
+    ('Período', 'periodo'),
+    ('ID', 'id'),
+    ('Data Finalização', 'data_finalizacao'),
+    ('Cliente', 'cliente__razao_social'),
+    ('Nota Fiscal', 'nota_fiscal'),
+    ('Tipo Finalização', 'tipo_finalizacao'),
+    ('Responsável Prejuízo', 'responsavel_prejuizo'),
+    ('Valor NF', 'valor_nf'),
+) + COLUNAS_ITENS
+
+ROTULOS = {
+    'status': dict(Avaria.STATUS_CHOICES),
+    'tipo_finalizacao': dict(Avaria.TIPO_FINALIZACAO_CHOICES),
+    'responsavel_prejuizo': dict(Avaria.RESPONSAVEL_PREJUIZO_CHOICES),
+}
+
+
+def _com_itens(avarias):
+    """Uma linha por item (LEFT JOIN); Avarias antigas, sem itens, usam o produto da própria Avaria."""
+    return avarias.annotate(
+        item_produto=Coalesce('itens__produto__nome', 'produto__nome'),
+        item_laboratorio=Coalesce('itens__produto__laboratorio', 'produto__laboratorio'),
+        item_lote=Coalesce('itens__lote', 'lote'),
+        item_quantidade=Coalesce('itens__quantidade', 'quantidade'),
+    ).order_by(*avarias.query.order_by, 'pk', 'itens__id')
+
+
+def _linhas(avarias, colunas, formatar=None):
+    """
+    Linhas da planilha a partir de values_list().iterator(). O Valor NF vai só
+    na primeira linha de cada Avaria, para a soma da coluna bater com o total.
+    """
+    campos = [campo for _, campo in colunas]
+    posicao_id, posicao_valor = campos.index('id'), campos.index('valor_nf')
+    rotulos = [(i, ROTULOS[campo]) for i, campo in enumerate(campos) if campo in ROTULOS]
+    anterior = None
+    for linha in _com_itens(avarias).values_list(*campos).iterator(chunk_size=2000):
+        linha = list(linha)
+        if linha[posicao_id] == anterior:
+            linha[posicao_valor] = None
+        anterior = linha[posicao_id]
+        for i, nomes in rotulos:
+            linha[i] = nomes.get(linha[i], linha[i])
+        if formatar:
+            formatar(linha)
+        yield linha
+
+
+def planilha_pesquisa(params):
+    """(cabeçalho, linhas) da planilha da Pesquisa Avançada."""
+    return [titulo for titulo, _ in COLUNAS_PESQUISA], _linhas(filtrar_pesquisa(params), COLUNAS_PESQUISA)
+
+
+def _inicio(dia):
+    return timezone.make_aware(datetime.combine(dia, time.min))
+
+
+def planilha_prejuizos(periodo, detalhado=False, now=None):
+    """
+    (cabeçalho, linhas) dos quadros de prejuízo do Dashboard: periodo='12m'
+    (por mês) ou '5y' (por ano). Com detalhado=True, as Avarias finalizadas do
+    período, item a item, em vez dos totais.
+    """
+    now = now or timezone.now()
+    inicio_12m, inicio_5y = financial_windows(now)
+    mensal = periodo == '12m'
+
+    if not detalhado:
+        stats = DashboardStats(now=now)
+        linhas = stats.financials(stats.finalization_series())['financial_12m' if mensal else 'financial_5y']
+        return ['Mês' if mensal else 'Ano', 'Cliente', 'Parceiro', 'Transbirday'], (
+            [
+                linha['month'].strftime('%m/%Y') if mensal else linha['year'],
+                linha['total_cliente'], linha['total_terceiro'], linha['total_transbirday'],
+            ]
+            for linha in linhas
+        )
+
+    inicio = _inicio(inicio_12m) if mensal else _inicio(inicio_5y.replace(month=1))
+    avarias = (
+        Avaria.objects.filter(status='FINALIZADA', data_finalizacao__gte=inicio)
+        .annotate(periodo=(TruncMonth if mensal else TruncYear)('data_finalizacao'))
+        .order_by('-periodo', 'responsavel_prejuizo', 'data_finalizacao')
+    )
+
+    def formatar(linha):
+        linha[0] = linha[0].strftime('%m/%Y') if mensal else linha[0].year
+
+    return [titulo for titulo, _ in COLUNAS_PREJUIZOS], _linhas(avarias, COLUNAS_PREJUIZOS, formatar)
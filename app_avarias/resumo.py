@@ -0,0 +1,133 @@
+"""
+Manutenção do resumo mensal (AvariaResumoMensal) usado pelo Dashboard.
+
+Cada Avaria contribui com quantidade=1 e valor_total=valor_nf para exatamente uma
+linha do resumo. Quando uma Avaria muda de estado, a contribuição é removida da
+chave antiga e somada na chave nova, com UPDATEs atômicos (F expressions).
+"""
+from decimal import Decimal
+
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import Avaria, AvariaResumoMensal
+
+CAMPOS_CHAVE = (
+    'data_criacao', 'data_finalizacao', 'status', 'tipo_finalizacao',
+    'responsavel_prejuizo', 'cliente_id', 'valor_nf',
+)
+
+
+def inicio_do_mes(value):
+    """Primeiro dia do mês (no fuso local) de um datetime, ou None."""
+    if not value:
+        return None
+    return timezone.localtime(value).date().replace(day=1)
+
+
+def chave_resumo(dados):
+    """
+    Monta a chave do resumo a partir de um dict com os CAMPOS_CHAVE.
+    Retorna (chave, valor) ou (None, 0) se a Avaria ainda não tem data de criação.
+    """
+    if not dados.get('data_criacao') or not dados.get('cliente_id'):
+        return None, Decimal('0')
+    chave = {
+        'mes_criacao': inicio_do_mes(dados['data_criacao']),
+        'mes_finalizacao': inicio_do_mes(dados.get('data_finalizacao')),
+        'status': dados['status'],
+        'tipo_finalizacao': dados.get('tipo_finalizacao') or None,
+        'responsavel_prejuizo': dados.get('responsavel_prejuizo') or None,
+        'cliente_id': dados['cliente_id'],
+    }
+    return chave, Decimal(str(dados.get('valor_nf') or 0))
+
+
+def dados_da_instancia(avaria):
+    return {campo: getattr(avaria, campo) for campo in CAMPOS_CHAVE}
+
+
+def _linha_travada(chave):
+    return AvariaResumoMensal.objects.select_for_update().filter(**chave).first()
+
+
+def aplicar_delta(chave, quantidade, valor):
+    """
+    Soma (ou subtrai) quantidade/valor na linha do resumo da chave informada
+    (uma só: a constraint resumo_chave_unica não deixa haver outra).
+    """
+    if chave is None or (not quantidade and not valor):
+        return
+    with transaction.atomic():
+        linha = _linha_travada(chave)
+        if linha is None:
+            try:
+                with transaction.atomic():
+                    AvariaResumoMensal.objects.create(quantidade=quantidade, valor_total=valor, **chave)
+                return
+            except IntegrityError:
+                # A concurrent first insert for this key won: update its row
+                linha = _linha_travada(chave)
+        AvariaResumoMensal.objects.filter(pk=linha.pk).update(
+            quantidade=F('quantidade') + quantidade,
+            valor_total=F('valor_total') + valor,
+        )
+
+
+def mover_contribuicao(dados_antigos, dados_novos):
+    """
+    Move a contribuição de uma Avaria da chave antiga para a nova.
+    dados_antigos=None para criação, dados_novos=None para exclusão.
+    """
+    chave_antiga, valor_antigo = chave_resumo(dados_antigos) if dados_antigos else (None, Decimal('0'))
+    chave_nova, valor_novo = chave_resumo(dados_novos) if dados_novos else (None, Decimal('0'))
+
+    if chave_antiga == chave_nova and valor_antigo == valor_novo:
+        return
+
+    with transaction.atomic():
+        if chave_antiga is not None:
+            aplicar_delta(chave_antiga, -1, -valor_antigo)
+        if chave_nova is not None:
+            aplicar_delta(chave_nova, 1, valor_novo)
+
+
+def _totais(dados):
+    """Soma (quantidade, valor) por chave do resumo de um iterável de dicts com os CAMPOS_CHAVE."""
+    totais = {}
+    for item in dados:
+        chave, valor = chave_resumo(item)
+        if chave is None:
+            continue
+        chave_tupla = tuple(sorted(chave.items()))
+        quantidade, soma = totais.get(chave_tupla, (0, Decimal('0')))
+        totais[chave_tupla] = (quantidade + 1, soma + valor)
+    return totais
+
+
+def somar_criadas(avarias):
+    """
+    Contribuição de Avarias inseridas com bulk_create (sem post_save): um
+    UPDATE (ou INSERT) por chave do resumo, não por Avaria.
+    """
+    with transaction.atomic():
+        for chave, (quantidade, valor) in _totais(map(dados_da_instancia, avarias)).items():
+            aplicar_delta(dict(chave), quantidade, valor)
+
+
+def reconstruir_resumo_mensal(avaria_model=Avaria, resumo_model=AvariaResumoMensal):
+    """
+    Recalcula o resumo inteiro a partir da tabela de Avarias.
+    Aceita os modelos como parâmetro para poder ser usado em data migrations.
+    """
+    linhas = avaria_model.objects.values_list(*CAMPOS_CHAVE).iterator(chunk_size=2000)
+    totais = _totais(dict(zip(CAMPOS_CHAVE, linha)) for linha in linhas)
+
+    with transaction.atomic():
+        resumo_model.objects.all().delete()
+        resumo_model.objects.bulk_create(
+            [resumo_model(quantidade=q, valor_total=v, **dict(chave)) for chave, (q, v) in totais.items()],
+            batch_size=500,
+        )
+    return len(totais)
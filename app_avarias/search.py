@@ -0,0 +1,200 @@
+"""
+Índice de busca da pesquisa de Avarias (parâmetro q de avaria_search).
+
+Cada Avaria tem um documento em AvariaBusca com NF, NFD, cliente, produtos,
+placas e motorista, normalizado (minúsculas, sem acentos). A busca usa:
+
+- SQLite: tabela FTS5 externa (tokenizer trigram) mantida por triggers sobre
+  AvariaBusca, ordenada por bm25;
+- PostgreSQL: índice GIN pg_trgm sobre o documento, ordenado por similaridade;
+- outros backends: LIKE sobre o documento (sem ranking).
+
+Termos com menos de 3 letras não formam trigramas e caem no LIKE.
+"""
+import unicodedata
+from collections import defaultdict
+
+from django.db import connection, transaction
+from django.db.models import FloatField, Q
+from django.db.models.expressions import RawSQL
+
+FTS_TABELA = 'app_avarias_avariabusca_fts'
+TRGM_INDICE = 'app_avarias_avariabusca_trgm'
+TAMANHO_LOTE = 1000
+
+
+def normalizar(texto):
+    texto = unicodedata.normalize('NFKD', str(texto or '')).encode('ascii', 'ignore').decode()
+    return ' '.join(texto.lower().split())
+
+
+# --- Estrutura do índice (usado pela migration) ---
+
+def criar_indice(schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        schema_editor.execute(
+            f"CREATE VIRTUAL TABLE {FTS_TABELA} USING fts5("
+            f"documento, content='app_avarias_avariabusca', content_rowid='avaria_id', tokenize='trigram')"
+        )
+        schema_editor.execute(
+            f"CREATE TRIGGER {FTS_TABELA}_ai AFTER INSERT ON app_avarias_avariabusca BEGIN "
+            f"INSERT INTO {FTS_TABELA}(rowid, documento) VALUES (new.avaria_id, new.documento); END"
+        )
+        schema_editor.execute(
+            f"CREATE TRIGGER {FTS_TABELA}_ad AFTER DELETE ON app_avarias_avariabusca BEGIN "
+            f"INSERT INTO {FTS_TABELA}({FTS_TABELA}, rowid, documento) VALUES ('delete', old.avaria_id, old.documento); END"
+        )
+        schema_editor.execute(
+            f"CREATE TRIGGER {FTS_TABELA}_au AFTER UPDATE ON app_avarias_avariabusca BEGIN "
+            f"INSERT INTO {FTS_TABELA}({FTS_TABELA}, rowid, documento) VALUES ('delete', old.avaria_id, old.documento); "
+            f"INSERT INTO {FTS_TABELA}(rowid, documento) VALUES (new.avaria_id, new.documento); END"
+        )
+    elif vendor == 'postgresql':
+        schema_editor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+        schema_editor.execute(
+            f"CREATE INDEX {TRGM_INDICE} ON app_avarias_avariabusca USING gin (documento gin_trgm_ops)"
+        )
+
+
+def remover_indice(schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        for sufixo in ('ai', 'ad', 'au'):
+            schema_editor.execute(f"DROP TRIGGER IF EXISTS {FTS_TABELA}_{sufixo}")
+        schema_editor.execute(f"DROP TABLE IF EXISTS {FTS_TABELA}")
+    elif vendor == 'postgresql':
+        schema_editor.execute(f"DROP INDEX IF EXISTS {TRGM_INDICE}")
+
+
+# --- Manutenção dos documentos ---
+
+def montar_documentos(ids, avaria_model=None, item_model=None):
+    """{avaria_id: documento} para os ids informados, em duas queries."""
+    if avaria_model is None:
+        from .models import Avaria as avaria_model, AvariaItem as item_model
+
+    itens = defaultdict(list)
+    for avaria_id, nome, laboratorio in (
+        item_model.objects.filter(avaria_id__in=ids)
+        .values_list('avaria_id', 'produto__nome', 'produto__laboratorio')
+    ):
+        itens[avaria_id].extend([nome, laboratorio])
+
+    documentos = {}
+    for linha in avaria_model.objects.filter(pk__in=ids).values(
+        'pk', 'nota_fiscal', 'nf_devolucao', 'cliente__razao_social',
+        'produto__nome', 'veiculo__placa', 'veiculo_carreta__placa', 'motorista__nome',
+    ):
+        partes = [str(linha['pk'])] + [valor for chave, valor in linha.items() if chave != 'pk'] + itens[linha['pk']]
+        documentos[linha['pk']] = normalizar(' '.join(str(p) for p in partes if p))
+    return documentos
+
+
+def indexar_avarias(ids, avaria_model=None, item_model=None, busca_model=None):
+    """Cria/atualiza os documentos das Avarias informadas (ids que não existem mais são removidos)."""
+    if busca_model is None:
+        from .models import AvariaBusca as busca_model
+
+    ids = list(ids)
+    for inicio in range(0, len(ids), TAMANHO_LOTE):
+        lote = ids[inicio:inicio + TAMANHO_LOTE]
+        documentos = montar_documentos(lote, avaria_model, item_model)
+        with transaction.atomic():
+            busca_model.objects.bulk_create(
+                [busca_model(avaria_id=pk, documento=doc) for pk, doc in documentos.items()],
+                update_conflicts=True, unique_fields=['avaria'], update_fields=['documento'],
+            )
+            busca_model.objects.filter(avaria_id__in=set(lote) - set(documentos)).delete()
+
+
+def reindexar_tudo(avaria_model=None, item_model=None, busca_model=None):
+    """Reconstrói os documentos de todas as Avarias, em lotes por pk."""
+    if avaria_model is None:
+        from .models import Avaria as avaria_model
+    total, ultimo_id = 0, 0
+    while True:
+        lote = list(avaria_model.objects.filter(pk__gt=ultimo_id).order_by('pk').values_list('pk', flat=True)[:TAMANHO_LOTE])
+        if not lote:
+            return total
+        indexar_avarias(lote, avaria_model, item_model, busca_model)
+        total += len(lote)
+        ultimo_id = lote[-1]
+
+
+# --- Consulta ---
+
+def _expressao_fts(termo):
+    # Cada palavra vira uma frase entre aspas (AND implícito entre elas)
+    return ' '.join('"{}"'.format(palavra.replace('"', '""')) for palavra in termo.split())
+
+
+def filtrar_por_busca(queryset, termo):
+    """
+    Restringe o queryset às Avarias que casam com o termo, ordenadas por
+    relevância. A busca entra na mesma query que os demais filtros (subquery no
+    índice), então todos se aplicam juntos e nada é cortado antes deles.
+    """
+    termo = normalizar(termo)
+    if not termo:
+        return queryset
+
+    palavras = termo.split()
+    if connection.vendor == 'sqlite' and all(len(p) >= 3 for p in palavras):
+        tabela = queryset.model._meta.db_table
+        expressao = _expressao_fts(termo)
+        return queryset.filter(
+            id__in=RawSQL(f"SELECT rowid FROM {FTS_TABELA} WHERE {FTS_TABELA} MATCH %s", [expressao]),
+        ).annotate(
+            relevancia=RawSQL(
+                f"SELECT bm25({FTS_TABELA}) FROM {FTS_TABELA} "
+                f"WHERE {FTS_TABELA} MATCH %s AND rowid = {tabela}.id",
+                [expressao],
+                output_field=FloatField(),
+            ),
+        ).order_by('relevancia', '-id')
+
+    for palavra in palavras:
+        queryset = queryset.filter(busca__documento__contains=palavra)
+    if connection.vendor == 'postgresql':
+        from django.contrib.postgres.search import TrigramWordSimilarity
+        return queryset.annotate(
+            similaridade=TrigramWordSimilarity(termo, 'busca__documento'),
+        ).order_by('-similaridade', '-id')
+    return queryset.order_by('-id')
+
+
+def filtrar_pesquisa(params):
+    """Avarias que atendem aos filtros da Pesquisa Avançada (params = request.GET ou dict)."""
+    from .models import Avaria
+
+    avarias = Avaria.objects.all().order_by('-data_criacao')
+
+    # Generic Search (ranked)
+    q = params.get('q')
+    if q:
+        avarias = filtrar_por_busca(avarias, q)
+
+    if params.get('status'):
+        avarias = avarias.filter(status=params['status'])
+    if params.get('data_ini'):
+        avarias = avarias.filter(data_criacao__date__gte=params['data_ini'])
+    if params.get('data_fim'):
+        avarias = avarias.filter(data_criacao__date__lte=params['data_fim'])
+
+    if params.get('nf'):
+        avarias = avarias.filter(nota_fiscal__icontains=params['nf'])
+    if params.get('nfd'):
+        avarias = avarias.filter(nf_devolucao__icontains=params['nfd'])
+    if params.get('placa'):
+        avarias = avarias.filter(
+            Q(veiculo__placa__icontains=params['placa']) |
+            Q(veiculo_carreta__placa__icontains=params['placa'])
+        )
+    if params.get('cpf'):
+        avarias = avarias.filter(motorista__cpf__icontains=params['cpf'])
+    if params.get('motorista'):
+        avarias = avarias.filter(motorista__nome__icontains=params['motorista'])
+    if params.get('local'):
+        avarias = avarias.filter(local_atuacao__icontains=params['local'])
+    return avarias
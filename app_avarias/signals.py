@@ -0,0 +1,109 @@
+from django.db import transaction
+from django.db.models import Q
+from django.db.models.signals import pre_save, post_save, post_delete
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .models import Avaria, AvariaFoto, AvariaItem, Cliente, Condutor, Produto, RegistroExcluido, Veiculo
+from . import imagens, resumo, search
+from .dashboard import invalidate_dashboard_cache
+from .tasks import run_in_background
+
+
+@receiver(pre_save, sender=Avaria)
+def guardar_estado_anterior(sender, instance, raw=False, **kwargs):
+    """Guarda os campos do resumo como estão no banco antes de salvar."""
+    instance._resumo_anterior = None
+    if raw or not instance.pk:
+        return
+    instance._resumo_anterior = (
+        Avaria.objects.filter(pk=instance.pk).values(*resumo.CAMPOS_CHAVE).first()
+    )
+
+
+@receiver(post_save, sender=Avaria)
+def atualizar_resumo_mensal(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    anterior = getattr(instance, '_resumo_anterior', None)
+    resumo.mover_contribuicao(anterior, resumo.dados_da_instancia(instance))
+    instance._resumo_anterior = None
+
+
+@receiver(post_delete, sender=Avaria)
+def remover_do_resumo_mensal(sender, instance, **kwargs):
+    resumo.mover_contribuicao(resumo.dados_da_instancia(instance), None)
+
+
+@receiver(post_save, sender=Avaria)
+@receiver(post_delete, sender=Avaria)
+@receiver(post_save, sender=AvariaItem)
+@receiver(post_delete, sender=AvariaItem)
+def invalidar_cache_dashboard(sender, raw=False, **kwargs):
+    if raw:
+        return
+    transaction.on_commit(invalidate_dashboard_cache)
+
+
+@receiver(post_save, sender=Avaria)
+@receiver(post_save, sender=AvariaItem)
+@receiver(post_delete, sender=AvariaItem)
+def atualizar_indice_busca(sender, instance, raw=False, **kwargs):
+    """Reindexa a Avaria após o commit (quando ela já foi apagada, o documento sai junto)."""
+    if raw:
+        return
+    avaria_id = instance.pk if sender is Avaria else instance.avaria_id
+    transaction.on_commit(lambda: search.indexar_avarias([avaria_id]))
+
+
+# Renomear um cliente, produto, veículo ou condutor muda o documento de todas as
+# Avarias ligadas a ele; como podem ser muitas, a reindexação vai para o background.
+RELACIONADOS_BUSCA = {
+    Cliente: lambda pk: Q(cliente_id=pk),
+    Produto: lambda pk: Q(produto_id=pk) | Q(itens__produto_id=pk),
+    Veiculo: lambda pk: Q(veiculo_id=pk) | Q(veiculo_carreta_id=pk),
+    Condutor: lambda pk: Q(motorista_id=pk),
+}
+
+
+def _reindexar_relacionadas(filtro):
+    ids = Avaria.objects.filter(filtro).values_list('pk', flat=True).distinct()
+    search.indexar_avarias(ids)
+
+
+@receiver(post_save, sender=Cliente)
+@receiver(post_save, sender=Produto)
+@receiver(post_save, sender=Veiculo)
+@receiver(post_save, sender=Condutor)
+def reindexar_avarias_relacionadas(sender, instance, created=False, raw=False, **kwargs):
+    if raw or created:
+        return
+    filtro = RELACIONADOS_BUSCA[sender](instance.pk)
+    transaction.on_commit(lambda: run_in_background(_reindexar_relacionadas, filtro))
+
+
+@receiver(post_save, sender=AvariaFoto)
+def processar_foto_enviada(sender, instance, created=False, raw=False, **kwargs):
+    """Gera as versões web/miniatura/impressao da foto em segundo plano."""
+    if raw or not created:
+        return
+    foto_id = instance.pk
+    transaction.on_commit(lambda: run_in_background(imagens.processar_foto, foto_id))
+
+
+# --- Sincronização com o app (/api/sync/) ---
+
+@receiver(post_delete, sender=Avaria)
+@receiver(post_delete, sender=Cliente)
+@receiver(post_delete, sender=Condutor)
+@receiver(post_delete, sender=Produto)
+@receiver(post_delete, sender=Veiculo)
+def registrar_exclusao(sender, instance, **kwargs):
+    RegistroExcluido.objects.create(modelo=sender._meta.model_name, objeto_id=instance.pk)
+
+
+@receiver(post_delete, sender=AvariaItem)
+@receiver(post_delete, sender=AvariaFoto)
+def marcar_avaria_alterada(sender, instance, **kwargs):
+    """Itens e fotos vão dentro da Avaria no app: sem o registro, quem muda é a Avaria."""
+    Avaria.objects.filter(pk=instance.avaria_id).update(atualizado_em=timezone.now())
@@ -0,0 +1,168 @@
+"""
+SLAs do ciclo de vida da Avaria: percentis (P50/P90/P99) e histograma de duração.
+
+Cada segmento é calculado em uma única query de agregação: contagens cumulativas
+por faixa de duração (Count com filter) + min/avg/max. No PostgreSQL os percentis
+saem exatos do próprio banco (PERCENTILE_CONT); nos demais backends são
+interpolados a partir do histograma cumulativo.
+"""
+from datetime import date, timedelta
+
+from django.db import connection
+from django.db.models import Aggregate, Avg, Count, DurationField, ExpressionWrapper, F, Max, Min, Q
+
+from . import kpi_cache
+from .models import Avaria
+
+SEGMENTOS = {
+    'decisao': {
+        'titulo': 'Tempo de Definição (Aberto -> Decisão)',
+        'inicio': 'data_criacao',
+        'fim': 'data_decisao',
+        'filtro': Q(),
+    },
+    'aguardando_saida': {
+        'titulo': 'Tempo de Saída (Decisão -> Em Rota)',
+        'inicio': 'data_decisao',
+        'fim': 'data_inicio_devolucao',
+        'filtro': Q(),
+    },
+    'transporte': {
+        'titulo': 'Tempo de Transporte (Rota -> Finalizado)',
+        'inicio': 'data_inicio_devolucao',
+        'fim': 'data_finalizacao',
+        'filtro': Q(status='FINALIZADA', tipo_finalizacao='DEVOLUCAO_CONCLUIDA'),
+    },
+}
+
+# Limites superiores das faixas do histograma; a última faixa é aberta
+FAIXAS = [
+    (timedelta(hours=1), 'até 1h'),
+    (timedelta(hours=4), '1h a 4h'),
+    (timedelta(hours=12), '4h a 12h'),
+    (timedelta(days=1), '12h a 1 dia'),
+    (timedelta(days=2), '1 a 2 dias'),
+    (timedelta(days=3), '2 a 3 dias'),
+    (timedelta(days=5), '3 a 5 dias'),
+    (timedelta(days=7), '5 a 7 dias'),
+    (timedelta(days=15), '7 a 15 dias'),
+    (timedelta(days=30), '15 a 30 dias'),
+]
+FAIXA_ABERTA = 'mais de 30 dias'
+
+PERCENTIS = {'p50': 0.5, 'p90': 0.9, 'p99': 0.99}
+
+
+class Percentil(Aggregate):
+    """PERCENTILE_CONT do PostgreSQL (percentil contínuo, exato)."""
+    function = 'PERCENTILE_CONT'
+    name = 'Percentil'
+    template = '%(function)s(%(fracao)s) WITHIN GROUP (ORDER BY %(expressions)s)'
+    output_field = DurationField()
+
+    def __init__(self, expression, fracao, **extra):
+        super().__init__(expression, fracao=float(fracao), **extra)
+
+
+def _percentil_interpolado(fracao, total, cumulativos, minimo, maximo):
+    """Estima o percentil a partir das contagens cumulativas por faixa."""
+    alvo = fracao * total
+    limite_inferior, anteriores = minimo, 0
+    limites = [limite for limite, _ in FAIXAS] + [maximo]
+    for limite, acumulado in zip(limites, cumulativos + [total]):
+        limite = min(max(limite, minimo), maximo)
+        if acumulado >= alvo and acumulado > anteriores:
+            proporcao = (alvo - anteriores) / (acumulado - anteriores)
+            return limite_inferior + (limite - limite_inferior) * proporcao
+        limite_inferior, anteriores = limite, acumulado
+    return maximo
+
+
+def calcular_segmento(nome, periodo=None):
+    """
+    Estatísticas de um segmento. periodo=(ano, mes) restringe às Avarias que
+    concluíram o segmento naquele mês.
+    """
+    segmento = SEGMENTOS[nome]
+    inicio, fim = segmento['inicio'], segmento['fim']
+
+    qs = Avaria.objects.filter(segmento['filtro'], **{f'{inicio}__isnull': False, f'{fim}__isnull': False})
+    if periodo:
+        qs = qs.filter(**{f'{fim}__year': periodo[0], f'{fim}__month': periodo[1]})
+    qs = qs.annotate(duracao=ExpressionWrapper(F(fim) - F(inicio), output_field=DurationField()))
+
+    agregados = {
+        'total': Count('id'),
+        'minimo': Min('duracao'),
+        'media': Avg('duracao'),
+        'maximo': Max('duracao'),
+    }
+    for i, (limite, _) in enumerate(FAIXAS):
+        agregados[f'faixa_{i}'] = Count('id', filter=Q(duracao__lte=limite))
+    exato = connection.vendor == 'postgresql'
+    if exato:
+        for chave, fracao in PERCENTIS.items():
+            agregados[chave] = Percentil('duracao', fracao)
+
+    dados = qs.aggregate(**agregados)
+    total = dados['total']
+    cumulativos = [dados[f'faixa_{i}'] for i in range(len(FAIXAS))]
+
+    histograma, anteriores = [], 0
+    for (_, rotulo), acumulado in zip(FAIXAS, cumulativos):
+        histograma.append({'faixa': rotulo, 'total': acumulado - anteriores})
+        anteriores = acumulado
+    histograma.append({'faixa': FAIXA_ABERTA, 'total': total - anteriores})
+
+    percentis = {}
+    for chave, fracao in PERCENTIS.items():
+        if not total:
+            percentis[chave] = None
+        elif exato:
+            percentis[chave] = dados[chave]
+        else:
+            percentis[chave] = _percentil_interpolado(fracao, total, cumulativos, dados['minimo'], dados['maximo'])
+
+    return {
+        'titulo': segmento['titulo'],
+        'total': total,
+        'minimo': dados['minimo'],
+        'media': dados['media'],
+        'maximo': dados['maximo'],
+        'percentis_exatos': exato,
+        'histograma': histograma,
+        **percentis,
+    }
+
+
+def calcular_slas(periodo=None):
+    """Todos os segmentos (uma query por segmento)."""
+    return {nome: calcular_segmento(nome, periodo) for nome in SEGMENTOS}
+
+
+def slas_em_cache(ano=None, mes=None):
+    """calcular_slas() via cache, por período (ou global, sem período)."""
+    periodo = None
+    if ano and mes:
+        inicio = date(int(ano), int(mes), 1)
+        periodo = (inicio.year, inicio.month)
+    chave = f'sla:{periodo[0]}:{periodo[1]:02}' if periodo else 'sla:global'
+    return kpi_cache.get_or_refresh(chave, calcular_slas, periodo)
+
+
+def _segundos(valor):
+    return round(valor.total_seconds()) if valor is not None else None
+
+
+def como_json(slas):
+    """Versão serializável (durações em segundos)."""
+    return {
+        nome: {
+            'titulo': dados['titulo'],
+            'total': dados['total'],
+            'percentis_exatos': dados['percentis_exatos'],
+            'segundos': {campo: _segundos(dados[campo]) for campo in ('minimo', 'media', 'maximo', *PERCENTIS)},
+            'histograma': dados['histograma'],
+        }
+        for nome, dados in slas.items()
+    }
@@ -0,0 +1,58 @@
+"""
+Armazenamento das fotos por conteúdo (SHA-256).
+
+O nome do arquivo gravado é o hash do conteúdo: avarias_fotos/sha256/ab/abcd...jpg.
+Bytes idênticos (o mesmo arquivo reenviado pelo app, a mesma foto em mais de uma
+Avaria) viram um único arquivo em disco, referenciado por todas as AvariaFoto.
+
+Como um arquivo pode ser compartilhado, ele nunca deve ser apagado por uma
+AvariaFoto isolada (o Django não apaga arquivos ao excluir registros).
+"""
+import hashlib
+import os
+import uuid
+
+from django.core.files.storage import FileSystemStorage
+
+PREFIXO = 'avarias_fotos/sha256'
+
+
+def hash_do_conteudo(conteudo):
+    """SHA-256 (hex) de um django.core.files.File, lido em blocos."""
+    sha = hashlib.sha256()
+    for bloco in conteudo.chunks():
+        sha.update(bloco)
+    conteudo.seek(0)
+    return sha.hexdigest()
+
+
+def nome_por_conteudo(digest, nome_original):
+    extensao = os.path.splitext(nome_original)[1].lower()
+    return f'{PREFIXO}/{digest[:2]}/{digest}{extensao}'
+
+
+def e_nome_por_conteudo(nome):
+    return (nome or '').startswith(PREFIXO + '/')
+
+
+class ArmazenamentoPorConteudo(FileSystemStorage):
+    """FileSystemStorage que nomeia os arquivos pelo SHA-256 e não grava duplicatas."""
+
+    def save(self, name, content, max_length=None):
+        if name is None:
+            name = content.name
+        nome = nome_por_conteudo(hash_do_conteudo(content), name)
+        if self.exists(nome):
+            return nome
+        # Written under a temporary name and renamed: readers never see a partial
+        # file, and two uploads of the same bytes at once just replace each other.
+        temporario = self._save(f'{nome}.{uuid.uuid4().hex}.tmp', content)
+        os.replace(self.path(temporario), self.path(nome))
+        return nome
+
+
+armazenamento = ArmazenamentoPorConteudo()
+
+
+def armazenamento_fotos():
+    return armazenamento
@@ -0,0 +1,61 @@
+"""
+Execução de tarefas em segundo plano (thread pools do próprio processo).
+
+Cada fila tem o seu pool: as exportações (minutos cada) rodam em 'exports' e
+não seguram as tarefas curtas da fila 'default' (cache do Dashboard, índice de
+busca, versões das fotos).
+
+Com BACKGROUND_TASKS_EAGER = True (útil em testes) as tarefas rodam na hora,
+na thread que as agendou.
+"""
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import close_old_connections, connections
+
+logger = logging.getLogger(__name__)
+
+# Fila -> setting com o número de threads (e o padrão)
+QUEUES = {
+    'default': ('BACKGROUND_TASKS_WORKERS', 2),
+    'exports': ('BACKGROUND_TASKS_EXPORT_WORKERS', 1),
+}
+
+_executors = {}
+_lock = threading.Lock()
+
+
+def _get_executor(queue='default'):
+    with _lock:
+        if queue not in _executors:
+            setting, padrao = QUEUES[queue]
+            _executors[queue] = ThreadPoolExecutor(
+                max_workers=getattr(settings, setting, padrao),
+                thread_name_prefix=f'avarias-bg-{queue}',
+            )
+        return _executors[queue]
+
+
+def run_in_background(func, *args, queue='default', **kwargs):
+    """Agenda func(*args, **kwargs) no pool da fila. Erros são logados, nunca propagados."""
+    def executar():
+        try:
+            func(*args, **kwargs)
+        except Exception:
+            logger.exception("Erro na tarefa em segundo plano %s", getattr(func, '__name__', func))
+
+    # Eager: same error handling, so callers (on_commit, signals) behave as in production
+    if getattr(settings, 'BACKGROUND_TASKS_EAGER', False):
+        executar()
+        return None
+
+    def runner():
+        close_old_connections()
+        try:
+            executar()
+        finally:
+            connections.close_all()
+
+    return _get_executor(queue).submit(runner)
@@ -1,3 +1,1031 @@
-from django.test import TestCase
+import importlib
+import os
+import shutil
+import tempfile
+import threading
+import zipfile
+from datetime import timedelta
+from decimal import Decimal
+from io import BytesIO, StringIO
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Group
+from django.db.models import Sum
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import DatabaseError, IntegrityError, connection, transaction
+from django.db.migrations.executor import MigrationExecutor
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from PIL import Image
+
+from app_avarias import dashboard, kpi_cache, pdf, relatorios, resumo, search, sla, tasks
+from app_avarias.eventos import registrar_evento
+from app_avarias.dashboard import DashboardStats
+from app_avarias.models import (
+    Avaria, AvariaBusca, AvariaEvento, AvariaFoto, AvariaItem, AvariaResumoMensal, Cliente, Condutor,
+    Exportacao, Produto, Veiculo,
+)
+from app_avarias.resumo import reconstruir_resumo_mensal
+from app_avarias.storage import PREFIXO
+
+User = get_user_model()
+
+migracao_observacoes = importlib.import_module('app_avarias.migrations.0020_migrar_observacoes')
+
+LOCMEM_CACHE = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+GIF_1X1 = b'GIF89a\x01\x00\x01\x00\x00\x00\x00!\xf9\x04\x01\x00\x00\x00\x00,\x00\x00\x00\x00\x01\x00\x01\x00\x00\x02\x01\x00\x00;'
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class ResumoMensalTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='gestor', password='password')
+        self.user.groups.add(Group.objects.get_or_create(name='Gestor')[0])
+        self.client.login(username='gestor', password='password')
+        self.cliente = Cliente.objects.create(razao_social="Cliente Teste", cnpj="11111111111111")
+
+    def criar_avaria(self, **kwargs):
+        dados = {'cliente': self.cliente, 'nota_fiscal': '123', 'criado_por': self.user, 'valor_nf': Decimal('100.00')}
+        dados.update(kwargs)
+        return Avaria.objects.create(**dados)
+
+    def resumo_por_status(self):
+        return {
+            linha['status']: (linha['qtd'], linha['valor'])
+            for linha in AvariaResumoMensal.objects.values('status').annotate(qtd=Sum('quantidade'), valor=Sum('valor_total'))
+        }
+
+    def test_resumo_acompanha_mudancas_de_estado(self):
+        avaria = self.criar_avaria()
+        self.criar_avaria(valor_nf=Decimal('50.00'))
+        self.assertEqual(self.resumo_por_status()['EM_ABERTO'], (2, Decimal('150.00')))
+
+        avaria.status = 'FINALIZADA'
+        avaria.tipo_finalizacao = 'ACEITE'
+        avaria.data_finalizacao = timezone.now()
+        avaria.save()
+
+        resumo = self.resumo_por_status()
+        self.assertEqual(resumo['EM_ABERTO'], (1, Decimal('50.00')))
+        self.assertEqual(resumo['FINALIZADA'], (1, Decimal('100.00')))
+
+        avaria.delete()
+        self.assertEqual(self.resumo_por_status().get('FINALIZADA', (0, 0))[0], 0)
+
+    def test_reconstrucao_igual_ao_incremental(self):
+        avaria = self.criar_avaria()
+        self.criar_avaria(status='AGUARDANDO_DEVOLUCAO')
+        avaria.valor_nf = Decimal('80.00')
+        avaria.save()
+        incremental = self.resumo_por_status()
+
+        reconstruir_resumo_mensal()
+        self.assertEqual(self.resumo_por_status(), incremental)
+
+    def test_uma_linha_por_chave(self):
+        self.criar_avaria()
+        linha = AvariaResumoMensal.objects.get()
+        # Null key fields compare equal too
+        self.assertIsNone(linha.tipo_finalizacao)
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            AvariaResumoMensal.objects.create(
+                mes_criacao=linha.mes_criacao, status=linha.status, cliente=self.cliente, quantidade=1,
+            )
+
+        # First insert lost to a concurrent one: the delta goes to the existing row
+        with mock.patch.object(resumo, '_linha_travada', side_effect=[None, linha]):
+            self.criar_avaria(valor_nf=Decimal('50.00'))
+        self.assertEqual(self.resumo_por_status()['EM_ABERTO'], (2, Decimal('150.00')))
+        self.assertEqual(AvariaResumoMensal.objects.count(), 1)
+
+    def test_dashboard_le_do_resumo(self):
+        self.criar_avaria()
+        self.criar_avaria(status='FINALIZADA', tipo_finalizacao='DEVOLUCAO_CONCLUIDA', data_finalizacao=timezone.now())
+
+        response = self.client.get(reverse('dashboard'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['count_open'], 1)
+        self.assertEqual(response.context['val_open'], Decimal('100.00'))
+        self.assertEqual(response.context['val_returned'], Decimal('100.00'))
+        self.assertEqual(response.context['count_monthly_returns'], 1)
+
+
+class DashboardStatsTests(TestCase):
+    # counters + creation series + finalization series + client stats
+    # + heatmap + top drivers + top products + 3 SLA segments
+    QUERY_BUDGET = 10
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='gestor', password='password')
+        self.cliente = Cliente.objects.create(razao_social="Cliente Teste", cnpj="11111111111111")
+        agora = timezone.now()
+        for i in range(30):
+            dados = {
+                'cliente': self.cliente, 'nota_fiscal': str(i), 'criado_por': self.user,
+                'valor_nf': Decimal('10.00'), 'local_atuacao': 'Matriz - SP',
+            }
+            if i % 3 == 1:
+                dados.update(status='FINALIZADA', tipo_finalizacao='ACEITE',
+                             data_decisao=agora, data_finalizacao=agora)
+            elif i % 3 == 2:
+                dados.update(status='FINALIZADA', tipo_finalizacao='DEVOLUCAO_CONCLUIDA',
+                             responsavel_prejuizo='TRANSBIRDAY', data_decisao=agora,
+                             data_inicio_devolucao=agora, data_finalizacao=agora)
+            Avaria.objects.create(**dados)
+
+    def test_query_budget(self):
+        stats = DashboardStats()
+        with self.assertNumQueries(self.QUERY_BUDGET):
+            context = stats.as_context()
+
+        self.assertEqual(context['count_open'], 10)
+        self.assertEqual(context['val_open'], Decimal('100.00'))
+        self.assertEqual(context['val_accepted'], Decimal('100.00'))
+        self.assertEqual(context['val_returned'], Decimal('100.00'))
+        self.assertEqual(context['acceptance_rate'], 50.0)
+        self.assertEqual(context['count_monthly_returns'], 10)
+        self.assertEqual(context['heatmap_list'], [{'state': 'São Paulo', 'count': 30}])
+        self.assertEqual(context['financial_12m'][0]['total_transbirday'], Decimal('100.00'))
+
+    def test_budget_nao_cresce_com_o_volume(self):
+        for i in range(30):
+            Avaria.objects.create(cliente=self.cliente, nota_fiscal=f"x{i}", criado_por=self.user)
+        with self.assertNumQueries(self.QUERY_BUDGET):
+            DashboardStats().as_context()
+
+
+class AvariaUfTests(TestCase):
+    def test_uf_derivada_do_local_de_atuacao(self):
+        user = User.objects.create_user(username='op', password='password')
+        cliente = Cliente.objects.create(razao_social="Cliente Teste", cnpj="11111111111111")
+        avaria = Avaria.objects.create(cliente=cliente, nota_fiscal='1', criado_por=user, local_atuacao='Filial Curitiba/PR')
+        self.assertEqual(avaria.uf, 'pr')
+
+        avaria.local_atuacao = 'Matriz São Paulo - SP'
+        avaria.save(update_fields=['local_atuacao'])
+        avaria.refresh_from_db()
+        self.assertEqual(avaria.uf, 'sp')
+
+        avaria.local_atuacao = 'Sem estado'
+        avaria.save()
+        self.assertIsNone(Avaria.objects.get(pk=avaria.pk).uf)
+
+@override_settings(CACHES=LOCMEM_CACHE, BACKGROUND_TASKS_EAGER=True)
+class DashboardCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='gestor', password='password')
+        self.cliente = Cliente.objects.create(razao_social="Cliente Teste", cnpj="11111111111111")
+
+    def criar_avaria(self):
+        return Avaria.objects.create(cliente=self.cliente, nota_fiscal='1', criado_por=self.user)
+
+    def test_segunda_leitura_vem_do_cache(self):
+        dashboard.cached_dashboard_context()
+        with self.assertNumQueries(0):
+            dashboard.cached_dashboard_context()
+
+    def test_save_recalcula_o_mes_corrente(self):
+        self.assertEqual(dashboard.cached_dashboard_context()['count_open'], 0)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.criar_avaria()
+        with self.assertNumQueries(0):
+            self.assertEqual(dashboard.cached_dashboard_context()['count_open'], 1)
+
+    def test_entrada_desatualizada_e_servida_enquanto_recalcula(self):
+        self.assertEqual(dashboard.cached_dashboard_context()['count_open'], 0)
+        self.criar_avaria()
+        cache.set(kpi_cache.GENERATION_KEY, 'nova-geracao')
+
+        with mock.patch.object(kpi_cache, 'run_in_background') as background:
+            self.assertEqual(dashboard.cached_dashboard_context()['count_open'], 0)
+            self.assertEqual(dashboard.cached_dashboard_context()['count_open'], 0)
+        # Only one recompute is scheduled while the first one holds the lock
+        self.assertEqual(background.call_count, 1)
+
+        func, *args = background.call_args.args
+        func(*args)
+        self.assertEqual(dashboard.cached_dashboard_context()['count_open'], 1)
+
+    @override_settings(BACKGROUND_TASKS_EAGER=True)
+    def test_erro_na_tarefa_e_logado_mesmo_em_modo_eager(self):
+        def falha():
+            raise RuntimeError('falhou')
+
+        with self.assertLogs('app_avarias.tasks', level='ERROR'):
+            tasks.run_in_background(falha)
+
+    @override_settings(BACKGROUND_TASKS_EAGER=False)
+    def test_exportacoes_nao_seguram_as_tarefas_curtas(self):
+        liberar = threading.Event()
+        self.addCleanup(liberar.set)
+        ocupadas = [
+            tasks.run_in_background(liberar.wait, 10, queue='exports')
+            for _ in range(tasks._get_executor('exports')._max_workers)
+        ]
+        # The export pool is busy; the default queue still runs
+        self.assertEqual(tasks.run_in_background(lambda: None).result(timeout=5), None)
+        self.assertFalse(any(futuro.done() for futuro in ocupadas))
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class SlaTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='gestor', password='password')
+        self.user.groups.add(Group.objects.get_or_create(name='Gestor')[0])
+        self.cliente = Cliente.objects.create(razao_social="Cliente Teste", cnpj="11111111111111")
+        inicio = timezone.now() - timedelta(days=40)
+        # 9 decisões em 2h e uma em 10 dias
+        for i, horas in enumerate([2] * 9 + [240]):
+            avaria = Avaria.objects.create(cliente=self.cliente, nota_fiscal=str(i), criado_por=self.user)
+            # data_criacao is auto_now_add, so it can only be backdated with update()
+            Avaria.objects.filter(pk=avaria.pk).update(data_criacao=inicio, data_decisao=inicio + timedelta(hours=horas))
+
+    def test_percentis_e_histograma(self):
+        with self.assertNumQueries(1):
+            decisao = sla.calcular_segmento('decisao')
+
+        self.assertEqual(decisao['total'], 10)
+        self.assertEqual(decisao['minimo'], timedelta(hours=2))
+        self.assertEqual(decisao['maximo'], timedelta(days=10))
+        # interpolated inside the 1h-4h bucket on SQLite, exact on PostgreSQL
+        self.assertGreaterEqual(decisao['p50'], timedelta(hours=2))
+        self.assertLessEqual(decisao['p50'], timedelta(hours=4))
+        # the single slow case dominates the tail but not the median
+        self.assertGreater(decisao['p99'], timedelta(days=7))
+        self.assertLessEqual(decisao['p99'], timedelta(days=10))
+
+        histograma = {faixa['faixa']: faixa['total'] for faixa in decisao['histograma']}
+        self.assertEqual(histograma['1h a 4h'], 9)
+        self.assertEqual(histograma['7 a 15 dias'], 1)
+        self.assertEqual(sum(histograma.values()), 10)
+
+    def test_segmento_vazio(self):
+        transporte = sla.calcular_segmento('transporte')
+        self.assertEqual(transporte['total'], 0)
+        self.assertIsNone(transporte['p90'])
+
+    def test_api_json(self):
+        self.client.login(username='gestor', password='password')
+        response = self.client.get(reverse('dashboard_sla_api'))
+        self.assertEqual(response.status_code, 200)
+        dados = response.json()
+        self.assertEqual(dados['decisao']['total'], 10)
+        self.assertEqual(dados['decisao']['segundos']['minimo'], 2 * 3600)
+
+        response = self.client.get(reverse('dashboard_sla_api'), {'year': '2026', 'month': '13'})
+        self.assertEqual(response.status_code, 400)
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class AvariaListPaginacaoTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='gestor', password='password')
+        self.user.groups.add(Group.objects.get_or_create(name='Gestor')[0])
+        self.client.login(username='gestor', password='password')
+        cliente = Cliente.objects.create(razao_social="Cliente Teste", cnpj="11111111111111")
+        self.ids = [
+            Avaria.objects.create(cliente=cliente, nota_fiscal=str(i), criado_por=self.user).pk
+            for i in range(25)
+        ]
+        # Same timestamp for everyone: the id tie-breaker must keep pages stable
+        Avaria.objects.update(data_criacao=timezone.now())
+        self.ids.sort(reverse=True)
+
+    def pagina(self, **params):
+        response = self.client.get(reverse('avaria_list'), {'page_size': 10, **params})
+        self.assertEqual(response.status_code, 200)
+        return response.context
+
+    def test_navega_para_frente_e_para_tras(self):
+        primeira = self.pagina()
+        self.assertEqual([a.pk for a in primeira['avarias']], self.ids[:10])
+        self.assertIsNone(primeira['querystring_anterior'])
+
+        segunda = self.pagina(cursor=primeira['pagina'].proximo_cursor)
+        self.assertEqual([a.pk for a in segunda['avarias']], self.ids[10:20])
+
+        terceira = self.pagina(cursor=segunda['pagina'].proximo_cursor)
+        self.assertEqual([a.pk for a in terceira['avarias']], self.ids[20:])
+        self.assertIsNone(terceira['querystring_proxima'])
+
+        voltou = self.pagina(cursor=terceira['pagina'].cursor_anterior)
+        self.assertEqual([a.pk for a in voltou['avarias']], self.ids[10:20])
+
+    def test_cursor_invalido_volta_ao_inicio(self):
+        context = self.pagina(cursor='nao-e-um-cursor')
+        self.assertEqual([a.pk for a in context['avarias']], self.ids[:10])
+
+    def test_page_size_limitado(self):
+        context = self.pagina(page_size=10_000)
+        self.assertEqual(context['pagina'].page_size, 500)
+
+    def test_pagina_cheia_custa_queries_constantes(self):
+        produto = Produto.objects.create(nome="Produto", laboratorio="Lab")
+        cliente = Cliente.objects.create(razao_social="Outro Cliente", cnpj="22222222222222")
+        avarias = Avaria.objects.bulk_create(
+            Avaria(cliente=cliente, nota_fiscal=str(i), criado_por=self.user, produto=produto)
+            for i in range(500)
+        )
+        AvariaItem.objects.bulk_create(
+            AvariaItem(avaria=avaria, produto=produto, quantidade=1)
+            for avaria in avarias for _ in range(2)
+        )
+
+        def queries(page_size):
+            with CaptureQueriesContext(connection) as contexto:
+                response = self.client.get(reverse('avaria_list'), {'page_size': page_size})
+            self.assertEqual(len(response.context['avarias']), page_size)
+            return len(contexto)
+
+        self.assertEqual(queries(500), queries(5))
+        self.assertContains(self.client.get(reverse('avaria_list'), {'page_size': 500}), 'Diversos (2 itens)', count=500)
+
+
+@override_settings(CACHES=LOCMEM_CACHE, BACKGROUND_TASKS_EAGER=True)
+class BuscaTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='gestor', password='password')
+        self.user.groups.add(Group.objects.get_or_create(name='Gestor')[0])
+        self.client.login(username='gestor', password='password')
+        self.farmacia = Cliente.objects.create(razao_social="Farmácia São João", cnpj="11111111111111")
+        self.outro = Cliente.objects.create(razao_social="Distribuidora Norte", cnpj="22222222222222")
+        self.produto = Produto.objects.create(nome="Dipirona 500mg", laboratorio="EMS")
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.avaria_farmacia = Avaria.objects.create(cliente=self.farmacia, nota_fiscal='778899', criado_por=self.user)
+            self.avaria_outro = Avaria.objects.create(cliente=self.outro, nota_fiscal='123456', criado_por=self.user)
+            AvariaItem.objects.create(avaria=self.avaria_outro, produto=self.produto)
+
+    def buscar(self, q):
+        response = self.client.get(reverse('avaria_search'), {'q': q})
+        self.assertEqual(response.status_code, 200)
+        return [a.pk for a in response.context['avarias']]
+
+    def test_busca_por_trecho_sem_acento(self):
+        self.assertEqual(self.buscar('sao joao'), [self.avaria_farmacia.pk])
+        self.assertEqual(self.buscar('8899'), [self.avaria_farmacia.pk])
+        self.assertEqual(self.buscar('DIPIRONA'), [self.avaria_outro.pk])
+        self.assertEqual(self.buscar('inexistente'), [])
+
+    def test_ordena_por_relevancia(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            # Newer, but with "dipirona" once; avaria_outro now has it twice
+            nova = Avaria.objects.create(cliente=self.farmacia, nota_fiscal='1', criado_por=self.user)
+            AvariaItem.objects.create(avaria=nova, produto=self.produto)
+            AvariaItem.objects.create(avaria=self.avaria_outro, produto=self.produto)
+        self.assertEqual(self.buscar('dipirona'), [self.avaria_outro.pk, nova.pk])
+
+        avarias = search.filtrar_por_busca(Avaria.objects.filter(cliente=self.farmacia), 'dipirona')
+        self.assertEqual(avarias.count(), 1)
+
+    def test_termo_curto_usa_like(self):
+        self.assertEqual(self.buscar('ms'), [self.avaria_outro.pk])
+
+    def test_renomear_produto_reindexa(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.produto.nome = "Paracetamol"
+            self.produto.save()
+        self.assertEqual(self.buscar('paracetamol'), [self.avaria_outro.pk])
+        self.assertEqual(self.buscar('dipirona'), [])
+
+    def test_excluir_avaria_remove_do_indice(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.avaria_outro.delete()
+        self.assertEqual(self.buscar('dipirona'), [])
+        self.assertFalse(AvariaBusca.objects.filter(avaria_id=self.avaria_outro.pk).exists())
+
+
+@override_settings(CACHES=LOCMEM_CACHE, BACKGROUND_TASKS_EAGER=True)
+class BuscaComFiltrosTests(TestCase):
+    """q junto com outros filtros, com mais resultados do que cabem numa página (600)."""
+    TOTAL = 600
+
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        media = override_settings(MEDIA_ROOT=media_root)
+        media.enable()
+        self.addCleanup(media.disable)
+
+        self.user = User.objects.create_user(username='gestor', password='password')
+        self.user.groups.add(Group.objects.get_or_create(name='Gestor')[0])
+        self.client.login(username='gestor', password='password')
+        cliente = Cliente.objects.create(razao_social="Farmácia São João", cnpj="11111111111111")
+        avarias = Avaria.objects.bulk_create(
+            Avaria(cliente=cliente, nota_fiscal=f"NF{i}", criado_por=self.user) for i in range(self.TOTAL)
+        )
+        # The two oldest ids are the least "relevant" (ties go to the newest id)
+        self.antigas = [a.pk for a in avarias[:2]]
+        Avaria.objects.filter(pk__in=self.antigas).update(data_criacao=timezone.now() - timedelta(days=30))
+        search.indexar_avarias([a.pk for a in avarias])
+        self.data = (timezone.localdate() - timedelta(days=30)).isoformat()
+
+    def test_filtro_se_aplica_antes_da_busca(self):
+        response = self.client.get(reverse('avaria_search'), {'q': 'farmacia', 'data_ini': self.data, 'data_fim': self.data})
+        self.assertEqual(sorted(a.pk for a in response.context['avarias']), self.antigas)
+        response = self.client.get(reverse('avaria_search'), {'q': 'farmacia'})
+        self.assertEqual(response.context['avarias'].count(), self.TOTAL)
+
+    def test_impressao_acima_do_limite_com_busca(self):
+        with mock.patch.object(relatorios, 'LIMITE_IMPRESSAO', 500):
+            response = self.client.get(reverse('avaria_search'), {'print': '1', 'q': 'farmacia'})
+        self.assertFalse(response.streaming)
+        self.assertEqual(response.context['total'], self.TOTAL)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('avaria_search_export'), {'q': 'farmacia'})
+        exportacao = Exportacao.objects.get()
+        self.assertEqual((exportacao.status, exportacao.total), ('CONCLUIDA', self.TOTAL))
+
+    def test_planilha_com_busca_traz_todas(self):
+        response = self.client.get(reverse('avaria_search'), {'q': 'farmacia', 'formato': 'csv'})
+        linhas = b''.join(response.streaming_content).decode('utf-8').splitlines()
+        self.assertEqual(len(linhas), self.TOTAL + 1)
+
+
+@override_settings(CACHES=LOCMEM_CACHE, BACKGROUND_TASKS_EAGER=True)
+class RelatorioPesquisaTests(TestCase):
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        media = override_settings(MEDIA_ROOT=media_root)
+        media.enable()
+        self.addCleanup(media.disable)
+
+        self.user = User.objects.create_user(username='gestor', password='password')
+        self.user.groups.add(Group.objects.get_or_create(name='Gestor')[0])
+        self.client.login(username='gestor', password='password')
+        cliente = Cliente.objects.create(razao_social="Cliente Teste", cnpj="11111111111111")
+        for i in range(12):
+            Avaria.objects.create(cliente=cliente, nota_fiscal=f"NF{i}", criado_por=self.user)
+
+    def test_impressao_e_transmitida_em_partes(self):
+        response = self.client.get(reverse('avaria_search'), {'print': '1'})
+        self.assertTrue(response.streaming)
+        html = b''.join(response.streaming_content).decode()
+        self.assertIn('<strong>Registros:</strong> 12', html)
+        self.assertEqual(html.count('<strong>#'), 12)
+        self.assertNotIn('Nenhum registro encontrado', html)
+
+    def test_acima_do_limite_oferece_exportacao(self):
+        with mock.patch.object(relatorios, 'LIMITE_IMPRESSAO', 10):
+            response = self.client.get(reverse('avaria_search'), {'print': '1', 'nf': 'NF'})
+        self.assertFalse(response.streaming)
+        self.assertContains(response, 'Exportar em segundo plano')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse('avaria_search_export'), {'nf': 'NF'})
+        exportacao = Exportacao.objects.get()
+        self.assertRedirects(response, reverse('exportacao_detail', args=[exportacao.pk]))
+
+        exportacao.refresh_from_db()
+        self.assertEqual(exportacao.status, 'CONCLUIDA')
+        self.assertEqual((exportacao.total, exportacao.processados), (12, 12))
+
+        response = self.client.get(reverse('exportacao_download', args=[exportacao.pk]))
+        html = b''.join(response.streaming_content).decode()
+        self.assertEqual(html.count('<strong>#'), 12)
+        response.close()
+
+
+class AvariaEventoTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='gestor', password='password')
+        self.user.groups.add(Group.objects.get_or_create(name='Gestor')[0])
+        self.client.login(username='gestor', password='password')
+        cliente = Cliente.objects.create(razao_social="Cliente Teste", cnpj="11111111111111")
+        self.avaria = Avaria.objects.create(cliente=cliente, nota_fiscal='123', criado_por=self.user)
+
+    def test_observacao_e_um_insert(self):
+        url = reverse('avaria_detail', args=[self.avaria.pk])
+        with CaptureQueriesContext(connection) as ctx:
+            self.client.post(url, {'add_observacao': '1', 'texto': 'Cliente ligou'})
+        escritas = [q['sql'] for q in ctx.captured_queries if q['sql'].startswith(('INSERT', 'UPDATE'))]
+        self.assertEqual(len(escritas), 1)
+        self.assertIn('app_avarias_avariaevento', escritas[0])
+        evento = AvariaEvento.objects.get(avaria=self.avaria)
+        self.assertEqual((evento.tipo, evento.autor, evento.texto), ('OBSERVACAO', 'gestor', 'Cliente ligou'))
+
+    def test_historico_em_texto(self):
+        registrar_evento(self.avaria, 'DECISAO', self.user, acao='ACEITAR', nf_retida='SIM', horas_retencao=5)
+        registrar_evento(self.avaria, 'OBSERVACAO', self.user, 'Segunda entrada')
+        historico = self.avaria.observacoes
+        self.assertIn('[DECISÃO: ACEITAR] | [NF RETIDA NA CONFERÊNCIA: SIM (5h)]', historico)
+        self.assertTrue(historico.endswith('- gestor] Segunda entrada'))
+
+
+
+class MigracaoObservacoesTests(TransactionTestCase):
+    """0020_migrar_observacoes, rodada no schema da época (antes de 0020)."""
+    anterior = [('app_avarias', '0019_avariaevento')]
+
+    def setUp(self):
+        executor = MigrationExecutor(connection)
+        executor.migrate(self.anterior)
+        self.apps = executor.loader.project_state(self.anterior).apps
+
+    def tearDown(self):
+        executor = MigrationExecutor(connection)
+        executor.migrate(executor.loader.graph.leaf_nodes())
+
+    def test_interpretar_texto_legado(self):
+        padrao = timezone.now()
+        texto = (
+            "Anotação solta\n\n"
+            "[01/02/2024 10:30 - ana] [ABERTURA] Caixa amassada\n\n"
+            "[02/02/2024 08:00 - joao] Cliente avisado\ncontinua aqui"
+        )
+        entradas = migracao_observacoes.interpretar_texto_legado(texto, padrao)
+        self.assertEqual([e['tipo'] for e in entradas], ['LEGADO', 'ABERTURA', 'OBSERVACAO'])
+        self.assertEqual(entradas[0]['timestamp'], padrao)
+        self.assertEqual(entradas[1]['autor'], 'ana')
+        self.assertEqual(entradas[2]['texto'], "[02/02/2024 08:00 - joao] Cliente avisado\ncontinua aqui")
+
+    def test_rodar_de_novo_nao_duplica(self):
+        ana = self.apps.get_model('app_avarias', 'Usuario').objects.create(username='ana')
+        cliente = self.apps.get_model('app_avarias', 'Cliente').objects.create(razao_social="Cliente", cnpj="11111111111111")
+        self.apps.get_model('app_avarias', 'Avaria').objects.create(
+            cliente=cliente, nota_fiscal='1', criado_por=ana,
+            observacoes="[01/02/2024 10:30 - ana] [ABERTURA] Caixa amassada\n\n[02/02/2024 08:00 - ana] Cliente avisado",
+        )
+        AvariaEvento = self.apps.get_model('app_avarias', 'AvariaEvento')
+
+        migracao_observacoes.observacoes_para_eventos(self.apps, None)
+        # A re-run after a failure halfway skips what was already migrated
+        migracao_observacoes.observacoes_para_eventos(self.apps, None)
+        self.assertEqual(list(AvariaEvento.objects.order_by('timestamp').values_list('tipo', 'usuario_id')),
+                         [('ABERTURA', ana.pk), ('OBSERVACAO', ana.pk)])
+
+
+class EdicaoItensTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='gestor', password='password')
+        self.user.groups.add(Group.objects.get_or_create(name='Gestor')[0])
+        self.client.login(username='gestor', password='password')
+        cliente = Cliente.objects.create(razao_social="Cliente Teste", cnpj="11111111111111")
+        self.avaria = Avaria.objects.create(cliente=cliente, nota_fiscal='123', criado_por=self.user)
+        self.produtos = Produto.objects.bulk_create([Produto(nome=f"Produto {i}", codigo_controle=f"P{i}") for i in range(150)])
+
+    def editar(self, itens, novos):
+        dados = {
+            'update_itens': '1',
+            'item_id[]': [item.pk for item in itens],
+            'lote[]': [f'L{item.pk}' for item in itens],
+            'quantidade[]': ['7'] * len(itens),
+            'novo_produto_id[]': [produto.pk for produto in novos],
+            'novo_lote[]': ['NOVO'] * len(novos),
+            'novo_quantidade[]': ['2'] * len(novos),
+        }
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.post(reverse('avaria_detail', args=[self.avaria.pk]), dados)
+        self.assertEqual(response.status_code, 302)
+        return len(ctx.captured_queries)
+
+    def test_consultas_nao_crescem_com_as_linhas(self):
+        AvariaItem.objects.bulk_create([AvariaItem(avaria=self.avaria, produto=p) for p in self.produtos[:3]])
+        poucas = self.editar(list(self.avaria.itens.all()), self.produtos[3:5])
+
+        AvariaItem.objects.bulk_create([AvariaItem(avaria=self.avaria, produto=p) for p in self.produtos[:120]])
+        itens = list(self.avaria.itens.all())
+        muitas = self.editar(itens, self.produtos[:130])
+        self.assertEqual(muitas, poucas)
+
+        self.assertEqual(self.avaria.itens.count(), len(itens) + 130)
+        self.assertEqual(self.avaria.itens.filter(quantidade=7, lote__startswith='L').count(), len(itens))
+        self.assertEqual(self.avaria.itens.filter(lote='NOVO', quantidade=2).count(), 130)
+
+    def test_remove_itens_e_ignora_produto_invalido(self):
+        mantido, removido = AvariaItem.objects.bulk_create(
+            [AvariaItem(avaria=self.avaria, produto=p) for p in self.produtos[:2]]
+        )
+        dados = {'update_itens': '1', 'item_id[]': [mantido.pk], 'novo_produto_id[]': ['999999', 'abc']}
+        self.client.post(reverse('avaria_detail', args=[self.avaria.pk]), dados)
+        self.assertEqual(list(self.avaria.itens.values_list('pk', flat=True)), [mantido.pk])
+        self.assertTrue(self.avaria.eventos.filter(tipo='EDICAO_ITENS').exists())
+
+
+@override_settings(CACHES=LOCMEM_CACHE, BACKGROUND_TASKS_EAGER=True)
+class AvariaCreateTests(TransactionTestCase):
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        media = override_settings(MEDIA_ROOT=media_root)
+        media.enable()
+        self.addCleanup(media.disable)
+
+        self.user = User.objects.create_user(username='gestor', password='password')
+        self.user.groups.add(Group.objects.get_or_create(name='Gestor')[0])
+        self.client.login(username='gestor', password='password')
+        self.cliente = Cliente.objects.create(razao_social="Cliente Teste", cnpj="11111111111111")
+        self.veiculo = Veiculo.objects.create(placa="ABC1234", tipo="PRINCIPAL")
+        self.condutor = Condutor.objects.create(nome="Motorista Teste", cpf="11122233344")
+        self.produtos = Produto.objects.bulk_create(
+            [Produto(nome=f"Produto {i}", codigo_controle=f"P{i}") for i in range(3)]
+        )
+
+    def dados(self, **extra):
+        dados = {
+            'cliente': self.cliente.pk, 'nota_fiscal': 'NF1', 'valor_nf': '100.00',
+            'veiculo': self.veiculo.pk, 'motorista': self.condutor.pk, 'criado_por': self.user.pk,
+            'observacoes': 'Caixa amassada',
+            'produto[]': [p.pk for p in self.produtos] + ['999999'],
+            'quantidade[]': ['1', '2', '3', '4'],
+            'lote[]': ['L1', 'L2', 'L3', 'L4'],
+        }
+        dados.update(extra)
+        return dados
+
+    def test_cria_itens_em_lote_e_fotos_na_transacao(self):
+        em_transacao = []
+        criar_foto = AvariaFoto.objects.create
+
+        def registrar_criacao(**kwargs):
+            # The file is already in storage when the row is created
+            em_transacao.append((connection.in_atomic_block, AvariaFoto.arquivo.field.storage.exists(kwargs['arquivo'])))
+            return criar_foto(**kwargs)
+
+        foto = SimpleUploadedFile("foto.gif", GIF_1X1, content_type="image/gif")
+        with mock.patch.object(AvariaFoto.objects, 'create', side_effect=registrar_criacao):
+            response = self.client.post(reverse('avaria_create'), self.dados(fotos=[foto]))
+        self.assertEqual(response.status_code, 302)
+        avaria = Avaria.objects.get(nota_fiscal='NF1')
+        self.assertEqual(sorted(avaria.itens.values_list('quantidade', flat=True)), [1, 2, 3])
+        self.assertEqual(avaria.eventos.get().tipo, 'ABERTURA')
+        self.assertEqual(avaria.fotos.count(), 1)
+        self.assertEqual(em_transacao, [(True, True)])
+
+    def test_falha_na_foto_desfaz_a_avaria(self):
+        foto = SimpleUploadedFile("foto.gif", GIF_1X1, content_type="image/gif")
+        with mock.patch.object(AvariaFoto.objects, 'create', side_effect=DatabaseError):
+            with self.assertRaises(DatabaseError):
+                self.client.post(reverse('avaria_create'), self.dados(fotos=[foto]))
+        self.assertFalse(Avaria.objects.exists())
+
+    def test_falha_ao_gravar_foto_mostra_erro(self):
+        foto = SimpleUploadedFile("foto.gif", GIF_1X1, content_type="image/gif")
+        with mock.patch.object(AvariaFoto.arquivo.field.storage, 'save', side_effect=OSError):
+            with self.assertLogs('app_avarias.crud_views', 'ERROR'):
+                response = self.client.post(reverse('avaria_create'), self.dados(fotos=[foto]))
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'Não foi possível salvar as fotos')
+        self.assertFalse(Avaria.objects.exists())
+
+    def test_falha_nos_itens_desfaz_a_avaria(self):
+        with mock.patch.object(AvariaItem.objects, 'bulk_create', side_effect=DatabaseError):
+            with self.assertRaises(DatabaseError):
+                self.client.post(reverse('avaria_create'), self.dados())
+        self.assertFalse(Avaria.objects.exists())
+        self.assertFalse(AvariaEvento.objects.exists())
+
+
+
+def jpeg_de_celular(largura=3000, altura=2000):
+    """JPEG com EXIF de orientação (girar 90°) e de fabricante, como o de uma câmera."""
+    exif = Image.Exif()
+    exif[0x0112] = 6  # Orientation
+    exif[0x010F] = 'Fabricante'  # Make
+    saida = BytesIO()
+    Image.new('RGB', (largura, altura), 'red').save(saida, 'JPEG', exif=exif)
+    return saida.getvalue()
+
+
+@override_settings(CACHES=LOCMEM_CACHE, BACKGROUND_TASKS_EAGER=True)
+class FotoVersoesTests(TestCase):
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        media = override_settings(MEDIA_ROOT=media_root)
+        media.enable()
+        self.addCleanup(media.disable)
+
+        self.user = User.objects.create_user(username='gestor', password='password')
+        cliente = Cliente.objects.create(razao_social="Cliente Teste", cnpj="11111111111111")
+        self.avaria = Avaria.objects.create(cliente=cliente, nota_fiscal='123', criado_por=self.user)
+
+    def test_versoes_sem_exif_e_com_rotacao(self):
+        original = jpeg_de_celular()
+        with self.captureOnCommitCallbacks(execute=True):
+            foto = AvariaFoto.objects.create(
+                avaria=self.avaria, arquivo=SimpleUploadedFile('camera.jpg', original, content_type='image/jpeg'),
+            )
+        foto.refresh_from_db()
+        self.assertIsNotNone(foto.processada_em)
+
+        for campo, lado in (('web', 1600), ('miniatura', 400), ('impressao', 1200)):
+            with getattr(foto, campo).open('rb') as arquivo:
+                imagem = Image.open(arquivo)
+                # Retrato: a rotação do EXIF foi aplicada nos pixels
+                largura, altura = imagem.size
+                self.assertEqual(altura, lado)
+                self.assertLess(largura, altura)
+                self.assertEqual(len(imagem.getexif()), 0)
+        self.assertEqual(foto.url_miniatura, foto.miniatura.url)
+
+        # O original fica como foi enviado
+        with foto.arquivo.open('rb') as arquivo:
+            self.assertEqual(arquivo.read(), original)
+
+    def test_original_enquanto_nao_processada(self):
+        with mock.patch('app_avarias.signals.run_in_background'):
+            with self.captureOnCommitCallbacks(execute=True):
+                foto = AvariaFoto.objects.create(avaria=self.avaria, arquivo=SimpleUploadedFile('a.gif', GIF_1X1))
+        self.assertEqual(foto.url_web, foto.arquivo.url)
+        self.assertEqual(foto.url_impressao, foto.arquivo.url)
+
+
+
+@override_settings(CACHES=LOCMEM_CACHE, BACKGROUND_TASKS_EAGER=True)
+class FotoArmazenamentoTests(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+        media = override_settings(MEDIA_ROOT=self.media_root)
+        media.enable()
+        self.addCleanup(media.disable)
+
+        self.user = User.objects.create_user(username='gestor', password='password')
+        cliente = Cliente.objects.create(razao_social="Cliente Teste", cnpj="11111111111111")
+        self.avaria = Avaria.objects.create(cliente=cliente, nota_fiscal='123', criado_por=self.user)
+
+    def arquivos_em_disco(self):
+        return sorted(
+            os.path.relpath(os.path.join(raiz, nome), self.media_root)
+            for raiz, _, nomes in os.walk(self.media_root) for nome in nomes
+        )
+
+    def test_mesmo_conteudo_gravado_uma_vez(self):
+        conteudo = jpeg_de_celular(300, 200)
+        with self.captureOnCommitCallbacks(execute=True):
+            primeira = AvariaFoto.objects.create(avaria=self.avaria, arquivo=SimpleUploadedFile('a.jpg', conteudo))
+            segunda = AvariaFoto.objects.create(avaria=self.avaria, arquivo=SimpleUploadedFile('b.JPG', conteudo))
+        primeira.refresh_from_db()
+        segunda.refresh_from_db()
+
+        self.assertEqual(primeira.arquivo.name, segunda.arquivo.name)
+        self.assertTrue(primeira.arquivo.name.startswith(PREFIXO + '/'))
+        self.assertEqual(primeira.miniatura.name, segunda.miniatura.name)
+        # 1 original + 3 renditions
+        self.assertEqual(len(self.arquivos_em_disco()), 4)
+
+    def test_deduplicar_fotos_existentes(self):
+        pasta = os.path.join(self.media_root, 'avarias_fotos', '2024', '01', '01')
+        os.makedirs(pasta)
+        repetido, unico = jpeg_de_celular(300, 200), jpeg_de_celular(200, 300)
+        for nome, conteudo in (('a.jpg', repetido), ('b.jpg', repetido), ('c.jpg', unico)):
+            with open(os.path.join(pasta, nome), 'wb') as arquivo:
+                arquivo.write(conteudo)
+        fotos = [
+            AvariaFoto.objects.create(avaria=self.avaria, arquivo=f'avarias_fotos/2024/01/01/{nome}')
+            for nome in ('a.jpg', 'b.jpg', 'c.jpg')
+        ]
+
+        saida = StringIO()
+        call_command('deduplicar_fotos', stdout=saida, stderr=StringIO())
+
+        a, b, c = [AvariaFoto.objects.get(pk=foto.pk).arquivo for foto in fotos]
+        self.assertEqual(a.name, b.name)
+        self.assertNotEqual(a.name, c.name)
+        with a.open('rb') as arquivo:
+            self.assertEqual(arquivo.read(), repetido)
+        self.assertEqual(self.arquivos_em_disco(), sorted([a.name, c.name]))
+        self.assertIn('1 duplicado(s) removido(s)', saida.getvalue())
+
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class AvariaPdfTests(TestCase):
+    def setUp(self):
+        pasta = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, pasta, ignore_errors=True)
+        self.pasta_pdf = f'{pasta}/pdf'
+        pastas = override_settings(MEDIA_ROOT=f'{pasta}/media', PDF_CACHE_DIR=self.pasta_pdf)
+        pastas.enable()
+        self.addCleanup(pastas.disable)
+
+        self.user = User.objects.create_user(username='gestor', password='password')
+        self.client.login(username='gestor', password='password')
+        cliente = Cliente.objects.create(razao_social="Farmácia São João", cnpj="11111111111111")
+        self.avaria = Avaria.objects.create(cliente=cliente, nota_fiscal='123', criado_por=self.user)
+        produto = Produto.objects.create(nome="Dipirona", laboratorio="EMS", codigo_controle="P1")
+        AvariaItem.objects.create(avaria=self.avaria, produto=produto, quantidade=3)
+        registrar_evento(self.avaria, 'AJUSTE_VALOR', self.user, valor_anterior='10', valor_novo='20', motivo='NF')
+
+    def baixar(self, **params):
+        return self.client.get(reverse('avaria_pdf', args=[self.avaria.pk]), params)
+
+    def test_pdf_em_cache_ate_a_avaria_mudar(self):
+        with mock.patch.object(pdf, 'gerar_pdf', wraps=pdf.gerar_pdf) as gerar:
+            response = self.baixar()
+            self.assertEqual(response['Content-Type'], 'application/pdf')
+            self.assertTrue(b''.join(response.streaming_content).startswith(b'%PDF'))
+            response.close()
+            self.baixar().close()
+            self.assertEqual(gerar.call_count, 1)
+
+            registrar_evento(self.avaria, 'OBSERVACAO', self.user, 'Nova observação')
+            self.baixar().close()
+            self.assertEqual(gerar.call_count, 2)
+        # Only the current version stays on disk
+        self.assertEqual(len(os.listdir(self.pasta_pdf)), 1)
+
+    def test_etag(self):
+        response = self.baixar()
+        response.close()
+        response = self.client.get(
+            reverse('avaria_pdf', args=[self.avaria.pk]), HTTP_IF_NONE_MATCH=response['ETag'],
+        )
+        self.assertEqual(response.status_code, 304)
+
+    def test_fotos_reduzidas(self):
+        AvariaFoto.objects.create(
+            avaria=self.avaria, arquivo=SimpleUploadedFile('camera.jpg', jpeg_de_celular(3000, 2000)),
+        )
+        response = self.baixar(fotos='1')
+        conteudo = b''.join(response.streaming_content)
+        response.close()
+        self.assertTrue(conteudo.startswith(b'%PDF'))
+        self.assertIn(b'/Width 800', conteudo)  # 3000x2000 rotated, reduced to 1200 px tall
+
+
+@override_settings(CACHES=LOCMEM_CACHE, BACKGROUND_TASKS_EAGER=True)
+class ExportacaoFichasTests(TestCase):
+    def setUp(self):
+        pasta = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, pasta, ignore_errors=True)
+        pastas = override_settings(MEDIA_ROOT=f'{pasta}/media', PDF_CACHE_DIR=f'{pasta}/pdf')
+        pastas.enable()
+        self.addCleanup(pastas.disable)
+
+        self.user = User.objects.create_user(username='gestor', password='password')
+        self.user.groups.add(Group.objects.get_or_create(name='Gestor')[0])
+        self.client.login(username='gestor', password='password')
+        cliente = Cliente.objects.create(razao_social="Cliente Teste", cnpj="11111111111111")
+        self.avarias = [
+            Avaria.objects.create(cliente=cliente, nota_fiscal=f"NF{i}", criado_por=self.user) for i in range(3)
+        ]
+        Avaria.objects.create(cliente=cliente, nota_fiscal="OUTRA", criado_por=self.user)
+        self.foto = AvariaFoto.objects.create(
+            avaria=self.avarias[0], arquivo=SimpleUploadedFile('camera.jpg', jpeg_de_celular(40, 30)),
+        )
+
+    def exportar(self, tipo):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse('avaria_search_export'), {'nf': 'NF', 'tipo': tipo})
+        exportacao = Exportacao.objects.get(tipo=tipo)
+        self.assertRedirects(response, reverse('exportacao_detail', args=[exportacao.pk]))
+        exportacao.refresh_from_db()
+        self.assertEqual(exportacao.status, 'CONCLUIDA', exportacao.erro)
+        self.assertEqual((exportacao.total, exportacao.processados), (3, 3))
+        return exportacao
+
+    def test_zip_com_fichas_e_fotos(self):
+        exportacao = self.exportar('FICHAS_ZIP')
+        with exportacao.arquivo.open('rb') as arquivo, zipfile.ZipFile(arquivo) as zf:
+            nomes = set(zf.namelist())
+            foto = zf.read(f'avaria_{self.avarias[0].pk}/fotos/foto_{self.foto.pk}.jpg')
+        self.assertEqual(nomes, {f'avaria_{a.pk}/ficha_{a.pk}.pdf' for a in self.avarias} | {
+            f'avaria_{self.avarias[0].pk}/fotos/foto_{self.foto.pk}.jpg',
+        })
+        with self.foto.arquivo.open('rb') as original:
+            self.assertEqual(foto, original.read())
+
+    def test_pdf_unico(self):
+        exportacao = self.exportar('FICHAS_PDF')
+        with exportacao.arquivo.open('rb') as arquivo:
+            conteudo = arquivo.read()
+        self.assertTrue(conteudo.startswith(b'%PDF'))
+        self.assertIn(b'/Count 3', conteudo)  # one page per ficha
+
+    def test_pdf_unico_acima_do_limite(self):
+        with mock.patch.object(relatorios, 'LIMITE_FICHAS_PDF', 2), self.assertLogs('app_avarias.relatorios', 'ERROR'):
+            with self.captureOnCommitCallbacks(execute=True):
+                self.client.post(reverse('avaria_search_export'), {'nf': 'NF', 'tipo': 'FICHAS_PDF'})
+        self.assertEqual(Exportacao.objects.get().status, 'ERRO')
+
+    def test_erro_ao_preparar_a_exportacao(self):
+        with mock.patch.object(relatorios, 'filtrar_pesquisa', side_effect=DatabaseError('sem conexão')), \
+                self.assertLogs('app_avarias.relatorios', 'ERROR'):
+            with self.captureOnCommitCallbacks(execute=True):
+                self.client.post(reverse('avaria_search_export'), {'nf': 'NF', 'tipo': 'FICHAS_ZIP'})
+        self.assertEqual(Exportacao.objects.values_list('status', 'erro').get(), ('ERRO', 'sem conexão'))
+
+    def test_exportacao_interrompida(self):
+        # Requested, but the process restarted before generating it
+        self.client.post(reverse('avaria_search_export'), {'nf': 'NF', 'tipo': 'FICHAS_ZIP'})
+        exportacao = Exportacao.objects.get()
+        response = self.client.get(reverse('exportacao_detail', args=[exportacao.pk]))
+        self.assertEqual(response.context['exportacao'].status, 'PENDENTE')
+
+        Exportacao.objects.update(data_criacao=timezone.now() - timedelta(hours=relatorios.EXPORTACAO_HORAS_LIMITE + 1))
+        response = self.client.get(reverse('exportacao_detail', args=[exportacao.pk]))
+        self.assertEqual(response.context['exportacao'].status, 'ERRO')
+        self.assertContains(response, "interrompida")
+
+    def test_comando_marca_as_interrompidas(self):
+        antiga = Exportacao.objects.create(usuario=self.user, tipo='FICHAS_ZIP', status='PROCESSANDO')
+        Exportacao.objects.update(data_criacao=timezone.now() - timedelta(hours=relatorios.EXPORTACAO_HORAS_LIMITE + 1))
+        recente = Exportacao.objects.create(usuario=self.user, tipo='FICHAS_ZIP')
+
+        call_command('marcar_exportacoes_interrompidas', stdout=StringIO())
+        antiga.refresh_from_db()
+        recente.refresh_from_db()
+        self.assertEqual((antiga.status, recente.status), ('ERRO', 'PENDENTE'))
+
+    def test_download_com_range(self):
+        exportacao = self.exportar('FICHAS_ZIP')
+        url = reverse('exportacao_download', args=[exportacao.pk])
+        with exportacao.arquivo.open('rb') as arquivo:
+            conteudo = arquivo.read()
+
+        response = self.client.get(url)
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        self.assertEqual(b''.join(response.streaming_content), conteudo)
+        response.close()
+
+        response = self.client.get(url, HTTP_RANGE='bytes=10-', HTTP_IF_RANGE=response['ETag'])
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], f'bytes 10-{len(conteudo) - 1}/{len(conteudo)}')
+        self.assertEqual(b''.join(response.streaming_content), conteudo[10:])
+
+        response = self.client.get(url, HTTP_RANGE='bytes=-5')
+        self.assertEqual(b''.join(response.streaming_content), conteudo[-5:])
+
+        response = self.client.get(url, HTTP_RANGE=f'bytes={len(conteudo)}-')
+        self.assertEqual(response.status_code, 416)
+        # A stale If-Range gets the whole file again
+        response = self.client.get(url, HTTP_RANGE='bytes=10-', HTTP_IF_RANGE='"outro"')
+        self.assertEqual(response.status_code, 200)
+        response.close()
+
+
+@override_settings(CACHES=LOCMEM_CACHE, BACKGROUND_TASKS_EAGER=True)
+class PlanilhaTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='gestor', password='password')
+        self.user.groups.add(Group.objects.get_or_create(name='Gestor')[0])
+        self.client.login(username='gestor', password='password')
+        cliente = Cliente.objects.create(razao_social="Farmácia; São João", cnpj="11111111111111")
+        dipirona = Produto.objects.create(nome="Dipirona", laboratorio="EMS", codigo_controle="P1")
+        agora = timezone.now()
+        self.avaria = Avaria.objects.create(
+            cliente=cliente, nota_fiscal='NF1', criado_por=self.user, valor_nf=Decimal('150.50'),
+            status='FINALIZADA', tipo_finalizacao='DEVOLUCAO_CONCLUIDA', responsavel_prejuizo='TRANSBIRDAY',
+            data_decisao=agora, data_finalizacao=agora,
+        )
+        AvariaItem.objects.create(avaria=self.avaria, produto=dipirona, lote='L1', quantidade=2)
+        AvariaItem.objects.create(
+            avaria=self.avaria, produto=Produto.objects.create(nome="Buscopan", laboratorio="Boehringer", codigo_controle="P2"),
+            lote='L2', quantidade=5,
+        )
+        # Older avaria, from before items existed
+        self.antiga = Avaria.objects.create(
+            cliente=cliente, nota_fiscal='NF2', criado_por=self.user, produto=dipirona, lote='L9', quantidade=1,
+        )
+
+    def baixar(self, url, params):
+        # Rows come from values_list: building Avaria instances would mean O(n) memory
+        with mock.patch.object(Avaria, 'from_db', side_effect=AssertionError("model instanciado")):
+            response = self.client.get(url, params)
+            self.assertTrue(response.streaming)
+            return b''.join(response.streaming_content)
+
+    def test_csv_da_pesquisa_com_uma_linha_por_item(self):
+        conteudo = self.baixar(reverse('avaria_search'), {'nf': 'NF', 'formato': 'csv'}).decode('utf-8')
+        self.assertTrue(conteudo.startswith('\ufeffID;Data Criação;Status;'))
+        linhas = conteudo.lstrip('\ufeff').splitlines()
+        self.assertEqual(len(linhas), 4)
+        por_lote = {linha.split(';')[-2]: linha for linha in linhas[1:]}
+        self.assertIn('"Farmácia; São João"', por_lote['L1'])
+        self.assertIn(';150,50;', por_lote['L1'])
+        self.assertNotIn('150,50', por_lote['L2'])  # valor NF only on the avaria's first row
+        self.assertTrue(por_lote['L9'].endswith(';Dipirona;EMS;L9;1'))
+        self.assertIn(';Finalizada;', por_lote['L1'])
+
+    def test_xlsx_da_pesquisa(self):
+        conteudo = self.baixar(reverse('avaria_search'), {'formato': 'xlsx'})
+        with zipfile.ZipFile(BytesIO(conteudo)) as zf:
+            self.assertIn('xl/workbook.xml', zf.namelist())
+            folha = zf.read('xl/worksheets/sheet1.xml').decode('utf-8')
+        self.assertEqual(folha.count('<row '), 4)
+        self.assertIn('<v>150.50</v>', folha)
+        self.assertIn('<t xml:space="preserve">Buscopan</t>', folha)
+
+    def test_prejuizos_do_dashboard(self):
+        response = self.client.get(reverse('dashboard_export'), {'periodo': '12m', 'formato': 'csv'})
+        linhas = b''.join(response.streaming_content).decode('utf-8').lstrip('\ufeff').splitlines()
+        self.assertEqual(linhas[0], 'Mês;Cliente;Parceiro;Transbirday')
+        self.assertEqual(linhas[1], f'{timezone.localdate():%m/%Y};;;150,50')
+
+        conteudo = self.baixar(reverse('dashboard_export'), {'periodo': '5y', 'formato': 'csv', 'detalhado': '1'})
+        linhas = conteudo.decode('utf-8').lstrip('\ufeff').splitlines()
+        self.assertEqual(len(linhas), 3)  # only the finalized avaria, one row per item
+        self.assertTrue(linhas[1].startswith(f'{timezone.localdate().year};{self.avaria.pk};'))
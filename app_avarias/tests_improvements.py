@@ -4,6 +4,7 @@ from django.utils import timezone
 from django.contrib.auth import get_user_model
 from django.core.files.uploadedfile import SimpleUploadedFile
 from app_avarias.models import Avaria, Cliente, Produto, Veiculo, Condutor
+from app_avarias.eventos import registrar_evento
 
 User = get_user_model()
 
@@ -93,9 +94,9 @@ class ImprovementTests(TestCase):
         avaria = Avaria.objects.create(
             cliente=self.cliente, produto=self.produto, nota_fiscal="555",
             veiculo=self.veiculo, motorista=self.condutor,
-            status='EM_ROTA_DEVOLUCAO', criado_por=self.user,
-            observacoes="Previous logs..."
+            status='EM_ROTA_DEVOLUCAO', criado_por=self.user
         )
+        registrar_evento(avaria, 'OBSERVACAO', texto="Previous logs...")
         url = reverse('avaria_detail', kwargs={'pk': avaria.pk})
         
         # Prepare file for upload
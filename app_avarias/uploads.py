@@ -0,0 +1,180 @@
+"""
+Upload de fotos em partes, retomável (app mobile).
+
+Protocolo (ver app_api/views.py):
+
+1. iniciar: o app informa nome e tamanho; recebe o id do upload;
+2. enviar partes: cada parte informa o offset em que começa. O corpo vai direto
+   para o arquivo parcial, em blocos, sem passar inteiro pela memória. Se a
+   conexão cair, o app consulta o offset já gravado e continua dali;
+3. finalizar: o app informa o SHA-256 do arquivo. Conferido, o arquivo vira
+   uma AvariaFoto e o parcial é apagado. Finalizar de novo devolve a mesma foto
+   (ou 410, se ela já foi excluída).
+
+Cada upload tem o próprio arquivo parcial, então várias fotos da mesma Avaria
+podem ser enviadas em paralelo. Partes do mesmo upload são serializadas por um
+lock no arquivo parcial.
+"""
+import hashlib
+import os
+from contextlib import contextmanager
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.files import File, locks
+from django.db import transaction
+from django.utils import timezone
+from PIL import Image, UnidentifiedImageError
+
+from .models import AvariaFoto, UploadFoto
+
+TAMANHO_BLOCO = 64 * 1024
+
+
+class UploadInvalido(ValueError):
+    pass
+
+
+class OffsetIncorreto(UploadInvalido):
+    """A parte não começa onde o upload parou; o app deve retomar de recebido."""
+
+    def __init__(self, recebido):
+        super().__init__(f"O upload está no byte {recebido}.")
+        self.recebido = recebido
+
+
+class FotoRemovida(Exception):
+    """O upload já foi concluído, mas a foto criada por ele foi excluída depois."""
+
+
+def _foto_concluida(upload):
+    if upload.foto is None:
+        raise FotoRemovida("A foto deste upload foi excluída.")
+    return upload.foto
+
+
+def _pasta():
+    return getattr(settings, 'UPLOADS_PARCIAIS_DIR', os.path.join(settings.BASE_DIR, 'uploads_parciais'))
+
+
+def caminho_parcial(upload):
+    return os.path.join(_pasta(), f'{upload.pk}.part')
+
+
+@contextmanager
+def _travado(upload, modo):
+    """Abre o arquivo parcial com lock exclusivo e devolve o upload relido do banco."""
+    with open(caminho_parcial(upload), modo) as arquivo:
+        locks.lock(arquivo, locks.LOCK_EX)
+        try:
+            upload.refresh_from_db()
+            yield upload, arquivo
+        finally:
+            locks.unlock(arquivo)
+
+
+def iniciar_upload(avaria, usuario, nome, tamanho):
+    nome = os.path.basename(str(nome or '').strip())
+    try:
+        tamanho = int(tamanho)
+    except (TypeError, ValueError):
+        raise UploadInvalido("Informe o tamanho do arquivo em bytes.")
+    maximo = getattr(settings, 'UPLOAD_FOTO_TAMANHO_MAXIMO', 50 * 1024 * 1024)
+    if not nome:
+        raise UploadInvalido("Informe o nome do arquivo.")
+    if not 0 < tamanho <= maximo:
+        raise UploadInvalido(f"O tamanho deve estar entre 1 e {maximo} bytes.")
+
+    upload = UploadFoto.objects.create(avaria=avaria, usuario=usuario, nome=nome, tamanho=tamanho)
+    os.makedirs(_pasta(), exist_ok=True)
+    open(caminho_parcial(upload), 'wb').close()
+    return upload
+
+
+def gravar_parte(upload, offset, corpo, tamanho_parte):
+    """
+    Grava tamanho_parte bytes lidos de corpo (stream) a partir de offset. Se a
+    leitura for interrompida, o que chegou fica gravado e recebido é atualizado,
+    para o app retomar dali.
+    """
+    if upload.status != 'ABERTO':
+        raise UploadInvalido("Este upload já foi finalizado.")
+    with _travado(upload, 'r+b') as (upload, arquivo):
+        if upload.status != 'ABERTO':
+            raise UploadInvalido("Este upload já foi finalizado.")
+        if offset != upload.recebido:
+            raise OffsetIncorreto(upload.recebido)
+        if tamanho_parte <= 0 or offset + tamanho_parte > upload.tamanho:
+            raise UploadInvalido("A parte ultrapassa o tamanho informado do arquivo.")
+
+        arquivo.seek(offset)
+        arquivo.truncate()  # drops the tail of a previously interrupted part
+        gravados = 0
+        try:
+            while gravados < tamanho_parte:
+                bloco = corpo.read(min(TAMANHO_BLOCO, tamanho_parte - gravados))
+                if not bloco:
+                    break
+                arquivo.write(bloco)
+                gravados += len(bloco)
+        finally:
+            arquivo.flush()
+            upload.recebido = offset + gravados
+            upload.save(update_fields=['recebido', 'data_atualizacao'])
+    return upload
+
+
+def _sha256(arquivo):
+    sha = hashlib.sha256()
+    arquivo.seek(0)
+    for bloco in iter(lambda: arquivo.read(TAMANHO_BLOCO), b''):
+        sha.update(bloco)
+    return sha.hexdigest()
+
+
+def finalizar_upload(upload, sha256):
+    """Confere tamanho e SHA-256 e cria a AvariaFoto. Um checksum errado reinicia o upload."""
+    if upload.status == 'CONCLUIDO':
+        return _foto_concluida(upload)
+
+    with _travado(upload, 'r+b') as (upload, arquivo):
+        if upload.status == 'CONCLUIDO':
+            return _foto_concluida(upload)
+        if upload.recebido != upload.tamanho:
+            raise UploadInvalido(f"Upload incompleto: {upload.recebido} de {upload.tamanho} bytes.")
+        if _sha256(arquivo) != str(sha256 or '').strip().lower():
+            arquivo.seek(0)
+            arquivo.truncate()
+            upload.recebido = 0
+            upload.save(update_fields=['recebido', 'data_atualizacao'])
+            raise UploadInvalido("O SHA-256 não confere; o upload foi reiniciado.")
+        try:
+            arquivo.seek(0)
+            Image.open(arquivo).verify()
+        except (OSError, SyntaxError, ValueError, UnidentifiedImageError):
+            raise UploadInvalido("O arquivo enviado não é uma imagem válida.")
+
+        arquivo.seek(0)
+        with transaction.atomic():
+            foto = AvariaFoto.objects.create(
+                avaria=upload.avaria, criado_por=upload.usuario, arquivo=File(arquivo, name=upload.nome),
+            )
+            upload.status = 'CONCLUIDO'
+            upload.foto = foto
+            upload.save(update_fields=['status', 'foto', 'data_atualizacao'])
+
+    os.remove(caminho_parcial(upload))
+    return foto
+
+
+def remover_uploads_abandonados(horas=48):
+    """Apaga uploads não finalizados sem atividade há mais de horas horas."""
+    limite = timezone.now() - timedelta(hours=horas)
+    abandonados = list(UploadFoto.objects.filter(status='ABERTO', data_atualizacao__lt=limite))
+    for upload in abandonados:
+        try:
+            os.remove(caminho_parcial(upload))
+        except FileNotFoundError:
+            pass
+    UploadFoto.objects.filter(pk__in=[u.pk for u in abandonados]).delete()
+    return len(abandonados)
@@ -13,13 +13,19 @@ urlpatterns = [
     # Dashboard & Welcome
     path('', views.welcome, name='welcome'),
     path('dashboard/', views.dashboard, name='dashboard'),
+    path('dashboard/sla/', views.dashboard_sla_api, name='dashboard_sla_api'),
+    path('dashboard/exportar/', views.dashboard_export, name='dashboard_export'),
     
     # Avarias Management
     path('avarias/', views.avaria_list, name='avaria_list'),
     path('avarias/nova/', crud_views.AvariaCreateView.as_view(), name='avaria_create'), # CBV for Create
     path('avarias/pesquisa/', views.avaria_search, name='avaria_search'),
+    path('avarias/pesquisa/exportar/', views.avaria_search_export, name='avaria_search_export'),
+    path('exportacoes/<int:pk>/', views.exportacao_detail, name='exportacao_detail'),
+    path('exportacoes/<int:pk>/download/', views.exportacao_download, name='exportacao_download'),
     path('avarias/<int:pk>/', views.avaria_detail, name='avaria_detail'),
     path('avarias/<int:pk>/print/', views.avaria_print, name='avaria_print'),
+    path('avarias/<int:pk>/pdf/', views.avaria_pdf, name='avaria_pdf'),
     path('avarias/definicao-prejuizo/', views.avaria_definicao_prejuizo_list, name='avaria_definicao_prejuizo_list'),
 
     # Cadastros CRUDs
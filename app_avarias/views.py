@@ -1,10 +1,14 @@
+
 from django.shortcuts import render, redirect, get_object_or_404
+from django.http import FileResponse, Http404, HttpResponseNotModified, JsonResponse, StreamingHttpResponse
 from django.contrib.auth.decorators import login_required
 from django.contrib import messages
 from django.contrib.auth import logout
 from django.utils import timezone
-from django.db.models import Sum, Count, Q, F, ExpressionWrapper, DurationField, Avg, Min, Max
-from .models import Avaria, AvariaFoto, Produto
+from django.db import transaction
+from django.db.models import Count, OuterRef, Prefetch, Q, Subquery
+from django.db.models.functions import Coalesce
+from .models import Avaria, AvariaFoto, AvariaItem, Exportacao, Produto
 from .forms import (
     AvariaForm, AvariaDecisaoForm, AvariaDevolucaoForm, AvariaObservacaoForm, 
     AvariaFotoForm, AvariaFinalizacaoDevolucaoForm, AvariaDefinicaoPrejuizoForm,
@@ -12,9 +16,14 @@ from .forms import (
 )
 from .decorators import group_required
 
-from django.db.models.functions import TruncMonth, ExtractMonth, ExtractYear
-import json
-from django.core.serializers.json import DjangoJSONEncoder
+from .dashboard import DashboardStats, cached_dashboard_context, invalidate_dashboard_cache
+from .sla import como_json, slas_em_cache
+from .pagination import paginar_por_cursor, tamanho_da_pagina
+from . import search
+from .search import filtrar_pesquisa
+from . import pdf, planilhas, relatorios
+from .downloads import resposta_de_arquivo
+from .eventos import registrar_evento
 
 @login_required
 def welcome(request):
@@ -26,372 +35,113 @@ def dashboard(request):
     """
     Dashboard Home View with Advanced KPIs, Financials, Charts and SLAs
     """
-    qs_all = Avaria.objects.all()
+    stats = DashboardStats(year=request.GET.get('year'), month=request.GET.get('month'))
+
+    context = dict(cached_dashboard_context(stats.year, stats.month))
+    context.update({
+        'month_options': [{'value': m, 'selected': m == stats.month} for m in range(1, 13)],
+        'year_options': [{'value': y, 'selected': y == stats.year} for y in range(2024, 2030)],
+    })
+    return render(request, 'app_avarias/dashboard.html', context)
 
-    # --- FILTER LOGIC ---
-    now = timezone.now()
-    month_filter = request.GET.get('month')
-    year_filter = request.GET.get('year')
+@login_required
+@group_required("Gestor")
+def dashboard_export(request):
+    """
+    Planilha dos quadros de prejuízo do Dashboard (?periodo=12m|5y,
+    ?formato=csv|xlsx); com ?detalhado=1, as Avarias do período item a item.
+    """
+    periodo = request.GET.get('periodo', '12m')
+    formato = request.GET.get('formato', 'csv')
+    if periodo not in ('12m', '5y') or formato not in planilhas.FORMATOS:
+        raise Http404
+    detalhado = bool(request.GET.get('detalhado'))
+    cabecalho, linhas = relatorios.planilha_prejuizos(periodo, detalhado)
+    nome = f"prejuizos_{periodo}{'_detalhado' if detalhado else ''}_{timezone.localdate():%Y%m%d}"
+    return planilhas.resposta_planilha(formato, nome, cabecalho, linhas)
 
+@login_required
+@group_required("Gestor")
+def dashboard_sla_api(request):
+    """
+    Percentis (P50/P90/P99) e histograma dos SLAs em JSON (durações em segundos).
+    Sem ?year=&month= retorna o histórico completo.
+    """
+    year, month = request.GET.get('year'), request.GET.get('month')
     try:
-        current_month = int(month_filter) if month_filter else now.month
-        current_year = int(year_filter) if year_filter else now.year
-    except ValueError:
-        current_month = now.month
-        current_year = now.year
-
-    qs_created = qs_all.filter(data_criacao__year=current_year, data_criacao__month=current_month)
-    qs_finalized_in_period = qs_all.filter(status='FINALIZADA', data_finalizacao__year=current_year, data_finalizacao__month=current_month)
-
-    # GLOBAL COUNTERS (Unfiltered)
-    qs_open = qs_all.filter(status='EM_ABERTO')
-    qs_waiting = qs_all.filter(status='AGUARDANDO_DEVOLUCAO')
-    qs_finalized = qs_all.filter(status='FINALIZADA')
-    
-    count_open = qs_open.count()
-    count_ready_return = qs_waiting.count()
-    
-    count_monthly_returns = qs_all.filter(
-        tipo_finalizacao='DEVOLUCAO_CONCLUIDA',
-        data_finalizacao__month=current_month,
-        data_finalizacao__year=current_year
-    ).count()
-    
-    # Financials (Sum of valor_nf)
-    from decimal import Decimal
+        slas = slas_em_cache(year, month)
+    except (TypeError, ValueError):
+        return JsonResponse({'erro': 'Período inválido.'}, status=400)
+    return JsonResponse(como_json(slas))
 
-    val_open = qs_open.aggregate(total=Sum('valor_nf'))['total'] or 0
-    if isinstance(val_open, (int, float, Decimal)):
-        val_open = Decimal(str(val_open)).quantize(Decimal('0.01'))
-    
-    val_returned = qs_finalized.filter(tipo_finalizacao='DEVOLUCAO_CONCLUIDA').aggregate(total=Sum('valor_nf'))['total'] or 0
-    if isinstance(val_returned, (int, float, Decimal)):
-        val_returned = Decimal(str(val_returned)).quantize(Decimal('0.01'))
-    
-    val_accepted = qs_finalized.filter(tipo_finalizacao='ACEITE').aggregate(total=Sum('valor_nf'))['total'] or 0
-    if isinstance(val_accepted, (int, float, Decimal)):
-        val_accepted = Decimal(str(val_accepted)).quantize(Decimal('0.01'))
-    
-    total_finished_decided = qs_finalized.filter(tipo_finalizacao__in=['ACEITE', 'DEVOLUCAO_CONCLUIDA']).count()
-    count_accepted = qs_finalized.filter(tipo_finalizacao='ACEITE').count()
-    
-    acceptance_rate = 0
-    if total_finished_decided > 0:
-        acceptance_rate = (count_accepted / total_finished_decided) * 100
+@login_required
+@group_required("Gestor")
+def avaria_search(request):
+    formato = request.GET.get('formato')
+    if formato in planilhas.FORMATOS:
+        cabecalho, linhas = relatorios.planilha_pesquisa(request.GET)
+        return planilhas.resposta_planilha(formato, f'pesquisa_avarias_{timezone.localdate():%Y%m%d}', cabecalho, linhas)
 
-    # 2. CHARTS DATA
-    
-    # A. Monthly Evolution (Created vs Finalized)
-    evolution_data = (
-        qs_all
-        .annotate(month=TruncMonth('data_criacao'))
-        .values('month')
-        .annotate(total_created=Count('id'))
-        .order_by('month')
-    )
-    evolution_data = list(evolution_data)
-    for d in evolution_data:
-        if d['month']:
-            d['month'] = d['month'].strftime('%Y-%m-%d')
-    
-    # Evolution: Returns (By Finalization Date)
-    evolution_returns = (
-        qs_finalized
-        .filter(tipo_finalizacao='DEVOLUCAO_CONCLUIDA')
-        .annotate(month=TruncMonth('data_finalizacao'))
-        .values('month')
-        .annotate(total=Count('id'))
-        .order_by('month')
-    )
-    evolution_returns = list(evolution_returns)
-    for d in evolution_returns:
-        if d['month']:
-            d['month'] = d['month'].strftime('%Y-%m-%d')
-
-    # Evolution: Accepted (By Finalization Date)
-    evolution_accepted = (
-        qs_finalized
-        .filter(tipo_finalizacao='ACEITE')
-        .annotate(month=TruncMonth('data_finalizacao'))
-        .values('month')
-        .annotate(total=Count('id'))
-        .order_by('month')
-    )
-    evolution_accepted = list(evolution_accepted)
-    for d in evolution_accepted:
-        if d['month']:
-            d['month'] = d['month'].strftime('%Y-%m-%d')
-
-    # B. Client Acceptance vs Rejection (Global)
-    client_stats = (
-        qs_finalized
-        .values('cliente__razao_social')
-        .annotate(
-            accepted=Count('id', filter=Q(tipo_finalizacao='ACEITE')),
-            returned=Count('id', filter=Q(tipo_finalizacao='DEVOLUCAO_CONCLUIDA'))
-        )
-        .order_by('-accepted')[:10]
-    )
-    
-    # D. Heatmap (Global)
-    raw_locations = list(qs_all
-        .exclude(local_atuacao__isnull=True)
-        .values('local_atuacao')
-        .annotate(total=Count('id')))
-        
-    # Map to BR states
-    import re
-    state_counts = {}
-    valid_states = [
-        'ac', 'al', 'ap', 'am', 'ba', 'ce', 'df', 'es', 'go', 'ma', 'mt', 'ms', 'mg', 
-        'pa', 'pb', 'pr', 'pe', 'pi', 'rj', 'rn', 'rs', 'ro', 'rr', 'sc', 'sp', 'se', 'to'
-    ]
-    
-    for item in raw_locations:
-        loc_str = (item['local_atuacao'] or "").lower()
-        cnt = item['total']
-        match = re.search(r'\b(' + '|'.join(valid_states) + r')\b', loc_str)
-        if match:
-            state_code = match.group(1)
-            key = f"br-{state_code}"
-            state_counts[key] = state_counts.get(key, 0) + cnt
-    
-    heatmap_data = [[k, v] for k, v in state_counts.items()]
-    heatmap_list = []
-    
-    STATE_MAP = {
-        'ac': 'Acre', 'al': 'Alagoas', 'ap': 'Amapá', 'am': 'Amazonas', 'ba': 'Bahia',
-        'ce': 'Ceará', 'df': 'Distrito Federal', 'es': 'Espírito Santo', 'go': 'Goiás',
-        'ma': 'Maranhão', 'mt': 'Mato Grosso', 'ms': 'Mato Grosso do Sul', 'mg': 'Minas Gerais',
-        'pa': 'Pará', 'pb': 'Paraíba', 'pr': 'Paraná', 'pe': 'Pernambuco', 'pi': 'Piauí',
-        'rj': 'Rio de Janeiro', 'rn': 'Rio Grande do Norte', 'rs': 'Rio Grande do Sul',
-        'ro': 'Rondônia', 'rr': 'Roraima', 'sc': 'Santa Catarina', 'sp': 'São Paulo',
-        'se': 'Sergipe', 'to': 'Tocantins'
-    }
+    avarias = filtrar_pesquisa(request.GET).select_related('cliente', 'veiculo', 'motorista').prefetch_related('itens__produto')
 
-    for k, v in state_counts.items():
-        state_code = k.replace('br-', '')
-        state_name = STATE_MAP.get(state_code, state_code.upper())
-        heatmap_list.append({'state': state_name, 'count': v})
-    
-    heatmap_list.sort(key=lambda x: x['count'], reverse=True)
-
-    # 3. TOP OFENDERS
-    top_drivers = (
-        qs_all
-        .values('motorista__nome', 'motorista__cpf')
-        .annotate(total=Count('id'))
-        .order_by('-total')[:5]
-    )
-    
-    top_products_total = (
-        qs_all
-        .values('produto__nome')
-        .annotate(total=Count('id'))
-        .order_by('-total')[:5]
-    )
-    
-    top_products_returned = (
-        qs_finalized
-        .filter(tipo_finalizacao='DEVOLUCAO_CONCLUIDA')
-        .values('produto__nome')
-        .annotate(total=Count('id'))
-        .order_by('-total')[:5]
-    )
-    
-    top_products_accepted = (
-        qs_finalized
-        .filter(tipo_finalizacao='ACEITE')
-        .values('produto__nome')
-        .annotate(total=Count('id'))
-        .order_by('-total')[:5]
-    )
-
-    # 4. SLAs
-    def calc_sla(queryset, start_field, end_field):
-        qs = queryset.filter(**{f"{start_field}__isnull": False, f"{end_field}__isnull": False})
-        if not qs.exists():
-            return {'min_time': None, 'avg_time': None, 'max_time': None}
-        stats = qs.aggregate(
-            min_time=Min(ExpressionWrapper(F(end_field) - F(start_field), output_field=DurationField())),
-            avg_time=Avg(ExpressionWrapper(F(end_field) - F(start_field), output_field=DurationField())),
-            max_time=Max(ExpressionWrapper(F(end_field) - F(start_field), output_field=DurationField()))
-        )
-        return stats
-
-    def format_duration(value):
-        if not value: return "-"
-        days = value.days
-        seconds = value.seconds
-        hours = seconds // 3600
-        minutes = (seconds % 3600) // 60
-        return f"{days} Dias e {hours:02}:{minutes:02} Horas"
-
-    def format_sla_dict(stats):
-        return {
-            'min_time': format_duration(stats['min_time']),
-            'avg_time': format_duration(stats['avg_time']),
-            'max_time': format_duration(stats['max_time'])
-        }
-
-    sla_decision = format_sla_dict(calc_sla(qs_all, 'data_criacao', 'data_decisao'))
-    sla_waiting_return = format_sla_dict(calc_sla(qs_all, 'data_decisao', 'data_inicio_devolucao'))
-    sla_transport = format_sla_dict(calc_sla(qs_finalized.filter(tipo_finalizacao='DEVOLUCAO_CONCLUIDA'), 'data_inicio_devolucao', 'data_finalizacao'))
-    
-    # -------------------------------------------------------------
-    # NEW LISTS: Monthly (12 months) and Annual (5 years) Financials
-    # -------------------------------------------------------------
-    # Helper to get financial breakdown
-    def get_financial_history(trunc_func, limit):
-         history = (qs_finalized
-            .annotate(period=trunc_func('data_finalizacao'))
-            .values('period')
-            .annotate(
-                val_devolvido=Sum('valor_nf', filter=Q(tipo_finalizacao='DEVOLUCAO_CONCLUIDA')),
-                val_aceitas=Sum('valor_nf', filter=Q(tipo_finalizacao='ACEITE')),
-                val_prejuizo=Sum('valor_nf', filter=Q(responsavel_prejuizo='TRANSBIRDAY'))
-            )
-            .order_by('-period')[:limit]
-         )
-         return list(history)
-         
-    history_monthly = get_financial_history(TruncMonth, 12)
-    history_yearly = get_financial_history(ExtractYear, 5)
-
-    # C. Financial Breakdown Lists (Monthly & Yearly)
-    
-    # 1. Last 12 Months
-    from datetime import timedelta
-    last_12_months = now - timedelta(days=365)
-    financial_12m = (
-        qs_finalized
-        .filter(data_finalizacao__gte=last_12_months)
-        .annotate(month=TruncMonth('data_finalizacao'))
-        .values('month')
-        .annotate(
-            total_cliente=Sum('valor_nf', filter=Q(responsavel_prejuizo='CLIENTE')),
-            total_transbirday=Sum('valor_nf', filter=Q(responsavel_prejuizo='TRANSBIRDAY')),
-            total_terceiro=Sum('valor_nf', filter=Q(responsavel_prejuizo='TRANSPORTADORA_TERCEIRA')),
-        )
-        .order_by('-month')
-    )
-    
-    # 2. Last 5 Years
-    last_5_years = now - timedelta(days=365*5)
-    financial_5y = (
-        qs_finalized
-        .filter(data_finalizacao__gte=last_5_years)
-        .annotate(year=ExtractYear('data_finalizacao'))
-        .values('year')
-        .annotate(
-            total_cliente=Sum('valor_nf', filter=Q(responsavel_prejuizo='CLIENTE')),
-            total_transbirday=Sum('valor_nf', filter=Q(responsavel_prejuizo='TRANSBIRDAY')),
-            total_terceiro=Sum('valor_nf', filter=Q(responsavel_prejuizo='TRANSPORTADORA_TERCEIRA')),
+    if request.GET.get('print'):
+        total = avarias.count()
+        if total > relatorios.LIMITE_IMPRESSAO:
+            # Too big to stream to the browser: offer the background export instead
+            return render(request, 'app_avarias/avaria_search_print_limite.html', {
+                'total': total,
+                'limite': relatorios.LIMITE_IMPRESSAO,
+                'parametros': relatorios.parametros_da_pesquisa(request.GET),
+            })
+        return StreamingHttpResponse(
+            relatorios.relatorio_pesquisa_html(avarias, total, request.user, autoprint=bool(request.GET.get('autoprint'))),
+            content_type='text/html; charset=utf-8',
         )
-        .order_by('-year')
-    )
 
-    context = {
-        'count_open': count_open,
-        'count_ready_return': count_ready_return,
-        'count_monthly_returns': count_monthly_returns,
-        'val_open': val_open,
-        'val_returned': val_returned,
-        'val_accepted': val_accepted,
-        'acceptance_rate': round(acceptance_rate, 1),
-        
-        'evolution_data': json.dumps(evolution_data, cls=DjangoJSONEncoder), 
-        'evolution_returns': json.dumps(evolution_returns, cls=DjangoJSONEncoder),
-        'evolution_accepted': json.dumps(evolution_accepted, cls=DjangoJSONEncoder),
-        'client_stats': list(client_stats),
-        'heatmap_data': json.dumps(heatmap_data, cls=DjangoJSONEncoder),
-        'heatmap_list': heatmap_list,
-        
-        'top_drivers': top_drivers,
-        'top_products_total': top_products_total,
-        'top_products_returned': top_products_returned,
-        'top_products_accepted': top_products_accepted,
-        
-        'sla_decision': sla_decision,
-        'sla_waiting_return': sla_waiting_return,
-        'sla_transport': sla_transport,
-        
-        'history_monthly': history_monthly,
-        'history_yearly': history_yearly,
-        
-        # New Financial Lists
-        'financial_12m': financial_12m,
-        'financial_5y': financial_5y,
+    return render(request, 'app_avarias/avaria_search.html', {
+        'avarias': avarias,
+        'parametros': relatorios.parametros_da_pesquisa(request.GET),
+        'limite_fichas_pdf': relatorios.LIMITE_FICHAS_PDF,
+    })
 
-        'month_options': [{'value': m, 'selected': m == current_month} for m in range(1, 13)],
-        'year_options': [{'value': y, 'selected': y == current_year} for y in range(2024, 2030)],
-    }
-    return render(request, 'app_avarias/dashboard.html', context)
+@login_required
+@group_required("Gestor")
+def avaria_search_export(request):
+    """
+    Gera em segundo plano o relatório da pesquisa (resultados grandes demais para
+    imprimir) ou as fichas das Avarias encontradas (tipo=FICHAS_PDF/FICHAS_ZIP).
+    """
+    if request.method != 'POST':
+        return redirect('avaria_search')
+    tipo = request.POST.get('tipo', 'PESQUISA')
+    if tipo not in dict(Exportacao.TIPO_CHOICES):
+        return redirect('avaria_search')
+    exportacao = relatorios.solicitar_exportacao(request.user, request.POST, tipo)
+    messages.info(request, "Exportação solicitada. O arquivo ficará disponível nesta página quando estiver pronto.")
+    return redirect('exportacao_detail', pk=exportacao.pk)
+
+def _exportacao_do_usuario(request, pk):
+    exportacao = get_object_or_404(Exportacao, pk=pk)
+    if exportacao.usuario_id != request.user.id and not request.user.is_superuser:
+        raise Http404
+    return exportacao
 
 @login_required
 @group_required("Gestor")
-def avaria_search(request):
-    import logging
-    logger = logging.getLogger(__name__)
-    
-    # Get Params
-    q = request.GET.get('q') # Termo geral (optional)
-    status = request.GET.get('status')
-    data_ini = request.GET.get('data_ini')
-    data_fim = request.GET.get('data_fim')
-    
-    # Specific Filters
-    nf = request.GET.get('nf')
-    nfd = request.GET.get('nfd') # NF Devolucao
-    placa = request.GET.get('placa')
-    cpf = request.GET.get('cpf')
-    motorista = request.GET.get('motorista')
-    local = request.GET.get('local')
-    
-    avarias = Avaria.objects.all().prefetch_related('itens__produto', 'cliente', 'veiculo', 'motorista').order_by('-data_criacao')
-    
-    # Generic Search
-    if q:
-        avarias = avarias.filter(
-            Q(nota_fiscal__icontains=q) |
-            Q(cliente__razao_social__icontains=q) |
-            Q(itens__produto__nome__icontains=q) |
-            Q(veiculo__placa__icontains=q) |
-            Q(motorista__nome__icontains=q)
-        ).distinct()
-    
-    # Specific Filters
-    if status:
-        avarias = avarias.filter(status=status)
-    if data_ini:
-        avarias = avarias.filter(data_criacao__date__gte=data_ini)
-    if data_fim:
-        avarias = avarias.filter(data_criacao__date__lte=data_fim)
-        
-    if nf:
-        avarias = avarias.filter(nota_fiscal__icontains=nf)
-    if nfd:
-        avarias = avarias.filter(nf_devolucao__icontains=nfd)
-    if placa:
-        avarias = avarias.filter(
-            Q(veiculo__placa__icontains=placa) | 
-            Q(veiculo_carreta__placa__icontains=placa)
-        )
-    if cpf:
-        avarias = avarias.filter(motorista__cpf__icontains=cpf)
-    if motorista:
-        avarias = avarias.filter(motorista__nome__icontains=motorista)
-    if local:
-        avarias = avarias.filter(local_atuacao__icontains=local)
-        
-    if request.GET.get('print'):
-        from django.utils import timezone
-        return render(request, 'app_avarias/avaria_search_print.html', {
-            'avarias': avarias,
-            'now': timezone.now()
-        })
-        
-    return render(request, 'app_avarias/avaria_search.html', {'avarias': avarias})
+def exportacao_detail(request, pk):
+    exportacao = _exportacao_do_usuario(request, pk)
+    # Lost on a process restart: show the error instead of refreshing forever
+    if relatorios.marcar_exportacoes_interrompidas(Exportacao.objects.filter(pk=exportacao.pk)):
+        exportacao.refresh_from_db()
+    return render(request, 'app_avarias/exportacao_detail.html', {'exportacao': exportacao})
+
+@login_required
+@group_required("Gestor")
+def exportacao_download(request, pk):
+    exportacao = _exportacao_do_usuario(request, pk)
+    if exportacao.status != 'CONCLUIDA' or not exportacao.arquivo:
+        raise Http404
+    return resposta_de_arquivo(request, exportacao.arquivo, etag=f'"exportacao-{exportacao.pk}-{exportacao.arquivo.size}"')
 
 @login_required
 @group_required(["Gestor", "Operacional"])
@@ -399,7 +149,23 @@ def avaria_list(request):
     status_filter = request.GET.get('status', 'EM_ABERTO')
     cd_filter = request.GET.get('cd_id')
     
-    avarias = Avaria.objects.all().prefetch_related('itens__produto').order_by('-data_criacao')
+    primeiro_item = AvariaItem.objects.filter(avaria=OuterRef('pk')).order_by('pk')
+    avarias = (
+        Avaria.objects
+        .select_related('cliente', 'produto')
+        .prefetch_related(Prefetch('itens', queryset=AvariaItem.objects.select_related('produto')))
+        .annotate(
+            total_itens=Coalesce(
+                Subquery(
+                    AvariaItem.objects.filter(avaria=OuterRef('pk')).order_by()
+                    .values('avaria').annotate(total=Count('pk')).values('total')
+                ),
+                0,
+            ),
+            primeiro_produto_nome=Subquery(primeiro_item.values('produto__nome')[:1]),
+            primeiro_produto_laboratorio=Subquery(primeiro_item.values('produto__laboratorio')[:1]),
+        )
+    )
     
     dashboard_cds = None
     selected_cd_id = None
@@ -426,8 +192,22 @@ def avaria_list(request):
                 except ValueError:
                     pass
         
+    pagina = paginar_por_cursor(
+        avarias,
+        cursor=request.GET.get('cursor'),
+        page_size=tamanho_da_pagina(request.GET.get('page_size')),
+    )
+
+    def querystring(cursor):
+        params = request.GET.copy()
+        params['cursor'] = cursor
+        return params.urlencode()
+
     context = {
-        'avarias': avarias,
+        'avarias': pagina,
+        'pagina': pagina,
+        'querystring_proxima': querystring(pagina.proximo_cursor) if pagina.tem_proxima else None,
+        'querystring_anterior': querystring(pagina.cursor_anterior) if pagina.tem_anterior else None,
         'current_filter': status_filter,
         'dashboard_cds': dashboard_cds,
         'selected_cd_id': selected_cd_id
@@ -450,6 +230,80 @@ def avaria_list(request):
 #     
 #     return render(request, 'app_avarias/avaria_form.html', {'form': form, 'title': 'Nova Avaria'})
 
+def _inteiro(valor, padrao=None):
+    try:
+        return int(valor)
+    except (TypeError, ValueError):
+        return padrao
+
+
+def _salvar_itens(avaria, dados, usuario):
+    """
+    Aplica o editor de itens (update_itens) numa única transação: um DELETE dos
+    itens removidos, um SELECT dos existentes, um bulk_update, um in_bulk dos
+    produtos novos, um bulk_create e o evento EDICAO_ITENS, qualquer que seja o
+    número de linhas.
+    Retorna quantas linhas novas foram ignoradas por produto inválido.
+    """
+    item_ids = dados.getlist('item_id[]')
+    lotes = dados.getlist('lote[]')
+    quantidades = dados.getlist('quantidade[]')
+    novos_produtos = dados.getlist('novo_produto_id[]')
+    novos_lotes = dados.getlist('novo_lote[]')
+    novas_quantidades = dados.getlist('novo_quantidade[]')
+
+    # Existing rows: position in the form -> item id
+    posicoes = {}
+    for i, item_id in enumerate(item_ids):
+        item_id = _inteiro(item_id)
+        if item_id is not None:
+            posicoes[item_id] = i
+
+    novos = [
+        (i, _inteiro(produto_id))
+        for i, produto_id in enumerate(novos_produtos) if produto_id
+    ]
+
+    with transaction.atomic():
+        # Items removed from the DOM
+        avaria.itens.exclude(id__in=list(posicoes)).delete()
+
+        itens = list(avaria.itens.filter(id__in=list(posicoes)))
+        agora = timezone.now()
+        for item in itens:
+            item.atualizado_em = agora
+            i = posicoes[item.id]
+            if i < len(lotes):
+                item.lote = lotes[i]
+            if i < len(quantidades):
+                qtd = _inteiro(quantidades[i])
+                if qtd is not None:
+                    item.quantidade = max(0, qtd)
+        AvariaItem.objects.bulk_update(itens, ['lote', 'quantidade', 'atualizado_em'])
+
+        produtos = Produto.objects.in_bulk([pk for _, pk in novos if pk is not None])
+        criar = []
+        for i, produto_id in novos:
+            if produto_id not in produtos:
+                continue
+            qtd = _inteiro(novas_quantidades[i] if i < len(novas_quantidades) else None, 1)
+            criar.append(AvariaItem(
+                avaria=avaria,
+                produto=produtos[produto_id],
+                lote=novos_lotes[i] if i < len(novos_lotes) else '',
+                quantidade=max(1, qtd),
+            ))
+        AvariaItem.objects.bulk_create(criar)
+        registrar_evento(avaria, 'EDICAO_ITENS', usuario, "Lista de produtos atualizada.")
+
+        # bulk_update/bulk_create do not send post_save
+        if itens or criar:
+            transaction.on_commit(invalidate_dashboard_cache)
+            transaction.on_commit(lambda: search.indexar_avarias([avaria.pk]))
+
+    return len(novos) - len(criar)
+
+
 @login_required
 @group_required(["Gestor", "Operacional"])
 def avaria_detail(request, pk):
@@ -468,14 +322,7 @@ def avaria_detail(request, pk):
         if 'add_observacao' in request.POST:
             obs_form = AvariaObservacaoForm(request.POST)
             if obs_form.is_valid():
-                texto = obs_form.cleaned_data['texto']
-                timestamp = timezone.localtime(timezone.now()).strftime("%d/%m/%Y %H:%M")
-                new_entry = f"[{timestamp} - {request.user.username}] {texto}\n"
-                if avaria.observacoes:
-                    avaria.observacoes += "\n" + new_entry
-                else:
-                    avaria.observacoes = new_entry
-                avaria.save()
+                registrar_evento(avaria, 'OBSERVACAO', request.user, obs_form.cleaned_data['texto'])
                 messages.success(request, 'Observação adicionada.')
                 return redirect('avaria_detail', pk=pk)
         
@@ -489,12 +336,6 @@ def avaria_detail(request, pk):
                 nf_retida = decisao_form.cleaned_data.get('nf_retida_conferencia')
                 horas = decisao_form.cleaned_data.get('horas_retencao')
                 
-                retencao_str = ""
-                if nf_retida == 'SIM':
-                    retencao_str = f" | [NF RETIDA NA CONFERÊNCIA: SIM ({horas}h)]"
-                else:
-                    retencao_str = " | [NF RETIDA NA CONFERÊNCIA: NÃO]"
-                
                 # New fields for DEVOLVER
                 nfd = decisao_form.cleaned_data.get('nf_devolucao', '')
                 cd = decisao_form.cleaned_data.get('cd_armazenagem_reversa')
@@ -504,22 +345,15 @@ def avaria_detail(request, pk):
                     messages.error(request, 'Para encaminhar para devolução, é obrigatório informar a Nota Fiscal de Devolução (NFD).')
                     return redirect('avaria_detail', pk=pk)
                 
-                # Build comprehensive history entry
-                cd_str = ""
-                if acao == 'DEVOLVER' and cd:
-                    cd_str = f" | [CD ARMAZENAGEM: {cd.codigo} - {cd.nome}]"
-                
-                nfd_str = ""
-                if acao == 'DEVOLVER' and nfd:
-                    nfd_str = f" | [NFD: {nfd}]"
-                
-                timestamp = timezone.localtime(timezone.now()).strftime("%d/%m/%Y %H:%M")
-                new_entry = f"[{timestamp} - {request.user.username}] [DECISÃO: {acao}]{retencao_str}{nfd_str}{cd_str} {obs_text}\n"
-
-                if avaria.observacoes:
-                    avaria.observacoes += "\n" + new_entry
-                else:
-                    avaria.observacoes = new_entry
+                # History entry
+                registrar_evento(
+                    avaria, 'DECISAO', request.user, obs_text,
+                    acao=acao,
+                    nf_retida=nf_retida,
+                    horas_retencao=horas if nf_retida == 'SIM' else None,
+                    nf_devolucao=nfd if acao == 'DEVOLVER' else None,
+                    cd=f"{cd.codigo} - {cd.nome}" if acao == 'DEVOLVER' and cd else None,
+                )
                 
                 if acao == 'ACEITAR':
                     avaria.status = 'FINALIZADA'
@@ -548,17 +382,10 @@ def avaria_detail(request, pk):
                 avaria.status = 'EM_ROTA_DEVOLUCAO'
                 avaria.data_inicio_devolucao = timezone.now()
                 
-                # History / Observation Log
-                obs_text = devolucao_form.cleaned_data.get('observacao_extra') or ""
-                timestamp = timezone.localtime(timezone.now()).strftime("%d/%m/%Y %H:%M")
-                new_entry = f"[{timestamp} - {request.user.username}] [SAÍDA DEVOLUÇÃO] {obs_text}\n"
-                
-                if avaria.observacoes:
-                    avaria.observacoes += "\n" + new_entry
-                else:
-                    avaria.observacoes = new_entry
-                        
                 avaria.save()
+
+                # History Log
+                registrar_evento(avaria, 'SAIDA_DEVOLUCAO', request.user, devolucao_form.cleaned_data.get('observacao_extra'))
                 messages.success(request, 'Devolução iniciada! Avaria em Rota.')
                 return redirect('avaria_detail', pk=pk)
             else:
@@ -575,16 +402,10 @@ def avaria_detail(request, pk):
                 avaria.tipo_finalizacao = 'DEVOLUCAO_CONCLUIDA'
                 avaria.data_finalizacao = timezone.now()
                 
-                # History Log
-                timestamp = timezone.localtime(timezone.now()).strftime("%d/%m/%Y %H:%M")
-                new_entry = f"[{timestamp} - {request.user.username}] [DEVOLUÇÃO CONCLUÍDA] Processo finalizado com comprovante.\n"
-                
-                if avaria.observacoes:
-                    avaria.observacoes += "\n" + new_entry
-                else:
-                    avaria.observacoes = new_entry
-                    
                 avaria.save()
+
+                # History Log
+                registrar_evento(avaria, 'DEVOLUCAO_CONCLUIDA', request.user, "Processo finalizado com comprovante.")
                 messages.success(request, 'Devolução concluída e finalizada!')
                 return redirect('avaria_detail', pk=pk)
             else:
@@ -606,75 +427,10 @@ def avaria_detail(request, pk):
         
         elif 'update_itens' in request.POST:
             # Handle items update
-            from .models import AvariaItem
-            
-            # 1. Update Existing Items and Handle Deletions
-            submitted_item_ids = request.POST.getlist('item_id[]')
-            submitted_lotes = request.POST.getlist('lote[]')
-            submitted_quantidades = request.POST.getlist('quantidade[]')
-            
-            # Delete items that are in DB but were not submitted (removed from DOM)
-            # Filter submitted_ids to ensure they are valid integers
-            valid_submitted_ids = []
-            for mid in submitted_item_ids:
-                try:
-                    valid_submitted_ids.append(int(mid))
-                except (ValueError, TypeError):
-                    pass
-            
-            # Delete items belonging to this avaria that are NOT in the submitted list
-            avaria.itens.exclude(id__in=valid_submitted_ids).delete()
-            
-            # Update values for submitted existing items
-            for i, item_id in enumerate(submitted_item_ids):
-                try:
-                    item = AvariaItem.objects.get(id=item_id, avaria=avaria)
-                    if i < len(submitted_lotes):
-                        item.lote = submitted_lotes[i]
-                    if i < len(submitted_quantidades):
-                        try:
-                            qtd = int(submitted_quantidades[i])
-                            item.quantidade = max(0, qtd) # Ensure non-negative
-                        except ValueError:
-                            pass
-                    item.save()
-                except (AvariaItem.DoesNotExist, ValueError):
-                    pass
+            ignorados = _salvar_itens(avaria, request.POST, request.user)
+            if ignorados:
+                messages.warning(request, f'{ignorados} novo(s) item(ns) ignorado(s): produto inválido.')
 
-            # 2. Handle New Items
-            novos_produtos = request.POST.getlist('novo_produto_id[]')
-            novos_lotes = request.POST.getlist('novo_lote[]')
-            novas_quantidades = request.POST.getlist('novo_quantidade[]')
-            
-            for i, produto_id in enumerate(novos_produtos):
-                if produto_id: # Ensure product ID is present
-                    try:
-                        qtd = 1
-                        if i < len(novas_quantidades) and novas_quantidades[i]:
-                            qtd = int(novas_quantidades[i])
-                        
-                        lote = ""
-                        if i < len(novos_lotes):
-                            lote = novos_lotes[i]
-                            
-                        AvariaItem.objects.create(
-                            avaria=avaria,
-                            produto_id=produto_id,
-                            lote=lote,
-                            quantidade=max(1, qtd)
-                        )
-                    except (ValueError, Exception) as e:
-                        print(f"Erro ao criar novo item: {e}")
-            
-            # Log the change
-            timestamp = timezone.localtime(timezone.now()).strftime("%d/%m/%Y %H:%M")
-            new_entry = f"[{timestamp} - {request.user.username}] [EDIÇÃO DE ITENS] Lista de produtos atualizada.\n"
-            if avaria.observacoes:
-                avaria.observacoes += "\n" + new_entry
-            else:
-                avaria.observacoes = new_entry
-            avaria.save()
-            
             messages.success(request, 'Alteraçoes salvas com sucesso!')
             return redirect('avaria_detail', pk=pk)
         
@@ -689,15 +445,13 @@ def avaria_detail(request, pk):
                     valor_anterior = avaria.valor_nf or Decimal('0')
                     avaria.valor_nf = Decimal(novo_valor)
                     
+                    avaria.save(update_fields=['valor_nf'])
+
                     # Log the change
-                    timestamp = timezone.localtime(timezone.now()).strftime("%d/%m/%Y %H:%M")
-                    new_entry = f"[{timestamp} - {request.user.username}] [AJUSTE DE VALOR] R$ {valor_anterior} → R$ {novo_valor} | Motivo: {motivo}\n"
-                    if avaria.observacoes:
-                        avaria.observacoes += "\n" + new_entry
-                    else:
-                        avaria.observacoes = new_entry
-                        
-                    avaria.save()
+                    registrar_evento(
+                        avaria, 'AJUSTE_VALOR', request.user,
+                        valor_anterior=str(valor_anterior), valor_novo=str(avaria.valor_nf), motivo=motivo,
+                    )
                     messages.success(request, 'Valor atualizado com sucesso!')
                 except Exception as e:
                      messages.error(request, f'Erro ao atualizar valor: {e}')
@@ -713,24 +467,14 @@ def avaria_detail(request, pk):
                 if cd_antigo != novo_cd:
                     avaria.cd_armazenagem_reversa = novo_cd
                     
+                    avaria.save(update_fields=['cd_armazenagem_reversa'])
+
                     # History Log
-                    timestamp = timezone.localtime(timezone.now()).strftime("%d/%m/%Y %H:%M")
-                    nome_antigo = f"{cd_antigo.codigo} - {cd_antigo.nome}" if cd_antigo else "Nenhum"
-                    nome_novo = f"{novo_cd.codigo} - {novo_cd.nome}"
-                    
-                    new_entry = (
-                        f"[{timestamp} - {request.user.username}] [TRANSFERÊNCIA CD]\n"
-                        f"CD de Origem: {nome_antigo}\n"
-                        f"CD de Destino: {nome_novo}\n"
-                        f"Observação adicional:\n{obs_transferencia}\n"
+                    registrar_evento(
+                        avaria, 'TRANSFERENCIA_CD', request.user, obs_transferencia,
+                        origem=f"{cd_antigo.codigo} - {cd_antigo.nome}" if cd_antigo else "Nenhum",
+                        destino=f"{novo_cd.codigo} - {novo_cd.nome}",
                     )
-                    
-                    if avaria.observacoes:
-                        avaria.observacoes += "\n" + new_entry
-                    else:
-                        avaria.observacoes = new_entry
-                        
-                    avaria.save()
                     messages.success(request, f'Avaria transferida com sucesso para {novo_cd.nome}!')
                 else:
                     messages.warning(request, 'O CD de destino é o mesmo do atual.')
@@ -760,6 +504,7 @@ def avaria_detail(request, pk):
 
     context = {
         'avaria': avaria,
+        'eventos': avaria.eventos.all(),
         'form': form,
         'decisao_form': decisao_form,
         'devolucao_form': devolucao_form,
@@ -797,7 +542,7 @@ def avaria_definicao_prejuizo_list(request):
         status='FINALIZADA',
         tipo_finalizacao='DEVOLUCAO_CONCLUIDA',
         responsavel_prejuizo__isnull=True
-    ).order_by('-data_finalizacao')
+    ).prefetch_related('eventos').order_by('-data_finalizacao')
     
     if request.method == 'POST':
         avaria_pk = request.POST.get('avaria_id')
@@ -807,9 +552,6 @@ def avaria_definicao_prejuizo_list(request):
             # Before saving, capture the responsibility for logging
             responsavel = form.cleaned_data.get('responsavel_prejuizo')
             
-            # History Log
-            timestamp = timezone.localtime(timezone.now()).strftime("%d/%m/%Y %H:%M")
-            
             # Detailed text construction
             detalhes_responsavel = ""
             if responsavel == 'TRANSBIRDAY':
@@ -823,18 +565,13 @@ def avaria_definicao_prejuizo_list(request):
                     # Fallback if selected transport service but it's not registered as third party (unlikely but safe)
                     detalhes_responsavel = "Transportadora Terceira (Dados não vinculados ao veículo)"
             
-            new_entry = f"[{timestamp} - {request.user.username}] [DEFINIÇÃO DE PREJUÍZO] Responsável: {avaria.get_responsavel_prejuizo_display()} - {detalhes_responsavel}\n"
-            
-            # We need to manually update observations since form only updates responsavel_prejuizo
-            # But wait, form.save() saves the instance. If we modify instance before save, it works.
-            avaria = form.save(commit=False)
-            
-            if avaria.observacoes:
-                avaria.observacoes += "\n" + new_entry
-            else:
-                avaria.observacoes = new_entry
-            
-            avaria.save()
+            avaria = form.save()
+
+            # History Log
+            registrar_evento(
+                avaria, 'DEFINICAO_PREJUIZO', request.user,
+                responsavel=responsavel, detalhes=detalhes_responsavel,
+            )
             messages.success(request, f'Responsabilidade definida para Avaria #{avaria.id}')
             return redirect('avaria_definicao_prejuizo_list')
     
@@ -847,7 +584,7 @@ def avaria_print(request, pk):
     
     fotos = []
     if show_photos:
-        fotos = avaria.fotos.all().order_by('criado_por', '-data_upload')
+        fotos = avaria.fotos.select_related('criado_por').order_by('criado_por', '-data_upload')
         
     context = {
         'avaria': avaria,
@@ -856,5 +593,21 @@ def avaria_print(request, pk):
     }
     return render(request, 'app_avarias/avaria_print.html', context)
 
+@login_required
+def avaria_pdf(request, pk):
+    """Ficha da Avaria em PDF; o arquivo só é gerado de novo quando a Avaria muda (ver pdf.py)."""
+    avaria = get_object_or_404(Avaria, pk=pk)
+    com_fotos = request.GET.get('fotos') == '1'
+    caminho, assinatura = pdf.pdf_da_avaria(avaria, com_fotos)
+
+    etag = f'"{assinatura}"'
+    if etag in request.headers.get('If-None-Match', ''):
+        response = HttpResponseNotModified()
+    else:
+        response = FileResponse(open(caminho, 'rb'), content_type='application/pdf', filename=f'avaria_{avaria.pk}.pdf')
+    response['ETag'] = etag
+    response['Cache-Control'] = 'private, no-cache'
+    return response
+
 def offline_view(request):
     return render(request, 'app_avarias/offline.html')
@@ -79,6 +79,24 @@ DATABASES = {
 }
 
 
+# Cache
+# File-based so every worker process sees the same entries (and the same
+# invalidations). Point this to Redis/Memcached if the app grows beyond one server.
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': BASE_DIR / 'cache',
+        'TIMEOUT': None,
+    }
+}
+
+# Background tasks (app_avarias/tasks.py)
+BACKGROUND_TASKS_WORKERS = 2
+BACKGROUND_TASKS_EXPORT_WORKERS = 1  # exports have their own pool (queue 'exports')
+BACKGROUND_TASKS_EAGER = False
+
+
 # Password validation
 # https://docs.djangoproject.com/en/5.0/ref/settings/#auth-password-validators
 
@@ -121,6 +139,19 @@ STATIC_ROOT = BASE_DIR / "staticfiles"
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / 'media'
 
+# Resumable photo uploads from the mobile app (app_avarias/uploads.py).
+# Partial files stay outside MEDIA_ROOT so they are never served.
+UPLOADS_PARCIAIS_DIR = BASE_DIR / 'uploads_parciais'
+UPLOAD_FOTO_TAMANHO_MAXIMO = 50 * 1024 * 1024
+
+# Avaria PDF reports, cached by the signature of their content (app_avarias/pdf.py)
+PDF_CACHE_DIR = BASE_DIR / 'cache_pdf'
+
+# API (app_api): cursor pagination by default, ?fields= on every serializer
+REST_FRAMEWORK = {
+    'DEFAULT_PAGINATION_CLASS': 'app_api.pagination.CursorPadrao',
+}
+
 # Auth Redirects
 LOGIN_REDIRECT_URL = 'welcome'
 LOGOUT_REDIRECT_URL = 'login'
@@ -33,11 +33,9 @@ class _AvariaDetailsScreenState extends State<AvariaDetailsScreen> {
     setState(() => _isUploading = true);
     final id = widget.avaria['id'];
     
-    int successCount = 0;
-    for (final file in _newPhotos) {
-        final success = await _api.uploadPhoto(id, file);
-        if (success) successCount++;
-    }
+    // Each photo is an independent upload, so they go in parallel
+    final results = await Future.wait(_newPhotos.map((file) => _api.uploadPhoto(id, file)));
+    final successCount = results.where((ok) => ok).length;
     
     setState(() => _isUploading = false);
     
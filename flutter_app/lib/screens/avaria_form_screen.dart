@@ -1,13 +1,15 @@
 import 'dart:io';
 import 'package:flutter/material.dart';
+import 'package:http/http.dart' as http;
 import '../services/api_service.dart';
 import '../services/camera_service.dart';
 
 class AvariaItemTemp {
   final int produtoId;
+  final String produtoNome;
   final int quantidade;
 
-  AvariaItemTemp(this.produtoId, this.quantidade);
+  AvariaItemTemp(this.produtoId, this.produtoNome, this.quantidade);
 }
 
 class AvariaFormScreen extends StatefulWidget {
@@ -23,18 +25,37 @@ class _AvariaFormScreenState extends State<AvariaFormScreen> {
   final _cameraService = CameraService();
 
   // Header Controllers
-  final _clienteIdController = TextEditingController();
   final _nfController = TextEditingController();
 
   // Item Controllers
-  final _produtoIdController = TextEditingController();
+  TextEditingController? _produtoController;
   final _qtdController = TextEditingController();
 
+  // Clientes and produtos come from the catalog kept on the device
+  // (GET /api/catalog/), so the form also works without signal
+  Map<String, List<dynamic>> _catalog = {};
+  int? _clienteId;
+  Map<String, dynamic>? _produto;
+
   // Data
   final List<AvariaItemTemp> _items = [];
   final List<File> _imageFiles = [];
   bool _isSubmitting = false;
 
+  @override
+  void initState() {
+    super.initState();
+    _api.getCatalog().then((catalog) {
+      if (mounted) setState(() => _catalog = catalog);
+    }).catchError((e) {
+      if (mounted) {
+        ScaffoldMessenger.of(context).showSnackBar(
+          SnackBar(content: Text('Erro ao carregar cadastros: $e')),
+        );
+      }
+    });
+  }
+
   Future<void> _takePhoto() async {
     final file = await _cameraService.takePhoto();
     if (file != null) {
@@ -43,23 +64,58 @@ class _AvariaFormScreenState extends State<AvariaFormScreen> {
   }
 
   void _addItem() {
-    final prodId = int.tryParse(_produtoIdController.text);
+    final produto = _produto;
     final qtd = int.tryParse(_qtdController.text);
 
-    if (prodId != null && qtd != null && prodId > 0 && qtd > 0) {
+    if (produto != null && qtd != null && qtd > 0) {
       setState(() {
-        _items.add(AvariaItemTemp(prodId, qtd));
+        _items.add(AvariaItemTemp(produto['id'], produto['nome'], qtd));
         // Reset input fields
-        _produtoIdController.clear();
+        _produto = null;
+        _produtoController?.clear();
         _qtdController.clear();
       });
     } else {
       ScaffoldMessenger.of(context).showSnackBar(
-        const SnackBar(content: Text('ID do Produto e Quantidade inválidos')),
+        const SnackBar(content: Text('Produto e Quantidade inválidos')),
       );
     }
   }
 
+  // Text field with suggestions from one list of the catalog
+  Widget _catalogField({
+    required String name,
+    required String label,
+    required String Function(Map<String, dynamic>) display,
+    required void Function(Map<String, dynamic>?) onChanged,
+    FormFieldValidator<String>? validator,
+    void Function(TextEditingController)? onController,
+  }) {
+    return Autocomplete<Map<String, dynamic>>(
+      displayStringForOption: display,
+      optionsBuilder: (value) {
+        final text = value.text.toLowerCase();
+        if (text.isEmpty) return const Iterable.empty();
+        return (_catalog[name] ?? [])
+            .cast<Map<String, dynamic>>()
+            .where((row) => row.values.any((v) => '$v'.toLowerCase().contains(text)))
+            .take(20);
+      },
+      onSelected: onChanged,
+      fieldViewBuilder: (context, controller, focusNode, onSubmitted) {
+        onController?.call(controller);
+        return TextFormField(
+          controller: controller,
+          focusNode: focusNode,
+          decoration: InputDecoration(labelText: label, isDense: true),
+          // Typing again discards the previous selection
+          onChanged: (_) => onChanged(null),
+          validator: validator,
+        );
+      },
+    );
+  }
+
   void _removeItem(int index) {
     setState(() {
       _items.removeAt(index);
@@ -78,7 +134,7 @@ class _AvariaFormScreenState extends State<AvariaFormScreen> {
       setState(() => _isSubmitting = true);
 
       final data = {
-        'cliente': int.tryParse(_clienteIdController.text),
+        'cliente': _clienteId,
         'nota_fiscal': _nfController.text,
         'itens': _items
             .map((i) => {
@@ -90,26 +146,27 @@ class _AvariaFormScreenState extends State<AvariaFormScreen> {
       };
 
       try {
-        final newId = await _api.createAvariaReturningId(data);
-
-        if (newId != null) {
-          // Upload Photos
-          int successCount = 0;
-          for (final file in _imageFiles) {
-            final result = await _api.uploadPhoto(newId, file);
-            if (result) successCount++;
-          }
+        // Queued first: if the connection drops, the avaria is not lost and
+        // resending it later cannot create a duplicate
+        await _api.queueAvaria(data, _imageFiles);
+        String message;
+        try {
+          await _api.sendPendingAvarias();
+          message = 'Avaria registrada!';
+        } on SocketException {
+          message = 'Sem conexão: avaria salva no aparelho e será enviada depois.';
+        } on http.ClientException {
+          message = 'Sem conexão: avaria salva no aparelho e será enviada depois.';
+        } catch (e) {
+          // Already queued: submitting the form again would duplicate it
+          message = 'Falha no envio: $e';
+        }
 
-          if (mounted) {
-            Navigator.pop(context);
-            ScaffoldMessenger.of(context).showSnackBar(
-              SnackBar(
-                  content:
-                      Text('Avaria registrada! $successCount fotos enviadas.')),
-            );
-          }
-        } else {
-          throw Exception('Falha ao criar avaria (ID nulo)');
+        if (mounted) {
+          Navigator.pop(context);
+          ScaffoldMessenger.of(context).showSnackBar(
+            SnackBar(content: Text(message)),
+          );
         }
       } catch (e) {
         if (mounted) {
@@ -138,12 +195,12 @@ class _AvariaFormScreenState extends State<AvariaFormScreen> {
                 child: Padding(
                   padding: const EdgeInsets.all(16.0),
                   child: Column(children: [
-                    TextFormField(
-                      controller: _clienteIdController,
-                      decoration: const InputDecoration(
-                          labelText: 'ID Cliente', hintText: 'Insira o ID'),
-                      keyboardType: TextInputType.number,
-                      validator: (v) => v!.isEmpty ? 'Campo obrigatório' : null,
+                    _catalogField(
+                      name: 'clientes',
+                      label: 'Cliente (nome ou CNPJ)',
+                      display: (c) => c['razao_social'],
+                      onChanged: (c) => _clienteId = c?['id'],
+                      validator: (_) => _clienteId == null ? 'Selecione um cliente' : null,
                     ),
                     const SizedBox(height: 10),
                     TextFormField(
@@ -171,7 +228,7 @@ class _AvariaFormScreenState extends State<AvariaFormScreen> {
                       final item = _items[idx];
                       return ListTile(
                         leading: CircleAvatar(child: Text('${idx + 1}')),
-                        title: Text('Produto ID: ${item.produtoId}'),
+                        title: Text(item.produtoNome),
                         subtitle: Text('Qtd: ${item.quantidade}'),
                         trailing: IconButton(
                           icon: const Icon(Icons.delete, color: Colors.red),
@@ -194,11 +251,13 @@ class _AvariaFormScreenState extends State<AvariaFormScreen> {
                   child: Row(
                     children: [
                       Expanded(
-                        child: TextField(
-                          controller: _produtoIdController,
-                          keyboardType: TextInputType.number,
-                          decoration: const InputDecoration(
-                              labelText: 'ID Produto', isDense: true),
+                        flex: 2,
+                        child: _catalogField(
+                          name: 'produtos',
+                          label: 'Produto',
+                          display: (p) => p['nome'],
+                          onChanged: (p) => _produto = p,
+                          onController: (c) => _produtoController = c,
                         ),
                       ),
                       const SizedBox(width: 10),
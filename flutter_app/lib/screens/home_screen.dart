@@ -14,19 +14,35 @@ class HomeScreen extends StatefulWidget {
 class _HomeScreenState extends State<HomeScreen> {
   final _api = ApiService();
   late Future<List<dynamic>> _avariasFuture;
+  int _pending = 0;
 
   @override
   void initState() {
     super.initState();
+    // Refresh the reference data while online (usually a 304), so the form
+    // has it on the device even without signal
+    _api.getCatalog().catchError((_) => <String, List<dynamic>>{});
     _loadData();
   }
 
   void _loadData() {
     setState(() {
-      _avariasFuture = _api.getAvarias();
+      _avariasFuture = _sendPendingAndLoad();
     });
   }
 
+  // Avarias queued without signal go out on every refresh
+  Future<List<dynamic>> _sendPendingAndLoad() async {
+    try {
+      await _api.sendPendingAvarias();
+    } catch (_) {
+      // Still offline: the queue is kept for the next refresh
+    }
+    final pending = await _api.pendingAvariasCount();
+    if (mounted) setState(() => _pending = pending);
+    return _api.getAvarias();
+  }
+
   @override
   Widget build(BuildContext context) {
     return Scaffold(
@@ -47,50 +63,65 @@ class _HomeScreenState extends State<HomeScreen> {
         },
         child: const Icon(Icons.add),
       ),
-      body: FutureBuilder<List<dynamic>>(
-        future: _avariasFuture,
-        builder: (context, snapshot) {
-          if (snapshot.connectionState == ConnectionState.waiting) {
-            return const Center(child: CircularProgressIndicator());
-          }
-          if (snapshot.hasError) {
-            return Center(child: Text('Erro: ${snapshot.error}'));
-          }
-          final list = snapshot.data ?? [];
-          if (list.isEmpty) {
-            return const Center(child: Text('Nenhuma avaria pendente.'));
-          }
+      body: Column(
+        children: [
+          if (_pending > 0)
+            Container(
+              width: double.infinity,
+              color: Colors.amber[100],
+              padding: const EdgeInsets.all(12),
+              child: Text('$_pending avaria(s) aguardando envio. Toque em atualizar quando houver sinal.'),
+            ),
+          Expanded(child: _buildList()),
+        ],
+      ),
+    );
+  }
+
+  Widget _buildList() {
+    return FutureBuilder<List<dynamic>>(
+      future: _avariasFuture,
+      builder: (context, snapshot) {
+        if (snapshot.connectionState == ConnectionState.waiting) {
+          return const Center(child: CircularProgressIndicator());
+        }
+        if (snapshot.hasError) {
+          return Center(child: Text('Erro: ${snapshot.error}'));
+        }
+        final list = snapshot.data ?? [];
+        if (list.isEmpty) {
+          return const Center(child: Text('Nenhuma avaria pendente.'));
+        }
 
-          return ListView.builder(
-            itemCount: list.length,
-            itemBuilder: (context, index) {
-              final item = list[index];
-              return Card(
-                margin: const EdgeInsets.symmetric(horizontal: 16, vertical: 8),
-                child: ListTile(
-                  leading: const CircleAvatar(
-                    backgroundColor: Colors.orangeAccent,
-                    child: Icon(Icons.inventory_2, color: Colors.white),
-                  ),
-                  title: Text(item['produto_nome'] ?? 'Produto desconhecido'),
-                  subtitle: Text(
-                      '${item['cliente_nome']} • NF: ${item['nota_fiscal']}'),
-                  trailing: const Icon(Icons.chevron_right),
-                  onTap: () async {
-                    await Navigator.push(
-                      context,
-                      MaterialPageRoute(
-                        builder: (context) => AvariaDetailsScreen(avaria: item),
-                      ),
-                    );
-                    _loadData(); // Reload list on return in case status changed
-                  },
+        return ListView.builder(
+          itemCount: list.length,
+          itemBuilder: (context, index) {
+            final item = list[index];
+            return Card(
+              margin: const EdgeInsets.symmetric(horizontal: 16, vertical: 8),
+              child: ListTile(
+                leading: const CircleAvatar(
+                  backgroundColor: Colors.orangeAccent,
+                  child: Icon(Icons.inventory_2, color: Colors.white),
                 ),
-              );
-            },
-          );
-        },
-      ),
+                title: Text(item['produto_nome'] ?? 'Produto desconhecido'),
+                subtitle: Text(
+                    '${item['cliente_nome']} • NF: ${item['nota_fiscal']}'),
+                trailing: const Icon(Icons.chevron_right),
+                onTap: () async {
+                  await Navigator.push(
+                    context,
+                    MaterialPageRoute(
+                      builder: (context) => AvariaDetailsScreen(avaria: item),
+                    ),
+                  );
+                  _loadData(); // Reload list on return in case status changed
+                },
+              ),
+            );
+          },
+        );
+      },
     );
   }
 }
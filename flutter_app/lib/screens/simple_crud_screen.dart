@@ -41,7 +41,11 @@ class _SimpleCrudScreenState extends State<SimpleCrudScreen> {
 
   void _loadData() {
     setState(() {
-      _dataFuture = _api.getList(widget.endpoint);
+      _dataFuture = _api.getList(widget.endpoint, fields: [
+        'id',
+        widget.titleKey,
+        if (widget.subtitleKey != null) widget.subtitleKey!,
+      ]);
     });
   }
 
@@ -1,6 +1,9 @@
 import 'dart:convert';
 import 'dart:io';
+import 'dart:math';
+import 'package:crypto/crypto.dart';
 import 'package:http/http.dart' as http;
+import 'package:path_provider/path_provider.dart';
 import 'package:shared_preferences/shared_preferences.dart';
 
 class ApiService {
@@ -34,7 +37,7 @@ class ApiService {
     try {
       print('Tentando login em: $baseUrl/avarias/');
       final response = await http.get(
-        Uri.parse('$baseUrl/avarias/'), // Test endpoint
+        Uri.parse('$baseUrl/avarias/?fields=id&page_size=1'), // Test endpoint
         headers: {'Authorization': basicAuth},
       ).timeout(const Duration(seconds: 10));
 
@@ -50,23 +53,116 @@ class ApiService {
     return false;
   }
 
+  // Incremental sync (GET /api/sync/?since=<token>): the avarias are kept on
+  // the device and only what changed since the last token is downloaded.
+  static const String _syncTokenKey = 'sync_token';
+  static const String _syncAvariasKey = 'sync_avarias';
+
   Future<List<dynamic>> getAvarias() async {
+    final prefs = await SharedPreferences.getInstance();
+    final since = prefs.getString(_syncTokenKey);
+    final Map<String, dynamic> avarias =
+        jsonDecode(prefs.getString(_syncAvariasKey) ?? '{}');
+
     final token = await getToken();
     final response = await http.get(
-      Uri.parse('$baseUrl/avarias/?status=EM_ABERTO'),
+      Uri.parse(since == null ? '$baseUrl/sync/' : '$baseUrl/sync/?since=$since'),
       headers: {
         'Content-Type': 'application/json',
         'Authorization': token ?? '',
       },
     );
 
-    if (response.statusCode == 200) {
-      return jsonDecode(utf8.decode(response.bodyBytes));
-    } else {
+    if (response.statusCode != 200) {
       throw Exception('Failed to load avarias');
     }
+    final body = jsonDecode(utf8.decode(response.bodyBytes));
+    if (body['completo'] == true) avarias.clear();
+    for (final avaria in body['avarias']) {
+      avarias['${avaria['id']}'] = avaria;
+    }
+    for (final id in body['removidos']['avarias']) {
+      avarias.remove('$id');
+    }
+    await prefs.setString(_syncAvariasKey, jsonEncode(avarias));
+    await prefs.setString(_syncTokenKey, body['token']);
+
+    final abertas = avarias.values
+        .where((avaria) => avaria['status'] == 'EM_ABERTO')
+        .toList()
+      ..sort((a, b) => (b['data_criacao'] as String).compareTo(a['data_criacao']));
+    return abertas;
   }
 
+  // Reference data (GET /api/catalog/): clientes, condutores, veiculos and
+  // produtos in one bundle. The last ETag and token are sent back, so an
+  // unchanged catalog costs a 304 and a changed one only the diff.
+  static const String _catalogEtagKey = 'catalog_etag';
+  static const String _catalogTokenKey = 'catalog_token';
+  static const String _catalogKey = 'catalog';
+  static const List<String> _catalogNames = ['clientes', 'condutores', 'veiculos', 'produtos'];
+
+  Future<Map<String, List<dynamic>>> getCatalog() async {
+    final prefs = await SharedPreferences.getInstance();
+    final etag = prefs.getString(_catalogEtagKey);
+    final since = prefs.getString(_catalogTokenKey);
+    final Map<String, dynamic> catalog =
+        jsonDecode(prefs.getString(_catalogKey) ?? '{}');
+    final hasCatalog = catalog.isNotEmpty;
+
+    final token = await getToken();
+    final http.Response response;
+    try {
+      response = await http.get(
+        Uri.parse(hasCatalog && since != null ? '$baseUrl/catalog/?since=$since' : '$baseUrl/catalog/'),
+        headers: {
+          'Content-Type': 'application/json',
+          'Authorization': token ?? '',
+          if (hasCatalog && etag != null) 'If-None-Match': etag,
+        },
+      );
+    } on IOException {
+      // Offline: the copy on the device is enough to fill the form
+      if (hasCatalog) return _catalogLists(catalog);
+      rethrow;
+    } on http.ClientException {
+      if (hasCatalog) return _catalogLists(catalog);
+      rethrow;
+    }
+
+    if (response.statusCode == 200) {
+      final body = jsonDecode(utf8.decode(response.bodyBytes));
+      final removidos = body['removidos'];
+      for (final name in _catalogNames) {
+        // Full bundle: replace; diff: merge by id and drop the removed ones
+        final rows = <String, dynamic>{
+          if (removidos != null)
+            for (final row in catalog[name] ?? []) '${row['id']}': row,
+        };
+        for (final row in body[name]) {
+          rows['${row['id']}'] = row;
+        }
+        for (final id in removidos?[name] ?? []) {
+          rows.remove('$id');
+        }
+        catalog[name] = rows.values.toList()
+          ..sort((a, b) => (a['id'] as int).compareTo(b['id']));
+      }
+      await prefs.setString(_catalogKey, jsonEncode(catalog));
+      await prefs.setString(_catalogEtagKey, response.headers['etag'] ?? '');
+      if (body['token'] != null) await prefs.setString(_catalogTokenKey, body['token']);
+    } else if (response.statusCode != 304) {
+      throw Exception('Falha ao carregar cadastros');
+    }
+
+    return _catalogLists(catalog);
+  }
+
+  static Map<String, List<dynamic>> _catalogLists(Map<String, dynamic> catalog) => {
+        for (final name in _catalogNames)
+          name: List<dynamic>.from(catalog[name] ?? []),
+      };
+
   Future<int?> createAvariaReturningId(Map<String, dynamic> data) async {
     final token = await getToken();
     final response = await http.post(
@@ -90,42 +186,226 @@ class ApiService {
     return id != null;
   }
 
+  // Offline queue (POST /api/avarias/bulk/): every avaria registered in the
+  // form is stored here with a key generated on the device, then sent. The
+  // key stays with the entry, so resending after a dropped connection or
+  // response returns the ids the server already created instead of
+  // duplicating them. Photos are copied out of the temporary directory and
+  // uploaded once the avaria has an id.
+  static const String _pendingAvariasKey = 'pending_avarias';
+
+  static String _newKey() {
+    final random = Random.secure();
+    final bytes = List<int>.generate(16, (_) => random.nextInt(256));
+    bytes[6] = (bytes[6] & 0x0f) | 0x40; // version 4
+    bytes[8] = (bytes[8] & 0x3f) | 0x80; // RFC 4122 variant
+    final hex = bytes.map((b) => b.toRadixString(16).padLeft(2, '0')).join();
+    return '${hex.substring(0, 8)}-${hex.substring(8, 12)}-${hex.substring(12, 16)}'
+        '-${hex.substring(16, 20)}-${hex.substring(20)}';
+  }
+
+  Future<List<dynamic>> _loadPending(SharedPreferences prefs) async =>
+      jsonDecode(prefs.getString(_pendingAvariasKey) ?? '[]');
+
+  Future<void> _savePending(SharedPreferences prefs, List<dynamic> pending) =>
+      prefs.setString(_pendingAvariasKey, jsonEncode(pending));
+
+  Future<void> queueAvaria(Map<String, dynamic> data, List<File> photos) async {
+    final key = _newKey();
+    final dir = Directory('${(await getApplicationDocumentsDirectory()).path}/pending_photos');
+    await dir.create(recursive: true);
+    final paths = <String>[];
+    for (var i = 0; i < photos.length; i++) {
+      paths.add((await photos[i].copy('${dir.path}/${key}_$i.jpg')).path);
+    }
+
+    final prefs = await SharedPreferences.getInstance();
+    final pending = await _loadPending(prefs);
+    pending.add({'dados': {...data, 'chave': key}, 'fotos': paths});
+    await _savePending(prefs, pending);
+  }
+
+  Future<int> pendingAvariasCount() async {
+    final prefs = await SharedPreferences.getInstance();
+    return (await _loadPending(prefs)).length;
+  }
+
+  // Sends the queued avarias in one request and then their photos. Returns
+  // how many entries were fully sent; what fails stays queued for the next
+  // call (network errors are rethrown).
+  Future<int> sendPendingAvarias() async {
+    final prefs = await SharedPreferences.getInstance();
+    var pending = await _loadPending(prefs);
+    final toCreate = pending.where((entry) => entry['id'] == null).toList();
+
+    if (toCreate.isNotEmpty) {
+      final token = await getToken();
+      final response = await http.post(
+        Uri.parse('$baseUrl/avarias/bulk/'),
+        headers: {
+          'Content-Type': 'application/json',
+          'Authorization': token ?? '',
+        },
+        body: jsonEncode({'avarias': toCreate.map((entry) => entry['dados']).toList()}),
+      );
+      if (response.statusCode == 400) {
+        // Entries the server refuses would block the queue forever: drop them
+        final errors = jsonDecode(utf8.decode(response.bodyBytes))['avarias'];
+        if (errors is List) {
+          final rejected = {
+            for (var i = 0; i < errors.length; i++)
+              if ((errors[i] as Map).isNotEmpty) toCreate[i]['dados']['chave'],
+          };
+          pending = await _loadPending(prefs);
+          pending.removeWhere((entry) => rejected.contains(entry['dados']['chave']));
+          await _savePending(prefs, pending);
+          throw Exception('${rejected.length} avaria(s) recusada(s) pelo servidor');
+        }
+      }
+      if (response.statusCode != 200 && response.statusCode != 201) {
+        throw Exception('Falha ao enviar avarias pendentes');
+      }
+      final body = jsonDecode(utf8.decode(response.bodyBytes));
+      final ids = <String, int>{
+        for (final result in body['avarias']) result['chave']: result['id'],
+      };
+      // Re-read: entries queued while the request was in flight are kept
+      pending = await _loadPending(prefs);
+      for (final entry in pending) {
+        entry['id'] ??= ids[entry['dados']['chave']];
+      }
+      await _savePending(prefs, pending);
+    }
+
+    var sent = 0;
+    for (final entry in pending.where((entry) => entry['id'] != null).toList()) {
+      final remaining = <String>[];
+      for (final path in List<String>.from(entry['fotos'])) {
+        final file = File(path);
+        if (!await file.exists()) continue;
+        if (await uploadPhoto(entry['id'], file)) {
+          await file.delete();
+        } else {
+          remaining.add(path);
+        }
+      }
+      entry['fotos'] = remaining;
+      if (remaining.isEmpty) {
+        pending.remove(entry);
+        sent++;
+      }
+    }
+    await _savePending(prefs, pending);
+    return sent;
+  }
+
+  // Resumable chunked upload (see app_avarias/uploads.py on the server):
+  // start -> PUT chunks with Upload-Offset -> finalize with the SHA-256.
+  // After a dropped connection the upload resumes from the offset the server
+  // already has instead of starting over.
+  static const int chunkSize = 512 * 1024;
+  static const int maxRetries = 5;
+
   Future<bool> uploadPhoto(int avariaId, File imageFile) async {
     final token = await getToken();
-    var uri = Uri.parse('$baseUrl/avarias/$avariaId/upload_foto/');
+    final headers = {'Authorization': token ?? ''};
+    final length = await imageFile.length();
 
-    var request = http.MultipartRequest('POST', uri);
-    request.headers['Authorization'] = token ?? '';
+    try {
+      final start = await http.post(
+        Uri.parse('$baseUrl/avarias/$avariaId/uploads/'),
+        headers: {...headers, 'Content-Type': 'application/json'},
+        body: jsonEncode({
+          'nome': imageFile.path.split(Platform.pathSeparator).last,
+          'tamanho': length,
+        }),
+      );
+      if (start.statusCode != 201) return false;
+      final uploadUrl = '$baseUrl/avarias/$avariaId/uploads/${jsonDecode(start.body)['id']}/';
 
-    // 'arquivo' is the field name expected by AvariaFotoSerializer
-    request.files
-        .add(await http.MultipartFile.fromPath('arquivo', imageFile.path));
+      int offset = 0;
+      int failures = 0;
+      final raf = await imageFile.open();
+      try {
+        while (offset < length) {
+          try {
+            await raf.setPosition(offset);
+            final chunk = await raf.read(min(chunkSize, length - offset));
+            final response = await http
+                .put(
+                  Uri.parse(uploadUrl),
+                  headers: {
+                    ...headers,
+                    'Content-Type': 'application/octet-stream',
+                    'Upload-Offset': '$offset',
+                  },
+                  body: chunk,
+                )
+                .timeout(const Duration(seconds: 60));
+            if (response.statusCode == 200 || response.statusCode == 409) {
+              // 409: server is at a different offset, continue from there
+              offset = jsonDecode(response.body)['offset'];
+              failures = 0;
+              continue;
+            }
+            if (response.statusCode != 400) return false;
+          } catch (e) {
+            print('Upload chunk error: $e');
+          }
+          if (++failures > maxRetries) return false;
+          await Future.delayed(Duration(seconds: 1 << failures));
+          offset = await _uploadOffset(uploadUrl, headers) ?? offset;
+        }
+      } finally {
+        await raf.close();
+      }
 
-    try {
-      var response = await request.send();
-      return response.statusCode == 201;
+      final digest = await sha256.bind(imageFile.openRead()).first;
+      final done = await http.post(
+        Uri.parse('${uploadUrl}finalizar/'),
+        headers: {...headers, 'Content-Type': 'application/json'},
+        body: jsonEncode({'sha256': digest.toString()}),
+      );
+      return done.statusCode == 201;
     } catch (e) {
       print('Upload error: $e');
       return false;
     }
   }
 
-  // Generic CRUD Helper
-  Future<List<dynamic>> getList(String endpoint) async {
+  Future<int?> _uploadOffset(String uploadUrl, Map<String, String> headers) async {
+    try {
+      final response = await http.get(Uri.parse(uploadUrl), headers: headers);
+      if (response.statusCode == 200) return jsonDecode(response.body)['offset'];
+    } catch (_) {}
+    return null;
+  }
+
+  // Generic CRUD Helper. Lists are cursor-paginated ({next, results}): the
+  // pages are followed until "next" is null. [fields] limits the payload to
+  // the keys the screen shows (?fields=id,nome,...).
+  Future<List<dynamic>> getList(String endpoint, {List<String>? fields}) async {
     final token = await getToken();
-    final response = await http.get(
-      Uri.parse('$baseUrl/$endpoint/'),
-      headers: {
-        'Content-Type': 'application/json',
-        'Authorization': token ?? '',
-      },
-    );
+    final query = fields == null ? '' : '?fields=${fields.join(',')}';
+    String? url = '$baseUrl/$endpoint/$query';
+    final results = <dynamic>[];
 
-    if (response.statusCode == 200) {
-      return jsonDecode(utf8.decode(response.bodyBytes));
-    } else {
-      throw Exception('Falha ao carregar $endpoint');
+    while (url != null) {
+      final response = await http.get(
+        Uri.parse(url),
+        headers: {
+          'Content-Type': 'application/json',
+          'Authorization': token ?? '',
+        },
+      );
+      if (response.statusCode != 200) {
+        throw Exception('Falha ao carregar $endpoint');
+      }
+      final page = jsonDecode(utf8.decode(response.bodyBytes));
+      results.addAll(page['results']);
+      url = page['next'];
     }
+    return results;
   }
 
   Future<bool> createItem(String endpoint, Map<String, dynamic> data) async {